@@ -0,0 +1,179 @@
+'''
+ Cost of assembling frames from blocks of raw samples
+'''
+
+import numpy as np
+import pytest
+
+IM_SIZES = [128, 256, 512, 1024]
+
+
+@pytest.mark.benchmark(group='assemble raster')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_assemble_raster(benchmark, im_size):
+    # One sample per pixel: a plain scatter
+    from scanPatterns import rasterPattern
+    P = rasterPattern(rows=im_size, cols=im_size).compile()
+    data = np.random.rand(P.num_samples)
+    out = np.empty(P.frame_shape)
+    benchmark(P.assemble, data, out)
+
+
+@pytest.mark.benchmark(group='assemble raster with fly-back')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_assemble_raster_flyback(benchmark, im_size):
+    # Fly-back samples are discarded so this exercises the bincount path
+    from scanPatterns import rasterPattern
+    P = rasterPattern(rows=im_size, cols=im_size, flyback_samples=16).compile()
+    data = np.random.rand(P.num_samples)
+    out = np.empty(P.frame_shape)
+    benchmark(P.assemble, data, out)
+
+
+@pytest.mark.benchmark(group='assemble reshape and transpose')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_reshape_transpose(benchmark, im_size):
+    # The original basicScanner approach, for comparison
+    data = list(np.random.rand(im_size**2))
+    benchmark(lambda: np.transpose(np.array(data).reshape(im_size, im_size)))
+
+
+@pytest.mark.benchmark(group='photon counting: difference and sum')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_photon_counts(benchmark, im_size):
+    # Per-sample counts from a cumulative uint32 count, then summed into a uint16 frame
+    from scanPatterns import rasterPattern
+    P = rasterPattern(rows=im_size, cols=im_size, flyback_samples=16).compile()
+    cumulative = np.cumsum(np.random.poisson(2, P.num_samples)).astype(np.uint32)
+    counts = np.empty_like(cumulative)
+    out = np.empty(P.frame_shape, dtype=np.uint16)
+
+    def assemble():
+        np.subtract(cumulative[1:], cumulative[:-1], out=counts[1:])
+        counts[0] = cumulative[0]
+        return P.assemble_counts(counts, out)
+
+    benchmark(assemble)
+
+
+@pytest.mark.benchmark(group='oversampled integration')
+@pytest.mark.parametrize('oversample', [4, 20])
+@pytest.mark.parametrize('im_size', [256, 512])
+def bench_oversampled_integration(benchmark, fast_simulation, im_size, oversample):
+    # Integrating oversample AI samples into each pixel with np.add.reduceat
+    from oversampledScanner import oversampledScanner
+    S = oversampledScanner(autoconnect=False, simulated=True)
+    S.im_size = im_size
+    S.oversample = oversample
+    S.set_up_tasks()
+    S._data[:] = np.random.rand(S._data.shape[0])
+
+    class reader():
+        # Stands in for the DAQ so only the integration is timed
+        def read_many_sample(self, data, number_of_samples_per_channel):
+            return number_of_samples_per_channel
+    S._reader = reader()
+
+    def acquire():
+        first_sample, frame, lease = S._acquire_frame()
+        lease.release()
+    benchmark(acquire)
+    S.close_tasks()
+
+
+@pytest.mark.benchmark(group='reconstruction engine')
+@pytest.mark.parametrize('mode', ['direct', 'bidirectional+phase', 'binning 2', '4 channels', 'line revisits'])
+@pytest.mark.parametrize('im_size', [256, 1024])
+def bench_reconstruction_engine(benchmark, im_size, mode):
+    from scanPatterns import rasterPattern, linePattern
+    from reconstructionEngine import reconstructionEngine
+    channels = 4 if mode == '4 channels' else 1
+    kwargs = {'use_numba': False}
+    if mode == 'line revisits':
+        # A closed path revisits its first point, so samples must be gathered first
+        P = linePattern(path=[(-1, -1), (1, -1), (1, 1), (-1, -1)], points_per_line=im_size, num_lines=im_size)
+    else:
+        P = rasterPattern(rows=im_size, cols=im_size, flyback_samples=16, bidirectional=mode.startswith('bi'))
+    if mode.startswith('bi'):
+        kwargs['phase'] = 3
+    if mode == 'binning 2':
+        kwargs['binning'] = 2
+    E = reconstructionEngine.from_plan(P.compile(), **kwargs)
+    data = np.random.rand(channels, P.num_samples).squeeze()
+    out = np.empty(((channels,) if channels > 1 else ()) + E.frame_shape)
+    benchmark(E.assemble, data, out)
+
+
+@pytest.mark.benchmark(group='reconstruction engine: numba')
+@pytest.mark.parametrize('im_size', [256, 1024])
+def bench_reconstruction_engine_numba(benchmark, im_size):
+    pytest.importorskip('numba')
+    from scanPatterns import rasterPattern
+    from reconstructionEngine import reconstructionEngine
+    P = rasterPattern(rows=im_size, cols=im_size, flyback_samples=16).compile()
+    E = reconstructionEngine.from_plan(P, oversample=4, use_numba=True)
+    data = np.random.rand(E.num_samples)
+    out = np.empty(E.frame_shape)
+    E.assemble(data, out)   # Compile outside the timing
+    benchmark(E.assemble, data, out)
+
+
+@pytest.mark.benchmark(group='frame buffers')
+@pytest.mark.parametrize('source', ['pool', 'allocate'])
+@pytest.mark.parametrize('im_size', [512, 1024])
+def bench_frame_buffer(benchmark, im_size, source):
+    # Leasing a pooled frame and writing it, against allocating a new frame each time
+    from framePool import framePool
+    P = framePool((im_size, im_size), np.float64, num_buffers=4)
+
+    if source == 'pool':
+        def frame():
+            lease = P.lease()
+            lease.array.fill(1)
+            lease.retain().release()   # A downstream stage
+            lease.release()
+    else:
+        def frame():
+            np.empty((im_size, im_size)).fill(1)
+    benchmark(frame)
+
+
+@pytest.mark.benchmark(group='feedback reconstruction')
+@pytest.mark.parametrize('position_source', ['command', 'feedback'])
+@pytest.mark.parametrize('im_size', [256, 512])
+def bench_feedback_reconstruction(benchmark, fast_simulation, im_size, position_source):
+    # Binning samples into pixels by the measured mirror position with np.bincount, against
+    # the precomputed pixel map of the command signal
+    from feedbackScanner import feedbackScanner
+    S = feedbackScanner(autoconnect=False, simulated=True)
+    S.im_size = im_size
+    S.position_source = position_source
+    S.generateScanWaveforms()
+    data = np.vstack((np.random.rand(S._points_to_plot), S.waveforms + np.random.normal(0, 1E-3, S.waveforms.shape)))
+    out = np.empty(S._frame_shape(data))
+    benchmark(S._assemble_frame, data, out)
+
+
+@pytest.mark.benchmark(group='safety monitor check')
+@pytest.mark.parametrize('block_samples', [264, 2640, 26400])
+def bench_safety_check(benchmark, block_samples):
+    # The saturation and mean level checks of one block of raw samples
+    from safetyMonitor import safetyMonitor
+    M = safetyMonitor(max_mean_level=0.8)
+    block = np.random.rand(block_samples)*0.5
+    M.check(block, block_samples)
+    benchmark(M.check, block, block_samples)
+    assert not M.tripped
+
+
+@pytest.mark.benchmark(group='autofocus sharpness')
+@pytest.mark.parametrize('im_size', [32, 64, 128])
+@pytest.mark.parametrize('method', ['stack', 'per plane'])
+def bench_sharpness(benchmark, im_size, method):
+    # Both sharpness metrics of an 11 plane z-sweep, in one pass over the stack or plane by plane
+    from autoFocuser import sharpness
+    stack = np.random.rand(11, im_size, im_size).astype(np.float32)
+    if method == 'stack':
+        benchmark(sharpness, stack)
+    else:
+        benchmark(lambda: [sharpness(plane[np.newaxis]) for plane in stack])
@@ -0,0 +1,115 @@
+'''
+ Cost of pushing data to pyqtgraph
+'''
+
+import numpy as np
+import pytest
+
+IM_SIZES = [128, 256, 512, 1024, 2048]
+
+
+@pytest.mark.benchmark(group='ImageView.setImage')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_image_view_set_image(benchmark, qt_app, im_size):
+    import pyqtgraph as pg
+    view = pg.ImageView()
+    view.show()
+    im = np.random.rand(im_size, im_size)
+    view.setImage(im)
+
+    def update():
+        view.setImage(im, autoLevels=False, autoHistogramRange=False)
+        qt_app.processEvents()
+
+    benchmark(update)
+    view.close()
+
+
+@pytest.mark.benchmark(group='displayPipeline.convert')
+@pytest.mark.parametrize('dtype', ['float64', 'uint16'])
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_display_convert(benchmark, im_size, dtype):
+    # Conversion to uint8 with percentile levels, as done by the display worker thread
+    from displayPipeline import displayPipeline
+    D = displayPipeline()
+    im = (np.random.rand(im_size, im_size)*4000).astype(dtype)
+    out = np.empty(im.shape, dtype=np.uint8)
+    benchmark(D.convert, im, out)
+    D.close()
+
+
+@pytest.mark.benchmark(group='ImageItem.setImage uint8')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_image_item_set_image(benchmark, qt_app, im_size):
+    # The GUI thread's share of a display update with displayPipeline: 60 fps needs < 16 ms
+    from imageWindow import image_item_window
+    _, win, item = image_item_window()
+    im = (np.random.rand(im_size, im_size)*255).astype(np.uint8)
+
+    def update():
+        item.setImage(im, autoLevels=False, levels=(0, 255))
+        qt_app.processEvents()
+
+    benchmark(update)
+    win.close()
+
+
+@pytest.mark.benchmark(group='PlotDataItem.setData')
+@pytest.mark.parametrize('num_points', [256, 2560, 25600, 256000])
+def bench_plot_set_data(benchmark, qt_app, num_points):
+    import pyqtgraph as pg
+    win = pg.GraphicsLayoutWidget(show=True)
+    curve = win.addPlot().plot(pen='w')
+    data = np.random.rand(num_points)
+
+    def update():
+        curve.setData(data)
+        qt_app.processEvents()
+
+    benchmark(update)
+    win.close()
+
+
+@pytest.mark.benchmark(group='imagePyramid: update a tile and view all')
+@pytest.mark.parametrize('im_size', [2048, 4096, 8192])
+def bench_pyramid_tile_update(benchmark, im_size):
+    # Pasting one 512 by 512 tile into a large mosaic, then fetching the whole mosaic at
+    # the level drawn in an 800 pixel window: only the tiles above the paste are recomputed
+    from imagePyramid import imagePyramid
+    mosaic = np.random.rand(im_size, im_size).astype(np.float32)
+    P = imagePyramid(mosaic)
+    level = P.choose_level(im_size/800)
+    P.region(level)
+    tile = np.random.rand(512, 512).astype(np.float32)
+
+    def paste_and_view():
+        mosaic[1024:1536, 1024:1536] = tile
+        P.update((1024, 1536, 1024, 1536))
+        return P.region(level)
+
+    benchmark(paste_and_view)
+
+
+@pytest.mark.benchmark(group='pyramidViewer new frame')
+@pytest.mark.parametrize('zoom', ['all', '1:1'])
+@pytest.mark.parametrize('im_size', [1024, 2048, 4096])
+def bench_pyramid_viewer(benchmark, qt_app, im_size, zoom):
+    # A new frame drawn zoomed out to fit the window, or at one image pixel per screen
+    # pixel. Compare with ImageView.setImage, which draws every pixel whatever the zoom.
+    from imagePyramid import pyramidViewer
+    V = pyramidViewer(size=800)
+    frames = [np.random.rand(im_size, im_size) for ii in range(2)]
+    V.set_image(frames[0])
+    if zoom == '1:1':
+        V._view.setRange(xRange=(0, 700), yRange=(0, 700), padding=0)
+    qt_app.processEvents()
+    count = [0]
+
+    def update():
+        count[0] += 1
+        V.set_image(frames[count[0] % 2])
+        V.refresh()
+        qt_app.processEvents()
+
+    benchmark(update)
+    V.close()
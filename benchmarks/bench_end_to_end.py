@@ -0,0 +1,189 @@
+'''
+ End-to-end frame rate of basicScanner running against the simulated DAQ as fast as it
+ can produce samples. The frames per second achieved are stored in the benchmark's extra_info.
+'''
+
+import time
+import pytest
+
+FRAMES_PER_ROUND = 5
+
+
+def acquire_frames(benchmark, per_second, qt_app, S, frames=FRAMES_PER_ROUND):
+    # Time rounds of acquiring frames frames from a running scanner and store the frame rate
+    def acquire():
+        S.wait_for_frames(frames)
+        qt_app.processEvents()
+    benchmark.pedantic(acquire, rounds=5, warmup_rounds=1)
+    per_second('frames_per_second', frames)
+
+
+@pytest.mark.benchmark(group='basicScanner end-to-end')
+@pytest.mark.parametrize('im_size', [128, 256, 512])
+def bench_basic_scanner_frame_rate(benchmark, per_second, qt_app, make_scanner, fast_simulation, im_size):
+    from basicScanner import basicScanner
+    B = make_scanner(basicScanner, im_size=im_size)
+    B.start_acquisition()
+    acquire_frames(benchmark, per_second, qt_app, B)
+
+
+@pytest.mark.benchmark(group='photonCountingScanner end-to-end')
+@pytest.mark.parametrize('im_size', [128, 256, 512])
+def bench_photon_counting_frame_rate(benchmark, per_second, qt_app, make_scanner, fast_simulation, im_size):
+    from photonCountingScanner import photonCountingScanner
+    P = make_scanner(photonCountingScanner, im_size=im_size)
+    P.start_acquisition()
+    acquire_frames(benchmark, per_second, qt_app, P)
+
+
+@pytest.mark.benchmark(group='multiDeviceScanner end-to-end')
+@pytest.mark.parametrize('num_devices', [1, 2, 3])
+def bench_multi_device_frame_rate(benchmark, per_second, qt_app, make_scanner, fast_simulation, num_devices):
+    from multiDeviceScanner import multiDeviceScanner
+    M = make_scanner(multiDeviceScanner, input_devices=[('Dev%d' % (ii+1), 'ai0:1') for ii in range(num_devices)])
+    M.start_acquisition()
+    acquire_frames(benchmark, per_second, qt_app, M)
+
+
+@pytest.mark.benchmark(group='raw replay throughput')
+@pytest.mark.parametrize('im_size', [128, 256, 512])
+def bench_raw_replay_throughput(benchmark, per_second, qt_app, make_scanner, fast_simulation, tmp_path, im_size):
+    # Maximum frame rate of the processing pipeline, fed from a raw recording
+    from basicScanner import basicScanner
+    from rawRecording import rawReplay
+
+    B = make_scanner(basicScanner, im_size=im_size)
+    B.start_acquisition()
+    B.start_raw_recording(str(tmp_path / 'raw'))
+    B.wait_for_frames(FRAMES_PER_ROUND)
+    B.stop_raw_recording()
+
+    R = rawReplay(str(tmp_path / 'raw'))
+    R.configure(B)
+
+    def replay():
+        R.replay(realtime=False)
+        qt_app.processEvents()
+    benchmark.pedantic(replay, rounds=5, warmup_rounds=1)
+
+    per_second('frames_per_second', R.num_blocks)
+    per_second('samples_per_second', R.num_blocks * B.scan_plan.samples_per_frame)
+
+
+@pytest.mark.benchmark(group='basicScanner start/stop')
+@pytest.mark.parametrize('commit_tasks', [True, False])
+def bench_start_stop_latency(benchmark, make_scanner, fast_simulation, commit_tasks):
+    # Committed tasks re-start without reserving resources again. See update_tasks.
+    from basicScanner import basicScanner
+    B = make_scanner(basicScanner, commit_tasks=commit_tasks)
+    latencies = []
+
+    def start_stop():
+        B.start_acquisition()
+        latencies.append(B.start_latency)
+        B.stop_acquisition()
+    benchmark.pedantic(start_stop, rounds=10, warmup_rounds=1)
+
+    benchmark.extra_info['start_latency'] = sum(latencies) / len(latencies)
+
+
+@pytest.mark.benchmark(group='basicScanner start/stop')
+@pytest.mark.parametrize('change', ['rewrite', 'reconfigure', 'recreate'])
+def bench_update_tasks(benchmark, make_scanner, fast_simulation, change):
+    from basicScanner import basicScanner
+    B = make_scanner(basicScanner)
+    settings = {'rewrite': [('scan_amplitude', 0.5), ('scan_amplitude', 0.6)],
+                'reconfigure': [('im_size', 128), ('im_size', 256)],
+                'recreate': [('export_clocks', True), ('export_clocks', False)]}[change]
+    actions = []
+
+    def update():
+        for name, value in settings:
+            setattr(B, name, value)
+            actions.append(B.update_tasks())
+    benchmark.pedantic(update, rounds=5, warmup_rounds=1)
+
+    assert set(actions) == {change}
+
+
+@pytest.mark.benchmark(group='triggeredScanner trials')
+@pytest.mark.parametrize('frames_per_trial', [1, 10])
+def bench_triggered_trial(benchmark, per_second, qt_app, make_scanner, fast_simulation, frames_per_trial):
+    # Time from a trigger to the trial's block being handed over, including re-arming
+    import simulatedDAQ
+    from triggeredScanner import triggeredScanner
+    T = make_scanner(triggeredScanner, im_size=128, frames_per_trial=frames_per_trial)
+    T.start_acquisition()
+
+    def trial():
+        assert simulatedDAQ.send_trigger('PFI0') > 0
+        T.wait_for_trials(1)
+        qt_app.processEvents()
+    benchmark.pedantic(trial, rounds=5, warmup_rounds=1)
+    per_second('frames_per_second', frames_per_trial)
+
+
+@pytest.mark.benchmark(group='basicScanner safety monitor')
+@pytest.mark.parametrize('monitor', ['off', 'on'])
+def bench_safety_monitor_frame_rate(benchmark, per_second, qt_app, make_scanner, fast_simulation, monitor):
+    # Frames read in blocks of a few ms and checked, against whole frames
+    from basicScanner import basicScanner
+    B = make_scanner(basicScanner)
+    if monitor == 'on':
+        B.enable_safety_monitor()
+    B.start_acquisition()
+    acquire_frames(benchmark, per_second, qt_app, B)
+    if monitor == 'on':
+        assert not B.safety_monitor.tripped
+
+
+@pytest.mark.benchmark(group='basicScanner safety monitor')
+def bench_safety_reaction(benchmark, make_scanner):
+    # In real time: the detector is flooded with light and acquisition is stopped. The
+    # time from the offending block being acquired to the stop is stored in extra_info.
+    import simulatedDAQ
+    from basicScanner import basicScanner
+
+    simulatedDAQ.sample.image  # Built on first use, which would delay the first samples
+    B = make_scanner(basicScanner)
+    B.enable_safety_monitor(reaction_time=0.02)
+    reactions = []
+    try:
+        def flood():
+            B.safety_monitor.reset()
+            simulatedDAQ.sample.background = 0
+            B.start_acquisition()
+            simulatedDAQ.sample.background = 2
+            while B._acquiring:
+                time.sleep(0.001)
+            reactions.append(B.safety_monitor.trip['reaction_latency'])
+        benchmark.pedantic(flood, rounds=5, warmup_rounds=1)
+    finally:
+        simulatedDAQ.sample.background = 0
+
+    benchmark.extra_info['reaction_ms'] = 1E3*max(reactions)
+
+
+@pytest.mark.benchmark(group='basicScanner autofocus')
+def bench_autofocus(benchmark, make_scanner):
+    # In real time: an 11 plane sweep with the simulated z stage, from 256 by 256 frames and back
+    import simulatedDAQ
+    import stages
+    from basicScanner import basicScanner
+
+    simulatedDAQ.sample.image  # Built on first use, which would delay the first samples
+    simulatedDAQ.sample.focal_plane = 3.3
+    B = make_scanner(basicScanner)
+    Z = stages.simulatedZStage()
+    errors = []
+    try:
+        def focus():
+            Z.move_to(0)
+            errors.append(B.autofocus(Z) - simulatedDAQ.sample.focal_plane)
+        benchmark.pedantic(focus, rounds=3, warmup_rounds=1)
+    finally:
+        simulatedDAQ.sample.focal_plane = 0
+        simulatedDAQ.sample.z = 0
+
+    benchmark.extra_info['max_error_um'] = max(abs(e) for e in errors)
+    assert max(abs(e) for e in errors) < simulatedDAQ.sample.depth_of_field
@@ -0,0 +1,61 @@
+'''
+ Cost and accuracy of online motion correction
+'''
+
+import numpy as np
+import pytest
+
+IM_SIZES = [128, 256, 512]
+
+
+def _texture(size, seed=0):
+    # A positive random texture with detail down to a few pixels, like a stained sample
+    rng = np.random.default_rng(seed)
+    k = np.hypot(*np.meshgrid(np.fft.fftfreq(size), np.fft.fftfreq(size)))
+    image = np.fft.ifft2(np.fft.fft2(rng.random((size, size)))*np.exp(-(k/0.15)**2)).real
+    return image - image.min()
+
+
+def _shifted(image, dy, dx):
+    # image moved down by dy and right by dx pixels with a Fourier shift
+    ky = 2*np.pi*np.fft.fftfreq(image.shape[0]).reshape(-1, 1)
+    kx = 2*np.pi*np.fft.fftfreq(image.shape[1]).reshape(1, -1)
+    return np.fft.ifft2(np.fft.fft2(image)*np.exp(-1j*(ky*dy + kx*dx))).real
+
+
+@pytest.mark.benchmark(group='motion correction')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_correct(benchmark, im_size):
+    # One frame registered to the running reference and shifted back
+    from motionCorrector import motionCorrector
+    M = motionCorrector()
+    reference = _texture(im_size).astype(np.float32)
+    frame = _shifted(reference, 1.3, -2.6).astype(np.float32)
+    M.correct(reference)
+    benchmark(M.correct, frame)
+
+
+@pytest.mark.benchmark(group='motion correction: sub-pixel accuracy')
+@pytest.mark.parametrize('upsample_factor', [1, 20])
+def bench_subpixel_accuracy(benchmark, upsample_factor):
+    # Recovery of known fractional shifts. upsample_factor=1 is the whole-pixel peak alone.
+    from motionCorrector import motionCorrector
+    rng = np.random.default_rng(1)
+    reference = _texture(256)
+    shifts = rng.uniform(-5, 5, (20, 2))
+    frames = [_shifted(reference, dy, dx) + 0.01*rng.standard_normal(reference.shape) for dy, dx in shifts]
+
+    def register():
+        measured = []
+        for frame in frames:
+            M = motionCorrector()
+            M.upsample_factor = upsample_factor
+            M.correct(reference)
+            M.correct(frame)
+            measured.append(M.shifts[1, 1:3])
+        return np.abs(np.array(measured) - shifts)
+
+    errors = benchmark.pedantic(register, rounds=1, iterations=1)
+    benchmark.extra_info.update(mean_error_px=float(errors.mean()), max_error_px=float(errors.max()))
+    if upsample_factor > 1:
+        assert errors.max() < 1.5/upsample_factor + 0.05
@@ -0,0 +1,45 @@
+'''
+ Throughput of compressed frame recording (see src/frameRecording.py). The compression
+ ratio, MB/s and frames per second achieved are stored in the benchmark's extra_info.
+ Codecs that are not installed are skipped.
+'''
+
+import numpy as np
+import pytest
+
+FRAMES = 64
+
+
+def specimen_frames(im_size):
+    # Simulated specimen frames with detector noise, as int16 would store them
+    import simulatedDAQ
+    x, y = np.meshgrid(np.linspace(-1, 1, im_size), np.linspace(-1, 1, im_size))
+    image = simulatedDAQ.sample.signal(x, y, 0)
+    rng = np.random.default_rng(0)
+    return [image + rng.normal(0, 0.01, image.shape) for ii in range(8)]
+
+
+@pytest.mark.benchmark(group='frame recording')
+@pytest.mark.parametrize('workers', [1, 4])
+@pytest.mark.parametrize('codec', ['zstd', 'blosc', 'lz4', 'zlib'])
+def bench_compressed_recording(benchmark, per_second, tmp_path, codec, workers):
+    import frameRecording
+    try:
+        frameRecording._load_codec(codec)
+    except ImportError:
+        pytest.skip('%s is not installed' % codec)
+
+    frames = specimen_frames(512)
+    results = []
+
+    def record():
+        W = frameRecording.frameRecorder(str(tmp_path / 'frames'), scale=32767, codec=codec, workers=workers)
+        for ii in range(FRAMES):
+            W.write(frames[ii % len(frames)], ii)
+        results.append(W.close())
+    benchmark.pedantic(record, rounds=3, warmup_rounds=1)
+
+    stats = results[-1]
+    benchmark.extra_info['ratio'] = stats['ratio']
+    benchmark.extra_info['mb_per_second'] = stats['mb_per_second']
+    per_second('frames_per_second', FRAMES)
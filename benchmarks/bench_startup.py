@@ -0,0 +1,54 @@
+'''
+ Cold-start import cost of the scanner modules
+
+ Each module is imported in a fresh interpreter with "python -X importtime". The
+ cumulative import time is recorded and checked against a budget, and we check that
+ importing the module does not drag in NI-DAQmx or Qt. Those are imported only when
+ tasks or windows are actually created.
+'''
+
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Cumulative import time budget in ms. Most of this is numpy.
+IMPORT_BUDGET_MS = 250
+
+HEAVY_MODULES = ('nidaqmx', 'pyqtgraph', 'PyQt5', 'PyQt6', 'PySide2', 'PySide6')
+
+MODULES = ['basicScanner', 'waveformTester', 'scanPatterns', 'galvoLimiter', 'motionCorrector',
+           'tiledScanner', 'acquisitionServer', 'frameServer', 'simulatedDAQ', 'scanPlan',
+           'displayPipeline', 'photonCountingScanner', 'oversampledScanner', 'multiDeviceScanner',
+           'rawRecording', 'reconstructionEngine', 'triggeredScanner', 'frameRecording',
+           'framePool', 'feedbackScanner', 'imagePyramid', 'pipelineTrace',
+           'aoScaling', 'safetyMonitor', 'autoFocuser', 'stages']
+
+
+def import_time_ms(module):
+    # Cumulative import time of module, in ms, measured in a fresh interpreter
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            cwd=SRC, capture_output=True, text=True, check=True)
+    match = re.search(r'import time:\s+\d+ \|\s+(\d+) \| %s\s*$' % module, result.stderr, re.MULTILINE)
+    return int(match.group(1))/1000
+
+
+@pytest.mark.benchmark(group='cold start import')
+@pytest.mark.parametrize('module', MODULES)
+def bench_cold_start(benchmark, module):
+    times = []
+    benchmark.pedantic(lambda: times.append(import_time_ms(module)), rounds=3, iterations=1)
+    best = min(times)
+    benchmark.extra_info['import_time_ms'] = best
+    assert best < IMPORT_BUDGET_MS, '%s took %0.1f ms to import (budget %d ms)' % (module, best, IMPORT_BUDGET_MS)
+
+
+@pytest.mark.parametrize('module', MODULES)
+def bench_no_heavy_imports(module):
+    code = 'import sys, %s; print(",".join(m for m in %r if m in sys.modules))' % (module, HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], cwd=SRC, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '', 'Importing %s also imported %s' % (module, result.stdout.strip())
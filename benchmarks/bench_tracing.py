@@ -0,0 +1,56 @@
+'''
+ Cost of tracing the pipeline, with tracing off (the NULL_TRACER) and on
+'''
+
+import pytest
+
+SPANS_PER_ROUND = 1000
+
+
+@pytest.mark.benchmark(group='pipelineTrace span')
+@pytest.mark.parametrize('tracing', ['off', 'on'])
+def bench_trace_span(benchmark, tracing):
+    # An empty instrumented stage, SPANS_PER_ROUND times. Off should cost well under a microsecond each.
+    import pipelineTrace
+    tracer = pipelineTrace.pipelineTracer() if tracing == 'on' else pipelineTrace.NULL_TRACER
+
+    def spans():
+        for ii in range(SPANS_PER_ROUND):
+            with tracer.span('stage'):
+                pass
+
+    benchmark(spans)
+    if benchmark.stats is not None:    # None with --benchmark-disable
+        benchmark.extra_info['ns_per_span'] = benchmark.stats.stats.mean/SPANS_PER_ROUND*1E9
+
+
+@pytest.mark.benchmark(group='pipelineTrace export')
+def bench_trace_export(benchmark, tmp_path):
+    # Writing a full ring buffer of 65536 events as Chrome trace JSON
+    import pipelineTrace
+    tracer = pipelineTrace.pipelineTracer(capacity=65536)
+    for ii in range(65536):
+        with tracer.span('stage'):
+            pass
+    benchmark.pedantic(tracer.save, args=(str(tmp_path / 'trace.json'),), rounds=3, iterations=1)
+
+
+@pytest.mark.benchmark(group='acquire frame with tracing')
+@pytest.mark.parametrize('tracing', ['off', 'on'])
+def bench_acquire_frame_traced(benchmark, fast_simulation, tracing):
+    # Reading and assembling a 256 by 256 frame from a block already in memory, so the
+    # tracing overhead is not hidden by the simulated DAQ
+    import numpy as np
+    from basicScanner import basicScanner
+    B = basicScanner(autoconnect=False, simulated=True)
+    B.generateScanWaveforms()
+    data = np.random.rand(B._points_to_plot)
+    B._read_raw_block = lambda: (0, data)
+    if tracing == 'on':
+        B.enable_tracing()
+
+    def acquire():
+        first_sample, frame, lease = B._acquire_frame()
+        lease.release()
+
+    benchmark(acquire)
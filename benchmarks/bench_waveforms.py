@@ -0,0 +1,76 @@
+'''
+ Cost of generating scan waveforms at different image sizes
+'''
+
+import numpy as np
+import pytest
+
+IM_SIZES = [128, 256, 512, 1024]
+
+
+@pytest.mark.benchmark(group='basicScanner.generateScanWaveforms')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_generate_scan_waveforms(benchmark, no_plan_cache, im_size):
+    from basicScanner import basicScanner
+    B = basicScanner(autoconnect=False)
+    B.im_size = im_size
+    benchmark(B.generateScanWaveforms)
+
+
+@pytest.mark.benchmark(group='scanPlan.load')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_load_cached_plan(benchmark, plan_cache, im_size):
+    # Start-up cost of a mode whose plan is already in the disk cache
+    from galvoLimiter import galvoLimiter
+    from scanPatterns import rasterPattern
+    L = galvoLimiter()
+    parameters = plan_cache.plan_parameters(rasterPattern(rows=im_size, cols=im_size).spec(), 1, 96E3, L)
+    plan_cache.get_plan(parameters, L)
+
+    def load():
+        plan_cache._plans.clear()
+        return plan_cache.get_plan(parameters, L)
+    benchmark(load)
+
+
+@pytest.mark.benchmark(group='waveformTester.generate_scan_waveform')
+@pytest.mark.parametrize('waveform_type', ['sine', 'sawtooth'])
+@pytest.mark.parametrize('pixels_per_line', [64, 256, 1024])
+def bench_generate_scan_waveform(benchmark, waveform_type, pixels_per_line):
+    from waveformTester import waveformTester
+    W = waveformTester(autoconnect=False)
+    W.waveform_type = waveform_type
+    W.pixels_per_line = pixels_per_line
+    benchmark(W.generate_scan_waveform)
+
+
+@pytest.mark.benchmark(group='galvoLimiter.check')
+@pytest.mark.parametrize('im_size', IM_SIZES)
+def bench_galvo_limit_check(benchmark, im_size):
+    from galvoLimiter import galvoLimiter
+    from scanPatterns import rasterPattern
+    P = rasterPattern(rows=im_size, cols=im_size).compile()
+    L = galvoLimiter()
+    benchmark(L.check, P.waveforms, 96E3, False)
+
+
+@pytest.mark.benchmark(group='AO waveforms to int16 codes')
+@pytest.mark.parametrize('cached', [False, True])
+@pytest.mark.parametrize('im_size', [256, 512, 1024])
+def bench_waveform_codes(benchmark, plan_cache, im_size, cached):
+    # Converting a plan's waveforms to DAC codes, and fetching them once cached with the plan.
+    # The codes take a quarter of the memory of the float64 waveforms.
+    import aoScaling
+    import scanPlan
+    from galvoLimiter import galvoLimiter
+    from scanPatterns import rasterPattern
+    limiter = galvoLimiter()
+    plan = scanPlan.get_plan(scanPlan.plan_parameters(rasterPattern(rows=im_size, cols=im_size).spec(), 1, 96E3, limiter), limiter)
+    scaling = ((0.0, 3276.7), (0.0, 3276.7))
+    if cached:
+        benchmark(plan.codes, scaling)
+    else:
+        out = np.empty(plan.waveforms.shape, dtype=np.int16)
+        benchmark(aoScaling.volts_to_codes, plan.waveforms, scaling, out)
+    benchmark.extra_info['float64_mb'] = plan.waveforms.nbytes/1E6
+    benchmark.extra_info['int16_mb'] = plan.codes(scaling).nbytes/1E6
@@ -0,0 +1,85 @@
+'''
+ Shared set-up for the benchmark suite
+
+ The suite runs headless: Qt uses its offscreen platform and the DAQ is simulated
+ (see src/simulatedDAQ.py) so no hardware, drivers or display are needed.
+'''
+
+import os
+import sys
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pytest
+
+
+@pytest.fixture
+def fast_simulation():
+    # Produce simulated samples as fast as possible rather than in real time
+    import simulatedDAQ
+    simulatedDAQ.realtime = False
+    yield simulatedDAQ
+    simulatedDAQ.realtime = True
+
+
+@pytest.fixture(scope='session', autouse=True)
+def plan_cache(tmp_path_factory):
+    # Keep compiled scan plans out of the user's cache directory
+    import scanPlan
+    scanPlan.cache_dir = str(tmp_path_factory.mktemp('plans'))
+    return scanPlan
+
+
+@pytest.fixture
+def no_plan_cache(plan_cache):
+    # Compile scan plans every time, to measure the cost of compilation itself
+    plan_cache.use_cache = False
+    yield plan_cache
+    plan_cache.use_cache = True
+
+
+@pytest.fixture(scope='session')
+def qt_app():
+    pg = pytest.importorskip('pyqtgraph')
+    return pg.mkQApp()
+
+
+def pytest_configure(config):
+    # Saved results go to .results next to pytest.ini, wherever pytest is run from, unless
+    # --benchmark-storage is given. Runs before pytest-benchmark reads the option.
+    if not any(arg.startswith('--benchmark-storage') for arg in config.invocation_params.args):
+        config.option.benchmark_storage = 'file://' + str(config.rootpath / '.results')
+
+
+@pytest.fixture
+def per_second(benchmark):
+    # per_second(name, count) stores count divided by the mean time of a round in the
+    # benchmark's extra_info. With --benchmark-disable there are no timings, so it does nothing.
+    def record(name, count):
+        if benchmark.stats is not None:
+            benchmark.extra_info[name] = count / benchmark.stats.stats.mean
+    return record
+
+
+@pytest.fixture
+def make_scanner(qt_app):
+    # make_scanner(cls, **settings) creates a scanner of class cls on the simulated DAQ, with
+    # the settings applied, its tasks set up and a plot. Every scanner made is stopped and
+    # closed, and its window closed, after the test.
+    made = []
+
+    def make(cls, **settings):
+        S = cls(autoconnect=False, simulated=True)
+        for name, value in settings.items():
+            setattr(S, name, value)
+        S.set_up_tasks()
+        S.setup_plot()
+        made.append(S)
+        return S
+
+    yield make
+    for S in made:
+        S.stop_acquisition()
+        S.close_tasks()
+        S._win.close()
@@ -0,0 +1,87 @@
+'''
+ Headless acquisition that streams frames over the network
+
+ acquisitionServer
+
+
+ Description:
+  Runs basicScanner with no GUI: Qt is never imported. Instead of being displayed,
+  every frame is published by a frameServer (see frameServer.py) so that it can be
+  viewed or analysed on another machine, for example with frameViewer.py. Run this on
+  the DAQ PC.
+
+
+  Usage:
+  From the command line on the DAQ PC:
+  python acquisitionServer.py 5555
+
+  Then on the viewing PC:
+  python frameViewer.py daq-pc.lab 5555
+
+  From Python:
+  import acquisitionServer
+  A = acquisitionServer.acquisitionServer(port=5555)
+  A.start_acquisition()
+  A.stop_acquisition()
+  A.close()
+
+'''
+
+import sys
+from basicScanner import basicScanner
+from frameServer import frameServer
+
+class acquisitionServer(basicScanner):
+
+    port = 5555           # TCP port on which frames are served
+    frame_server = []     # The frameServer publishing the frames
+
+
+    def __init__(self, autoconnect=True, port=None, simulated=None):
+        if port is not None:
+            self.port = port
+        super().__init__(autoconnect=autoconnect, simulated=simulated)
+    #close constructor
+
+
+    def setup_plot(self):
+        # There is no plot: frames go to the network instead
+        self.frame_server = frameServer(port=self.port)
+        self._attach_tracer()
+    #close setup_plot
+
+
+    def _read_and_display_last_frame(self, tTask, event_type, num_samples, callback_data):
+        with self.tracer.span('frame'):
+            _im = self._read_last_frame()
+            if _im is not None:
+                self.frame_server.publish(_im, lease=self._frame_lease.retain())
+        return 0
+    #close _read_and_display_last_frame
+
+
+    def _attach_tracer(self):
+        super()._attach_tracer()
+        if isinstance(self.frame_server, frameServer):
+            self.frame_server.tracer = self.tracer
+    #close _attach_tracer
+
+
+    def close(self):
+        self.stop_acquisition()
+        self.close_tasks()
+        if isinstance(self.frame_server, frameServer):
+            self.frame_server.close()
+    #close close
+
+#close class acquisitionServer
+
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5555
+    print('\nRunning headless acquisition server on port %d\n\n' % port)
+    SERVER = acquisitionServer(port=port)
+    SERVER.start_acquisition()
+    input('press return to stop')
+    SERVER.close()
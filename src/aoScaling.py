@@ -0,0 +1,94 @@
+'''
+ Conversion of AO waveforms to the device's native int16 DAC codes
+
+ aoScaling
+
+
+ Description:
+  Writing a float64 waveform with task.write makes the driver scale every sample to the
+  DAC's 16 bit codes each time it is written, and the float64 buffer is four times the size
+  of the codes. Instead the waveforms can be converted once, using the device's own AO
+  calibration, and written through nidaqmx's AnalogUnscaledWriter as int16.
+
+  Each AO channel reports the polynomial that converts volts to codes in its
+  ao_dev_scaling_coeff property, lowest order coefficient first: code = c0 + c1*V + ...
+  This includes the board's calibration, so the codes produce the same voltages as the
+  driver's own scaling would. Codes are rounded to the nearest integer. Voltages outside
+  the range of the DAC raise a ValueError rather than being clipped.
+
+  scanPlan caches the codes of each plan for each scaling (see scanPlan.codes), so
+  switching between plans rewrites the AO buffer without converting anything.
+
+
+  Usage:
+  import aoScaling
+  scaling = aoScaling.device_scaling(task)        # One tuple of coefficients per channel
+  codes = aoScaling.volts_to_codes(waveforms, scaling)
+  writer = nidaqmx.stream_writers.AnalogUnscaledWriter(task.out_stream)
+  writer.write_int16(codes)
+
+  basicScanner and waveformTester write this way unless unscaled_output is False.
+
+'''
+
+import numpy as np
+
+_INT16 = np.iinfo(np.int16)
+
+
+def device_scaling(task):
+    '''
+    The volts to codes polynomial of each AO channel of task, as a tuple of tuples
+    '''
+    return tuple(tuple(float(c) for c in task.ao_channels[ii].ao_dev_scaling_coeff)
+                 for ii in range(len(task.ao_channels)))
+#close device_scaling
+
+
+def volts_to_codes(waveforms, scaling, out=None):
+    '''
+    Convert a channels by samples array of volts (or one channel, 1D) to int16 codes,
+    written into out if given. Returns the codes.
+    '''
+    waveforms = np.asarray(waveforms, dtype=np.float64)
+    single = waveforms.ndim == 1
+    volts = waveforms.reshape(1, -1) if single else waveforms
+    if volts.shape[0] != len(scaling):
+        raise ValueError('%d channels of waveforms but %d channels of scaling' % (volts.shape[0], len(scaling)))
+    if out is None:
+        out = np.empty(waveforms.shape, dtype=np.int16)
+    codes = out.reshape(1, -1) if single else out
+
+    scratch = np.empty(volts.shape[1])  # One channel at a time, so never a float copy of them all
+    for v, coefficients, code in zip(volts, scaling, codes):
+        # Horner's method
+        scratch[...] = coefficients[-1]
+        for c in coefficients[-2::-1]:
+            scratch *= v
+            scratch += c
+        np.rint(scratch, out=scratch)
+        if scratch.min() < _INT16.min or scratch.max() > _INT16.max:
+            raise ValueError('Waveform of %0.3f to %0.3f V is beyond the range of the AO DAC' % (v.min(), v.max()))
+        np.copyto(code, scratch, casting='unsafe')
+    return out
+#close volts_to_codes
+
+
+def codes_to_volts(codes, scaling):
+    '''
+    The voltages that int16 codes produce: the inverse of volts_to_codes. The polynomial
+    is inverted with Newton's method, starting from its linear part.
+    '''
+    codes = np.asarray(codes, dtype=np.float64)
+    single = codes.ndim == 1
+    codes = codes.reshape(1, -1) if single else codes
+    volts = np.empty(codes.shape)
+    for code, coefficients, v in zip(codes, scaling, volts):
+        c = np.asarray(coefficients, dtype=np.float64)
+        v[...] = (code - c[0])/c[1]
+        if c.shape[0] > 2:
+            slope = np.polynomial.polynomial.polyder(c)
+            for ii in range(4):
+                v -= (np.polynomial.polynomial.polyval(v, c) - code)/np.polynomial.polynomial.polyval(v, slope)
+    return volts[0] if single else volts
+#close codes_to_volts
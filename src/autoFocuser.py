@@ -0,0 +1,232 @@
+'''
+ Autofocus by a fast z-sweep and image sharpness
+
+ autoFocuser
+
+
+ Description:
+  Finding focus by eye is slow. An autoFocuser steps a z stage (see stages.py) through
+  num_planes planes spanning z_range microns either side of its current position, or as
+  much of that as is within the stage's travel (zStage.limits), and acquires one small
+  frame at each: im_size by im_size pixels of the centre of the field, field_fraction of
+  the scan amplitude across. Acquisition is stopped while the stage
+  moves and started again once it has settled, so every frame is from a single plane.
+
+  The planes are stacked and the sharpness of all of them is measured in one vectorised
+  pass over the stack:
+  - 'laplacian': the variance of the 4 neighbour Laplacian of each plane
+  - 'gradient':  the normalised gradient energy: the mean squared difference between
+                 neighbouring pixels divided by the squared mean of the plane, so that it
+                 does not change with brightness
+  A parabola is fitted to the metric chosen by metric over the fit_points planes around
+  the sharpest, and the stage is moved to its peak. If the sharpest plane is at either end
+  of the sweep focus may lie beyond it: the stage is moved to that plane and
+  peak_in_range is False. Run again from there, or with a larger z_range. If no plane
+  scores min_contrast times the median, focus is too far away to be seen: the stage
+  returns to where it started and run returns None.
+
+  The scanner's settings are restored afterwards, and acquisition re-started if it was
+  running. Frame and raw recording and motion correction are paused during the sweep.
+  Plans are cached (see scanPlan.py), so after the first run switching to the sweep's
+  small frames and back costs only the re-configuration of the tasks. With the default
+  settings at 96 kHz a frame takes 13 ms and a run against the simulated DAQ about 0.6 s,
+  most of it the stage settling and the tasks starting and stopping at each plane. The
+  time taken by each step is in timings.
+
+
+  Usage:
+  import basicScanner, stages
+  b = basicScanner.basicScanner()
+  z_stage = stages.aoZStage(dev_name='Dev2', channel='ao0')
+  b.autofocus(z_stage, z_range=30, num_planes=13)   # Returns the z in focus
+  b.autofocuser.scores                               # Sharpness of each plane, by metric
+
+  Without hardware:
+  b = basicScanner.basicScanner(simulated=True)
+  b.autofocus(stages.simulatedZStage())
+
+  The metrics can also be used on their own, on any planes by rows by columns stack:
+  import autoFocuser
+  autoFocuser.sharpness(stack)      # {'laplacian': ..., 'gradient': ...}
+
+'''
+
+import time
+import numpy as np
+
+
+def sharpness(stack):
+    '''
+    Both sharpness metrics of every plane of a planes by rows by columns stack, as a dict
+    of 1D arrays: 'laplacian' (variance of the Laplacian) and 'gradient' (normalised
+    gradient energy)
+    '''
+    s = np.asarray(stack)
+    if s.dtype.kind != 'f':
+        s = s.astype(np.float32)
+    if s.ndim != 3 or min(s.shape[1:]) < 3:
+        raise ValueError('Sharpness needs a planes by rows by columns stack of at least 3 by 3 pixels')
+    planes = s.shape[0]
+
+    # Sums over each plane are accumulated in float64, whatever the type of the stack
+    laplacian = s[:, :-2, 1:-1] + s[:, 2:, 1:-1]
+    laplacian += s[:, 1:-1, :-2]
+    laplacian += s[:, 1:-1, 2:]
+    laplacian -= 4*s[:, 1:-1, 1:-1]
+    n = laplacian[0].size
+    laplacian_mean = np.einsum('ijk->i', laplacian, dtype=np.float64)/n
+    laplacian_var = np.einsum('ijk,ijk->i', laplacian, laplacian, dtype=np.float64)/n - laplacian_mean**2
+
+    gx = np.diff(s, axis=2)
+    energy = np.einsum('ijk,ijk->i', gx, gx, dtype=np.float64)/gx[0].size
+    gy = np.diff(s, axis=1)
+    energy += np.einsum('ijk,ijk->i', gy, gy, dtype=np.float64)/gy[0].size
+    mean = np.einsum('ijk->i', s, dtype=np.float64)/s[0].size
+
+    return {'laplacian': np.maximum(laplacian_var, 0),
+            'gradient': energy/np.maximum(mean**2, np.finfo(np.float64).tiny)}
+#close sharpness
+
+
+def fit_peak(z, scores, fit_points=3):
+    '''
+    The z of the peak of a parabola fitted to the fit_points scores around the highest,
+    and whether that is inside the sweep. If the highest is at either end of the sweep, or
+    the fit does not have a maximum, the z of the highest score is returned.
+    '''
+    z = np.asarray(z, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    best = int(np.argmax(scores))
+    n = z.shape[0]
+    if best == 0 or best == n - 1:
+        return z[best], False
+
+    lo = max(best - fit_points//2, 0)
+    hi = min(lo + max(fit_points, 3), n)
+    lo = max(hi - max(fit_points, 3), 0)
+    # Centred and scaled for a well conditioned fit
+    dz = z[lo:hi] - z[best]
+    scale = np.abs(dz).max()
+    a, b, c = np.polyfit(dz/scale, scores[lo:hi]/(np.abs(scores[lo:hi]).max() or 1), 2)
+    if a >= 0:
+        return z[best], True
+    peak = z[best] - scale*b/(2*a)
+    return float(np.clip(peak, z[lo], z[hi-1])), True
+#close fit_peak
+
+
+
+class autoFocuser():
+
+    z_range = 20            # Microns swept either side of the current position
+    num_planes = 11         # Number of planes in the sweep
+    im_size = 32            # Frames of the sweep are im_size by im_size pixels
+    field_fraction = 0.5    # Fraction of the scan amplitude imaged: the centre of the field
+    metric = 'laplacian'    # Metric the focus is fitted to: 'laplacian' or 'gradient'
+    fit_points = 3          # Number of planes around the sharpest that the parabola is fitted to
+    min_contrast = 1.5      # Focus is found only if the sharpest plane scores this many times the median
+
+    scanner = None          # The basicScanner acquiring the frames
+    z_stage = None          # The zStage moving the focus
+
+    z = []                  # z of each plane of the sweep
+    stack = None            # Planes by rows by columns frames of the sweep
+    scores = {}             # Sharpness of each plane, by metric
+    best_z = None           # z the stage was moved to
+    peak_in_range = False   # False if the sharpest plane was at an end of the sweep
+    timings = {}            # Seconds taken by each step of the last run
+
+
+
+    def __init__(self, scanner, z_stage, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError('autoFocuser has no setting %s' % name)
+            setattr(self, name, value)
+        self.scanner = scanner
+        self.z_stage = z_stage
+    #close constructor
+
+
+    def run(self):
+        '''
+        Sweep, move the z stage to the sharpest plane and return its z
+        '''
+        S = self.scanner
+        if self.metric not in ('laplacian', 'gradient'):
+            raise ValueError("metric must be 'laplacian' or 'gradient'")
+        if not S._task_created():
+            return None
+
+        t0 = time.perf_counter()
+        z0 = self.z_stage.get_position()
+        low, high = self.z_stage.limits()
+        self.z = np.linspace(max(z0 - self.z_range, low), min(z0 + self.z_range, high), self.num_planes)
+        self.timings = {}
+
+        saved = {name: getattr(S, name) for name in
+                 ('im_size', 'scan_amplitude', 'scan_pattern', 'frame_recorder', 'raw_recorder', 'motion_corrector')}
+        was_acquiring = S._acquiring
+        self.stack = None
+        self.best_z = None
+        self.peak_in_range = False
+        try:
+            S.frame_recorder = S.raw_recorder = S.motion_corrector = None
+            S.scan_pattern = None
+            S.im_size = self.im_size
+            S.scan_amplitude = saved['scan_amplitude']*self.field_fraction
+            S.stop_acquisition()
+            S.update_tasks()
+            self.timings['configure'] = time.perf_counter() - t0
+
+            t = time.perf_counter()
+            self.stack = self._sweep()
+            self.timings['sweep'] = time.perf_counter() - t
+        finally:
+            t = time.perf_counter()
+            for name, value in saved.items():
+                setattr(S, name, value)
+            S.update_tasks()
+            self.timings['restore'] = time.perf_counter() - t
+
+            t = time.perf_counter()
+            if self.stack is not None:
+                self.scores = sharpness(self.stack)
+                score = self.scores[self.metric]
+                if score.max() >= self.min_contrast*np.median(score):
+                    self.best_z, self.peak_in_range = fit_peak(self.z, score, self.fit_points)
+            self.z_stage.move_to(z0 if self.best_z is None else self.best_z)
+            if was_acquiring:
+                S.start_acquisition()
+            self.timings['focus'] = time.perf_counter() - t
+        self.timings['total'] = time.perf_counter() - t0
+
+        if self.best_z is None:
+            print('Autofocus failed: %s. Returned to z = %0.2f um' %
+                  ('no frames acquired' if self.stack is None else 'no plane is clearly sharper than the rest', z0))
+        else:
+            print('Focus at z = %0.2f um (%+0.2f um) from %d planes in %0.0f ms%s' %
+                  (self.best_z, self.best_z - z0, self.num_planes, 1E3*self.timings['total'],
+                   '' if self.peak_in_range else '. Sharpest at the end of the sweep: focus may lie beyond it.'))
+        return self.best_z
+    #close run
+
+
+    def _sweep(self):
+        # One frame per plane, with acquisition stopped while the stage moves
+        S = self.scanner
+        stack = None
+        for ii, z in enumerate(self.z):
+            self.z_stage.move_to(z)
+            S.start_acquisition()
+            frame = S.wait_for_frames(1)
+            S.stop_acquisition()
+            if frame is None:
+                return None
+            if stack is None:
+                stack = np.empty((self.num_planes,) + frame.shape, dtype=np.float32)
+            stack[ii] = frame
+        return stack
+    #close _sweep
+
+#close class autoFocuser
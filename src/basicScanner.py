@@ -23,13 +23,89 @@
   b.set_amplitude(1)
   b.stop_acquisition()
 
+  To try it out without any hardware use the simulated DAQ:
+  b = basicScanner.basicScanner(simulated=True)
+
+  Scan waveforms are checked against the mirror limits in b.galvo_limiter. Patterns that
+  are too fast have their fly-back lengthened. To refuse them instead:
+  b.galvo_limiter.action = 'reject'
+
+  To synchronise other instruments, line and frame clocks can be generated on two counters
+  clocked by the AO sample clock. Every frame is also time stamped with the sample clock
+  count of its first sample, so it can be aligned with external data recorded from the clocks:
+  b = basicScanner.basicScanner(autoconnect=False)
+  b.export_clocks = True
+  b.frame_clock_terminal = 'PFI12'
+  b.set_up_tasks(); b.setup_plot()
+  b.start_acquisition()
+  b.save_frame_timestamps('frames.csv')
+
+  Frames are scaled for display using percentiles of each frame. To fix the display levels:
+  b.display.levels = (0, 0.5)
+
+  Frames are assembled into buffers leased from b.frame_pool (see framePool.py), which the
+  display and other stages hold by reference rather than copying. last_frame is therefore
+  only valid until the next frame; wait_for_frames returns a copy that may be kept.
+
+  Tasks are created and committed once, so starting and stopping is fast (see
+  b.start_latency). After changing settings, update_tasks applies them doing no more than
+  necessary: it only rewrites the AO buffer if just the waveforms changed, re-configures
+  the timing of the existing tasks if the number of samples changed, and re-creates them
+  only if something else changed:
+  b.scan_amplitude = 2
+  b.update_tasks()     # Returns 'rewrite', 'reconfigure' or 'recreate'
+
+  Scan parameters may be loaded from a profile (see scanPlan.py and the profiles directory).
+  The waveforms and pixel map of each profile are compiled once and cached on disk:
+  b = basicScanner.basicScanner(profile='standard_256')
+  b.load_profile('fast_128')
+
+  Frames are assembled by a reconstructionEngine built from the scan plan. To shift the
+  pixel map by 3 samples (mirror lag) and average 2 by 2 blocks of pixels:
+  b.set_reconstruction(phase_offset=3, pixel_binning=2)
+
+  To correct for sample drift, register each frame to a running reference:
+  b.enable_motion_correction()
+  b.motion_corrector.save_shifts('shifts.csv')
+
+  To tune frame processing offline, record the raw samples and replay them later through
+  the same code (see rawRecording.py):
+  b.start_raw_recording('session1')
+  b.stop_raw_recording()
+
+  To record the frames themselves, compressed as 16 bit integers in a thread pool (see
+  frameRecording.py):
+  b.start_recording('session1')
+  b.stop_recording()    # Returns the compression ratio and MB/s achieved
+
+  To see how the DAQ callback, display and recording threads interleave, trace every
+  stage and open the result at https://ui.perfetto.dev (see pipelineTrace.py):
+  b.enable_tracing()
+  b.save_trace('session1.json')
+
+  To protect the PMT, check every few ms of samples for saturation and a high mean level
+  as they are read, and stop scanning (or run other actions) if either is too high (see
+  safetyMonitor.py):
+  b.enable_safety_monitor(max_mean_level=0.5, reaction_time=0.01)
+  b.safety_monitor.report()   # Check cost and reaction latency
+
+  To focus automatically, sweep a z stage (see stages.py) acquiring small frames and move
+  to the sharpest plane (see autoFocuser.py):
+  b.autofocus(stages.aoZStage(dev_name='Dev2', channel='ao0'))
+
 '''
 
-import nidaqmx
-from nidaqmx.constants import (AcquisitionType,RegenerationMode)
+import threading
+import time
 import numpy as np
-from pyqtgraph.Qt import QtGui, QtCore
-import pyqtgraph as pg
+from motionCorrector import motionCorrector
+from scanPatterns import rasterPattern, pattern_from_spec
+from galvoLimiter import galvoLimiter
+import scanPlan
+import aoScaling
+from reconstructionEngine import reconstructionEngine
+from framePool import framePool, frameBuffer
+from pipelineTrace import NULL_TRACER
 
 class basicScanner():
 
@@ -46,23 +122,133 @@ class basicScanner():
     waveforms = []  # Will contain the x and y scanner waveforms
     im_size = 256   # Number of pixel rows and columns (square images)
 
+    # An optional scan pattern from scanPatterns.py. If None, a square im_size raster is used.
+    scan_pattern = None
+    _pattern = []   # The compiled pattern currently being scanned
+
+    # Frame reconstruction. phase_offset delays the pixel map by this many raw samples to
+    # compensate for the mirrors lagging the command signal. pixel_binning averages blocks
+    # of pixel_binning by pixel_binning pixels. See reconstructionEngine.py
+    phase_offset = 0
+    pixel_binning = 1
+    _engine = []    # The reconstructionEngine turning raw blocks into frames
+
+    # The immutable scan plan (waveforms, pixel map, buffer sizes) currently in use. Plans are
+    # cached by scanPlan.py so returning to a previous set of parameters costs nothing.
+    scan_plan = None
+    profile = None  # Name of the last profile loaded
+
     # NI DAQ Task configuration
     dev_name = 'Dev1'      # The name of the DAQ device as shown in MAX
-    sample_rate = 96E3     # Sample Rate in Hz
+    sample_rate = 96E3     # Requested AO sample rate in Hz
+    _ao_rate = None        # AO sample rate in use, if the device cannot run at exactly sample_rate
     num_samples_per_channel = [] #The length of the waveform
     
     h_task_ao = [] # DAQmx task handle for analog output
     h_task_ai = [] # DAQmx task handle for analog input
 
+    # If True the waveforms are converted once to the AO DAC's int16 codes, using the device's
+    # calibration, and written unscaled. The codes are cached with each plan. See aoScaling.py
+    unscaled_output = True
+    _ao_scaling = None     # Volts to codes polynomial of each AO channel
+    _ao_writer = []        # nidaqmx AnalogUnscaledWriter for the AO task
+    _ao_codes = []         # int16 buffer for waveforms that are not a plan's (e.g. offset tiles)
+
+    # If True tasks are verified and committed when they are created. Stopping then returns
+    # them to the committed state rather than releasing the hardware, so they re-start quickly.
+    commit_tasks = True
+    start_latency = None   # Seconds taken by the last start_acquisition
+    _task_settings = {}    # The settings the tasks were configured with. See update_tasks
+    _acquiring = False
+
+    # Line and frame clock outputs. If export_clocks is True two counters generate pulse
+    # trains whose ticks are the AO sample clock, so they stay locked to the scan. Each line
+    # and frame clock pulse rises clock_initial_delay samples after its line or frame starts
+    # and stays high for clock_duty_cycle of the period. By default the pulses appear on the
+    # counters' default output terminals; set the *_terminal properties (e.g. 'PFI12') to route them.
+    export_clocks = False
+    line_clock_counter = 'ctr0'
+    frame_clock_counter = 'ctr1'
+    line_clock_terminal = ''
+    frame_clock_terminal = ''
+    clock_duty_cycle = 0.5
+    clock_initial_delay = 2  # Samples. DAQmx requires at least 2 ticks.
+    h_task_clocks = []       # DAQmx counter output tasks generating the clocks
+
+    # Sample clock count (since acquisition last started) of the first sample of each frame.
+    # The count restarts whenever acquisition is (re)started, as do the clocks. The counts of
+    # the last num_frame_indices frames are kept in a ring buffer. See frame_sample_index
+    num_frame_indices = 65536
+    last_frame_sample = None # Sample clock count of the first sample of last_frame
+    _frame_samples = []      # Ring buffer of sample clock counts, by frames_acquired
+
+    # If True, the tasks are created on a simulated device (see simulatedDAQ.py) so no
+    # hardware is needed.
+    simulated = False
+    _daq = []      # The DAQmx module in use: nidaqmx or simulatedDAQ
+
 
     # Properties associated with pyqtgraph plotting
     _points_to_plot = []    # scalar defining how many points to plot at once
     _app = []               # QApplication stored here
     _win = []               # GraphicsLayoutWidget stored here
-    _plot = []              # plot object stored here
+    _plot = []              # ImageItem showing the frames is stored here
+
+    # Converts frames to uint8 in a worker thread and updates the plot from a Qt timer.
+    # Set display.levels to a (low, high) tuple for fixed levels. See displayPipeline.py
+    display = []
+
+    # Optional frame processing stages
+    motion_corrector = None # A motionCorrector instance when motion correction is enabled
+
+    # Raw data recording and replay. See rawRecording.py
+    raw_recorder = None     # A rawRecorder: every raw block read is also written to disk
+    raw_source = None       # A rawReplay: raw blocks come from a recording instead of the DAQ
+    frame_recorder = None   # A frameRecorder: every frame is compressed and written to disk
+
+    # Checks waveforms against the mirror velocity and acceleration limits. See galvoLimiter.py
+    galvo_limiter = []
+
+    # The most recent frame is kept here so that scripts can grab frames
+    last_frame = []         # The most recently acquired frame
+    frames_acquired = 0     # Number of frames acquired since this object was created
+    _frame_condition = []   # threading.Condition notified whenever a new frame arrives
+
+    # Frames are assembled into a pool of preallocated buffers. If they are all in use the
+    # callback waits up to frame_pool_timeout seconds for one, then drops the frame.
+    num_frame_buffers = 8
+    frame_pool_timeout = 0.05
+    frame_pool = None       # The framePool
+    frames_dropped = 0      # Frames not assembled because no buffer was free
+    _frame_lease = None     # The frameBuffer holding last_frame
+
+    # Records the timing of each stage of the pipeline on every thread when tracing is
+    # enabled. See enable_tracing and pipelineTrace.py
+    tracer = NULL_TRACER
+
+    # Checks the detector signal for overload as it is read. When enabled the AI buffer
+    # is read in blocks of a few ms, which are assembled into frames. See enable_safety_monitor
+    safety_monitor = None
+    _block_samples = 0      # Samples per block when reading in blocks, otherwise 0
+    _block_frame = []       # Preallocated raw frame the AI samples are read into, whole or block by block
+    _block_fill = 0         # Samples of _block_frame filled so far
+    _block_first_sample = 0 # Sample clock count of the first sample of _block_frame
+    _block_reader = []      # nidaqmx AnalogSingleChannelReader reading into _block_frame
 
+    autofocuser = None      # The autoFocuser of the last autofocus, holding its sweep and scores
 
-    def __init__(self, autoconnect=True):
+
+    def __init__(self, autoconnect=True, simulated=None, profile=None):
+
+        if simulated is not None:
+            self.simulated = simulated
+
+        self._frame_condition = threading.Condition()
+        self.galvo_limiter = galvoLimiter()
+        self._frame_samples = np.zeros(self.num_frame_indices, dtype=np.int64)
+
+        if profile is not None:
+            self.load_profile(profile)
 
         if autoconnect:
             self.set_up_tasks()
@@ -77,36 +263,32 @@ class basicScanner():
         regeneration. Connects AI to a callback function to handling plotting of data.
         '''
 
-        # * Create two separate DAQmx tasks for the AI and AO
-        self.h_task_ao = nidaqmx.Task('simplescannerao')
-        self.h_task_ai = nidaqmx.Task('simplescannerai')
+        self._import_daq()
 
-
-        # * Connect to analog input and output voltage channels on the named device
+        # * Create the DAQmx task for the AO and connect it to the analog output voltage
+        #   channels on the named device
+        self.h_task_ao = self._daq.Task('simplescannerao')
         self.h_task_ao.ao_channels.add_ao_voltage_chan( '%s/ao0:1' % self.dev_name)
-        self.h_task_ai.ai_channels.add_ai_voltage_chan( '%s/ai0' % self.dev_name)
+        if self.unscaled_output:
+            self._ao_scaling = aoScaling.device_scaling(self.h_task_ao)
+            self._ao_writer = self._daq.stream_writers.AnalogUnscaledWriter(self.h_task_ao.out_stream)
 
 
         self.generateScanWaveforms() # This populates the waveforms property
-        '''
-        SET UP ANALOG INPUT
-        '''
 
-        # * Configure the sampling rate and the number of samples
-        self.h_task_ai.timing.cfg_samp_clk_timing(self.sample_rate, \
-                                    source= '/%s/ao/SampleClock' % self.dev_name, \
-                                    samps_per_chan=self._points_to_plot, \
-                                    sample_mode=AcquisitionType.CONTINUOUS)
+        self._set_up_input_task()
+        self._configure_output_task()
+        self._set_up_start_trigger()
 
-        # NOTE: must explicitly set the input buffer so that it's a multiple
-        # of the number of samples per frame. Setting the samples per channel 
-        # (above) does not achieve this.
-        self.h_task_ai.in_stream.input_buf_size = self._points_to_plot * 2
+        if self.export_clocks:
+            self._set_up_clock_tasks()
 
-        # * Register a a callback function to be run every N samples
-        self.h_task_ai.register_every_n_samples_acquired_into_buffer_event(self._points_to_plot, self._read_and_display_last_frame)
+        if self.commit_tasks:
+            self._commit()
+        self._task_settings = {'structure': self._task_structure(), 'timing': self._task_timing()}
 
 
+    def _configure_output_task(self):
         '''
         SET UP ANALOG OUTPUT
         '''
@@ -115,9 +297,10 @@ class basicScanner():
         # * Configure the sampling rate and the number of samples
         #   http://zone.ni.com/reference/en-XX/help/370471AE-01/daqmxcfunc/daqmxcfgsampclktiming/
         #   https://nidaqmx-python.readthedocs.io/en/latest/timing.html
-        self.h_task_ao.timing.cfg_samp_clk_timing(rate = self.sample_rate, \
-                                               samps_per_chan=self._points_to_plot, \
-                                               sample_mode = AcquisitionType.CONTINUOUS)
+        sample_mode, samples = self._sample_mode()
+        self.h_task_ao.timing.cfg_samp_clk_timing(rate = self.ao_sample_rate, \
+                                               samps_per_chan=samples or self._points_to_plot, \
+                                               sample_mode = sample_mode)
 
 
         # * Do allow sample regeneration: i.e. the buffer contents will play repeatedly (cyclically).
@@ -125,20 +308,91 @@ class basicScanner():
         # For more on DAQmx write properties: http://zone.ni.com/reference/en-XX/help/370469AG-01/daqmxprop/daqmxwrite/
         # For a discussion on regeneration mode in the context of analog output tasks see:
         # https://forums.ni.com/t5/Multifunction-DAQ/Continuous-write-analog-voltage-NI-cDAQ-9178-with-callbacks/td-p/4036271
-        self.h_task_ao.out_stream.regen_mode = RegenerationMode.ALLOW_REGENERATION
+        self.h_task_ao.out_stream.regen_mode = self._daq.constants.RegenerationMode.ALLOW_REGENERATION
 
 
 
-        # * Set the size of the output buffer TODO -- do we need this?
+        # * Set the size of the output buffer to one frame. This matters when the tasks are
+        #   re-configured for a frame of a different length (see update_tasks).
         #   http://zone.ni.com/reference/en-XX/help/370471AG-01/daqmxcfunc/daqmxcfgoutputbuffer/
-        #self.h_task.cfgOutputBuffer(num_samples_per_channel);
+        self.h_task_ao.out_stream.output_buf_size = self._points_to_plot
 
 
         # * Write the waveforms to the buffer
-        self.h_task_ao.write(self.waveforms, timeout=2)
+        self._write_waveforms()
+
+
+    def _write_waveforms(self):
+        '''
+        Write self.waveforms to the AO buffer, as int16 codes if unscaled_output is True.
+        The codes of a plan's own waveforms are cached with the plan, so only waveforms
+        that have been modified (e.g. offset by tiledScanner) are converted here.
+        '''
+        if not self.unscaled_output:
+            self.h_task_ao.write(self.waveforms, timeout=2)
+            return
+
+        if self.waveforms is self.scan_plan.waveforms:
+            codes = self.scan_plan.codes(self._ao_scaling)
+        else:
+            if not isinstance(self._ao_codes, np.ndarray) or self._ao_codes.shape != self.waveforms.shape:
+                self._ao_codes = np.empty(self.waveforms.shape, dtype=np.int16)
+            codes = aoScaling.volts_to_codes(self.waveforms, self._ao_scaling, out=self._ao_codes)
+        self._ao_writer.write_int16(codes, timeout=2)
+
+
+    def _set_up_input_task(self):
+        '''
+        SET UP ANALOG INPUT
+        Sub-classes with other detectors (e.g. photonCountingScanner) replace this method.
+        '''
+        self.h_task_ai = self._daq.Task('simplescannerai')
+        self.h_task_ai.ai_channels.add_ai_voltage_chan( '%s/ai0' % self.dev_name)
+        self._configure_input_task()
 
 
+    def _configure_input_task(self):
+        '''
+        Set the timing, buffer size and callback of the input task. Also used by
+        update_tasks to re-configure an existing task.
+        '''
+        # * Configure the sampling rate and the number of samples
+        sample_mode, samples = self._sample_mode()
+        self.h_task_ai.timing.cfg_samp_clk_timing(self.ao_sample_rate, \
+                                    source= '/%s/ao/SampleClock' % self.dev_name, \
+                                    samps_per_chan=samples or self.scan_plan.callback_interval, \
+                                    sample_mode=sample_mode)
+
+        # NOTE: must explicitly set the input buffer so that it's a multiple
+        # of the number of samples per frame. Setting the samples per channel 
+        # (above) does not achieve this.
+        self.h_task_ai.in_stream.input_buf_size = self.scan_plan.input_buf_size
+
+        # * Samples are read straight into a preallocated frame. Task.read would return a list.
+        self._block_frame = np.zeros(self._points_to_plot)
+        self._block_reader = self._daq.stream_readers.AnalogSingleChannelReader(self.h_task_ai.in_stream)
+
+        # * Register a a callback function to be run every N samples: every frame, or every
+        #   block when the safety monitor is on
+        if self.safety_monitor is None:
+            self._block_samples = 0
+            self.h_task_ai.register_every_n_samples_acquired_into_buffer_event(self.scan_plan.callback_interval,
+                                                                                self._read_and_display_last_frame)
+        else:
+            self._block_samples = self._safety_block_samples()
+            self.h_task_ai.register_every_n_samples_acquired_into_buffer_event(self._block_samples,
+                                                                                self._read_and_check_block)
+
+
+    def _sample_mode(self):
+        '''
+        The sample mode of the AO and AI tasks and, for finite acquisition, the number of
+        samples each acquires. Sub-classes acquiring a fixed number of frames replace this.
+        '''
+        return self._daq.constants.AcquisitionType.CONTINUOUS, None
+
 
+    def _set_up_start_trigger(self):
         '''
         Set up the triggering
         '''
@@ -149,60 +403,463 @@ class basicScanner():
         # Note that now the AO task must be started before the AI task in order for the synchronisation to work
 
 
+    def _set_up_clock_tasks(self):
+        '''
+        Create counter output tasks generating line and frame clocks. They count AO sample
+        clock ticks and are started by the AO start trigger, so they begin with the scan.
+        '''
+        clocks = ((self.line_clock_counter, self.line_clock_terminal, self.scan_plan.samples_per_line),
+                  (self.frame_clock_counter, self.frame_clock_terminal, self.scan_plan.samples_per_frame))
+
+        self.h_task_clocks = []
+        for counter, terminal, period in clocks:
+            high_ticks = min(max(int(period*self.clock_duty_cycle), 2), period-2)
+            task = self._daq.Task('simplescanner%s' % counter)
+            chan = task.co_channels.add_co_pulse_chan_ticks('%s/%s' % (self.dev_name, counter),
+                                                            '/%s/ao/SampleClock' % self.dev_name,
+                                                            idle_state=self._daq.constants.Level.LOW,
+                                                            initial_delay=self.clock_initial_delay,
+                                                            low_ticks=period-high_ticks,
+                                                            high_ticks=high_ticks)
+            if terminal:
+                chan.co_pulse_term = '/%s/%s' % (self.dev_name, terminal)
+            task.timing.cfg_implicit_timing(sample_mode=self._daq.constants.AcquisitionType.CONTINUOUS)
+            task.triggers.start_trigger.cfg_dig_edge_start_trig('/%s/ao/StartTrigger' % self.dev_name)
+            self.h_task_clocks.append(task)
+
+        print('Exporting a line clock every %d samples on %s and a frame clock every %d samples on %s' %
+              (clocks[0][2], self.line_clock_counter, clocks[1][2], self.frame_clock_counter))
+
+
     def generateScanWaveforms(self):
         '''
         This method builds simple ("unshaped") galvo waveforms and stores them in the self.waveforms property.
         "shaped" waveforms would be those that have some sort of smoothed deceleration at the mirror 
         turn-arounds to help increase frame rate and improve scanning accuracy. 
-        '''
 
-        yWaveform = np.linspace(self.scan_amplitude, -self.scan_amplitude, self.im_size**2)
+        By default a square raster of im_size by im_size pixels is produced. Any other pattern
+        from scanPatterns (rectangular frames, ROIs, line scans, point scans) may be used
+        by assigning it to self.scan_pattern or calling set_scan_pattern.
+        '''
 
-        # The X waveform goes from +scan_amplitude to -scan_amplitude over the course of one line.
-        xWaveform = np.linspace(-self.scan_amplitude, self.scan_amplitude, self.im_size) # One line of X
+        if self.scan_pattern is None:
+            # Y goes from +scan_amplitude to -scan_amplitude over the frame and X from
+            # -scan_amplitude to +scan_amplitude over each of the "imSize" lines.
+            spec = rasterPattern(rows=self.im_size, cols=self.im_size).spec()
+        else:
+            spec = self.scan_pattern.spec()
 
-        # Repeat the X waveform "imSize" times in order to build a square image
-        xWaveform = np.tile(xWaveform, self.im_size)
+        # Fetch the plan for these parameters, compiling it only if it has not been seen
+        # before. Compiling checks the pattern is safe for the mirrors. If it is not the
+        # pattern is either rejected (ValueError) or its turn-arounds are lengthened.
+        parameters = scanPlan.plan_parameters(spec, self.scan_amplitude, self.ao_sample_rate, self.galvo_limiter)
+        self.scan_plan = scanPlan.get_plan(parameters, self.galvo_limiter)
 
-        # Assemble the two waveforms
-        self.waveforms = np.stack((xWaveform, yWaveform));
+        # The waveforms and the sample-to-pixel map used to assemble frames
+        self._pattern = self.scan_plan.pattern()
+        self.waveforms = self.scan_plan.waveforms
 
-        self._points_to_plot = len(yWaveform)
+        self._points_to_plot = self._pattern.num_samples
+        self._build_engine()
 
         # Report frame rate to screen
         print('Scanning with a frame size of %d by %d pixels at %0.2f frames per second. %d samples per frame.\n' % \
-             (self.im_size, self.im_size, self.sample_rate/self._points_to_plot,self._points_to_plot) );
+             (self._pattern.frame_shape + (self.ao_sample_rate/self._points_to_plot,self._points_to_plot)) );
 
 
 
     def setup_plot(self):
-        # Set up pyqtgraph plot window
-        self._app = QtGui.QApplication([])
-        self._win = QtGui.QMainWindow()
-        self._win.resize(800,800) # Make window 800 by 800 pixels
-        pg.setConfigOptions(antialias=True)
-        self._plot = pg.ImageView()
-        self._win.setCentralWidget(self._plot)
-        self._win.show()
-
-        # Remove the buttons beneath to histogram
-        self._plot.ui.roiBtn.hide()
-        self._plot.ui.menuBtn.hide()
+        # Set up pyqtgraph plot window. Qt is imported here, not at the top of the file, so
+        # the scanner can also run headless (see acquisitionServer.py).
+        from imageWindow import image_item_window
+        from displayPipeline import displayPipeline
+        self._app, self._win, self._plot = image_item_window()
+        self.display = displayPipeline()
+        self.display.attach(self._plot)
+        self._attach_tracer()
 
 
     def _read_and_display_last_frame(self,tTask, event_type, num_samples, callback_data):
-        # Callback function that extract data and update plots
-        data = self.h_task_ai.read(number_of_samples_per_channel=self._points_to_plot)
-        _im = np.array(data).reshape(self.im_size,self.im_size)
-        self._plot.setImage(np.transpose(_im), autoLevels=False, autoHistogramRange=False)
+        # Callback function that extract data and queue them for display. The display
+        # pipeline converts and draws the frame later so the callback returns straight away.
+        with self.tracer.span('frame'):
+            _im = self._read_last_frame()
+            if _im is not None:
+                self.display.submit(_im, self._frame_lease.retain())
+        return 0
+
+
+    def _read_and_check_block(self, tTask, event_type, num_samples, callback_data):
+        # Callback reading one block into the frame being filled and checking it with the
+        # safety monitor. Once the frame is full it is processed as usual.
+        n = self._block_samples
+        if self._block_fill == 0:
+            self._block_first_sample = self.h_task_ai.in_stream.curr_read_pos
+        block = self._block_frame[self._block_fill:self._block_fill+n]
+        with self.tracer.span('read block'):
+            self._block_reader.read_many_sample(block, number_of_samples_per_channel=n)
+        self._block_fill += n
+
+        with self.tracer.span('safety check'):
+            self.safety_monitor.check(block, self._block_first_sample + self._block_fill)
+
+        if self._block_fill == self._block_frame.shape[0]:
+            self._block_fill = 0
+            self._read_and_display_last_frame(tTask, event_type, self._block_frame.shape[0], callback_data)
         return 0
 
 
+    def _read_last_frame(self):
+        '''
+        Read one frame of data from the AI buffer, assemble it into an image and pass
+        it through any enabled processing stages. Returns the processed frame, or None if
+        it was dropped. The frame is held by self._frame_lease: stages that keep it after
+        the callback returns must retain() that and release() it when they are done.
+        '''
+        first_sample, _im, lease = self._acquire_frame()
+        if _im is None:
+            return None
+
+        if self.motion_corrector is not None:
+            with self.tracer.span('motion correction'):
+                _im = self.motion_corrector.correct(_im)
+            lease.release()
+            lease = frameBuffer(_im)    # A new array, outside the pool
+
+        if self.frame_recorder is not None:
+            with self.tracer.span('record'):
+                self.frame_recorder.write(_im, first_sample)
+
+        with self._frame_condition:
+            previous = self._frame_lease
+            self.last_frame = _im
+            self._frame_lease = lease
+            self._frame_samples[self.frames_acquired % self._frame_samples.shape[0]] = first_sample
+            self.last_frame_sample = first_sample
+            self.frames_acquired += 1
+            self._frame_condition.notify_all()
+        if previous is not None:
+            previous.release()
+
+        return _im
+
+
+    def _acquire_frame(self):
+        '''
+        Read and assemble one frame. Returns the sample clock count of its first sample,
+        the frame and the frameBuffer holding it. The frame is None if it was dropped.
+        '''
+        with self.tracer.span('read'):
+            if self.raw_source is not None:
+                first_sample, data = self.raw_source.read_block()
+            else:
+                first_sample, data = self._read_raw_block()
+
+        if self.raw_recorder is not None:
+            with self.tracer.span('raw record'):
+                self.raw_recorder.write(first_sample, data)
+
+        with self.tracer.span('lease buffer'):
+            lease = self._lease_frame(data)
+        if lease is None:
+            self.frames_dropped += 1
+            self.tracer.instant('frame dropped')
+            if self.frames_dropped == 1:
+                print('Dropping frames: all %d frame buffers are in use' % self.frame_pool.num_buffers)
+            return first_sample, None, None
+
+        with self.tracer.span('assemble'):
+            frame = self._assemble_frame(data, lease.array)
+        return first_sample, frame, lease
+
+
+    def _read_raw_block(self):
+        '''
+        Read one frame's worth of raw samples from the DAQ. Returns the sample clock count
+        of the first sample and the samples. Sub-classes with other detectors replace this
+        and _assemble_frame.
+        '''
+        if self._block_samples:
+            # Already read, block by block, by _read_and_check_block
+            return self._block_first_sample, self._block_frame
+
+        # The read position is the number of samples read since the task started: i.e. the
+        # sample clock count of the first sample of this frame
+        first_sample = self.h_task_ai.in_stream.curr_read_pos
+        self._block_reader.read_many_sample(self._block_frame, number_of_samples_per_channel=self._points_to_plot)
+        return first_sample, self._block_frame
+
+
+    def _assemble_frame(self, data, out):
+        '''
+        Turn one raw block from _read_raw_block into a frame, written into out
+        '''
+        return self._engine.assemble(data, out=out)
+
+
+    def _lease_frame(self, data):
+        '''
+        Lease a buffer for the frame assembled from data, from a pool that is (re)built
+        when the frame shape or type changes. Returns None if none is free.
+        '''
+        shape = self._frame_shape(data)
+        dtype = self._frame_dtype(data)
+        if self.frame_pool is None or not self.frame_pool.matches(shape, dtype):
+            self.frame_pool = framePool(shape, dtype, self.num_frame_buffers)
+        return self.frame_pool.lease(self.frame_pool_timeout)
+
+
+    def _frame_shape(self, data):
+        # One plane per channel of a multi-channel block
+        return data.shape[:-1] + self._engine.frame_shape
+
+
+    def _frame_dtype(self, data):
+        # Type of the frames assembled from data. Sub-classes may store frames differently.
+        if self._engine.reduction == 'sum' and data.dtype.kind in 'ui':
+            return np.uint32
+        return np.float64
+
+
+    def _build_engine(self):
+        self._engine = reconstructionEngine.from_plan(self.scan_plan, **self._reconstruction_options())
+
+
+    def _reconstruction_options(self):
+        '''
+        Arguments of the reconstructionEngine. Sub-classes add their own.
+        '''
+        return {'phase': self.phase_offset, 'binning': self.pixel_binning}
+
+
+    def set_reconstruction(self, phase_offset=None, pixel_binning=None):
+        '''
+        Change how frames are assembled. Takes effect from the next frame without
+        touching the tasks, so it also works while scanning or replaying a recording.
+        '''
+        if phase_offset is not None:
+            self.phase_offset = phase_offset
+        if pixel_binning is not None:
+            self.pixel_binning = pixel_binning
+        if self.scan_plan is not None:
+            self._build_engine()
+
+
+    def wait_for_frames(self, num_frames=1, timeout=10):
+        '''
+        Block until num_frames new frames have been acquired then return a copy of the last
+        of them. Acquisition must be running. Returns None if the timeout (in seconds) expires.
+        '''
+        with self._frame_condition:
+            target = self.frames_acquired + num_frames
+            if not self._frame_condition.wait_for(lambda: self.frames_acquired >= target, timeout):
+                print('Timed out waiting for frames')
+                return None
+            return self.last_frame.copy()   # Copied under the lock, before the buffer is re-used
+
+
+    @property
+    def ao_sample_rate(self):
+        '''
+        The AO sample rate in use: sample_rate, unless a subclass had to adjust it
+        '''
+        return self.sample_rate if self._ao_rate is None else self._ao_rate
+
+
+    @property
+    def frame_sample_index(self):
+        '''
+        Sample clock count of the first sample of each of the last num_frame_indices frames,
+        oldest first. The first of them is frame number frames_acquired - len(frame_sample_index).
+        '''
+        with self._frame_condition:
+            size = self._frame_samples.shape[0]
+            if self.frames_acquired <= size:
+                return self._frame_samples[:self.frames_acquired].copy()
+            return np.roll(self._frame_samples, -(self.frames_acquired % size))
+
+
+    @property
+    def frame_times(self):
+        '''
+        Start time of each frame in seconds, from the sample clock count
+        '''
+        return self.frame_sample_index / self.ao_sample_rate
+
+
+    def save_frame_timestamps(self, fname):
+        '''
+        Write a CSV file with the frame number, sample clock count and start time of each
+        of the last num_frame_indices frames
+        '''
+        with self._frame_condition:
+            samples = self.frame_sample_index
+            first_frame = self.frames_acquired - samples.shape[0]
+        with open(fname, 'w') as f:
+            f.write('frame,sample,time\n')
+            for ii, n in enumerate(samples):
+                f.write('%d,%d,%0.9f\n' % (first_frame + ii, n, n/self.ao_sample_rate))
+
+
+    def enable_motion_correction(self, reference_frames=None):
+        '''
+        Register each frame to a running reference before it is displayed.
+        The shift time series is available via self.motion_corrector.shifts
+        '''
+        self.motion_corrector = motionCorrector(reference_frames=reference_frames)
+
+
+    def disable_motion_correction(self):
+        self.motion_corrector = None
+
+
+    def start_recording(self, fname, **kwargs):
+        '''
+        Compress and write every frame, after any processing, to fname.frames. Compression
+        runs in a thread pool. Keyword arguments (codec, workers, ...) are passed to the
+        frameRecorder. See frameRecording.py
+        '''
+        from frameRecording import frameRecorder
+        self.stop_recording()
+        options = self._recording_format()
+        options.update(kwargs)
+        metadata = {'scanner': type(self).__name__, 'sample_rate': float(self.ao_sample_rate)}
+        if self.scan_plan is not None:
+            metadata['plan_parameters'] = self.scan_plan.parameters
+        self.frame_recorder = frameRecorder(fname, metadata=metadata, **options)
+        self._attach_tracer()
+
+
+    def _recording_format(self):
+        # Analog frames are stored as int16, full scale being +/- detector_voltage_range
+        return {'dtype': 'int16', 'scale': 32767/self.detector_voltage_range}
+
+
+    def stop_recording(self):
+        '''
+        Stop recording frames. Returns the compression ratio and throughput achieved.
+        '''
+        recorder = self.frame_recorder
+        self.frame_recorder = None
+        if recorder is not None:
+            return recorder.close()
+
+
+    def enable_tracing(self, capacity=65536):
+        '''
+        Record the start and duration of every pipeline stage, on every thread, in a ring
+        buffer holding the last capacity events. Covers the DAQ callback, the display and
+        any frame recording. Write them out with save_trace. See pipelineTrace.py
+        '''
+        from pipelineTrace import pipelineTracer
+        self.tracer = pipelineTracer(capacity)
+        self._attach_tracer()
+
+
+    def disable_tracing(self):
+        self.tracer = NULL_TRACER
+        self._attach_tracer()
+
+
+    def save_trace(self, fname):
+        '''
+        Write the events traced so far to fname as Chrome trace JSON, which can be opened
+        at https://ui.perfetto.dev or chrome://tracing. Best done with acquisition stopped.
+        '''
+        return self.tracer.save(fname)
+
+
+    def _attach_tracer(self):
+        # Give the components that run in other threads the scanner's tracer
+        for component in (self.display, self.frame_recorder):
+            if hasattr(component, 'tracer'):
+                component.tracer = self.tracer
+
+
+    def enable_safety_monitor(self, actions=None, **settings):
+        '''
+        Check each block of samples for detector overload as soon as it is read, and stop
+        acquisition if more than max_saturated_fraction of a block is at saturation_level
+        or its mean exceeds max_mean_level. Blocks last at most half of reaction_time
+        seconds. actions replaces the stop with other functions, called as action(reason),
+        e.g. safetyMonitor.output_action(gain_task, 0). saturation_level defaults to 98%
+        of detector_voltage_range. See safetyMonitor.py. Raises ValueError for scanners
+        that read their own raw blocks (e.g. photon counting or several devices).
+        '''
+        from safetyMonitor import safetyMonitor
+        if type(self)._read_raw_block is not basicScanner._read_raw_block:
+            raise ValueError('%s reads its own raw blocks, which the safety monitor '
+                             'cannot check' % type(self).__name__)
+        settings.setdefault('saturation_level', 0.98*self.detector_voltage_range)
+        self.safety_monitor = safetyMonitor([self._safety_stop] if actions is None else actions, **settings)
+        self.update_tasks()
+
+
+    def disable_safety_monitor(self):
+        self.safety_monitor = None
+        self.update_tasks()
+
+
+    def _safety_stop(self, reason):
+        # The default protective action. Runs on the DAQ callback thread.
+        self.stop_acquisition()
+
+
+    def _safety_block_samples(self):
+        return self.safety_monitor.block_samples(self.scan_plan.samples_per_frame,
+                                                 self.scan_plan.samples_per_line, self.ao_sample_rate)
+
+
+    def autofocus(self, z_stage, **settings):
+        '''
+        Sweep z_stage through z_range microns either side of its position, acquiring a
+        small frame of the centre of the field at each plane, and move it to the sharpest.
+        Returns the z in focus. Keyword arguments (z_range, num_planes, im_size, metric, ...)
+        set up the autoFocuser. See autoFocuser.py
+        '''
+        from autoFocuser import autoFocuser
+        self.autofocuser = autoFocuser(self, z_stage, **settings)
+        return self.autofocuser.run()
+
+
+    def start_raw_recording(self, fname):
+        '''
+        Write every raw block, before any processing, to fname.raw. The scan waveforms,
+        pixel map and settings go to fname.npz. See rawRecording.py for replay.
+        '''
+        from rawRecording import rawRecorder
+        self.stop_raw_recording()
+        self.raw_recorder = rawRecorder(fname, self)
+
+
+    def stop_raw_recording(self):
+        recorder = self.raw_recorder
+        self.raw_recorder = None
+        if recorder is not None:
+            recorder.close()
+
+
     def start_acquisition(self):
         if not self._task_created():
             return
+        if self.safety_monitor is not None and self.safety_monitor.tripped:
+            print('Not starting: the safety monitor tripped (%s). Call safety_monitor.reset() first.' %
+                  self.safety_monitor.trip_reason)
+            return
 
+        self._block_fill = 0
+        t0 = time.perf_counter()
+        self._start_tasks()
+        self.start_latency = time.perf_counter() - t0
+        if self.safety_monitor is not None:
+            self.safety_monitor.start(self.ao_sample_rate)
+        self._acquiring = True
+
+
+    def _start_tasks(self):
         self.h_task_ao.start()
+        for task in self.h_task_clocks:
+            task.start()   # Armed: they start with the AO task
         self.h_task_ai.start() # Starting this task triggers the AO task
 
 
@@ -210,8 +867,16 @@ class basicScanner():
         if not self._task_created():
             return
 
+        self._stop_tasks()
+        self._acquiring = False
+
+
+    def _stop_tasks(self):
         self.h_task_ai.stop()
         self.h_task_ao.stop()
+        for task in self.h_task_clocks:
+            task.stop()
+
 
     def close_tasks(self):
         if not self._task_created():
@@ -219,24 +884,154 @@ class basicScanner():
 
         self.h_task_ai.close()
         self.h_task_ao.close()
+        for task in self.h_task_clocks:
+            task.close()
+        self.h_task_clocks = []
+        self._task_settings = {}
+        self._acquiring = False
 
 
-    def set_amplitude(self,amplitude):
+    def _all_tasks(self):
+        # Every task this scanner has created
+        return [self.h_task_ao, self.h_task_ai] + self.h_task_clocks
+
+
+    def _commit(self):
+        # Verify the tasks, reserve their resources and program the hardware, so that
+        # starting them later does nothing else
+        for task in self._all_tasks():
+            task.control(self._daq.constants.TaskMode.TASK_COMMIT)
+
+
+    def _task_structure(self):
+        '''
+        Settings that can only be changed by re-creating the tasks. Sub-classes add their own.
+        '''
+        return {'simulated': self.simulated, 'dev_name': self.dev_name, 'export_clocks': self.export_clocks,
+                'line_clock_counter': self.line_clock_counter, 'frame_clock_counter': self.frame_clock_counter,
+                'line_clock_terminal': self.line_clock_terminal, 'frame_clock_terminal': self.frame_clock_terminal,
+                'clock_duty_cycle': self.clock_duty_cycle, 'clock_initial_delay': self.clock_initial_delay,
+                'unscaled_output': self.unscaled_output}
+
+
+    def _task_timing(self):
+        # Settings that can be changed by re-configuring the existing tasks
+        block = self._safety_block_samples() if self.safety_monitor is not None else 0
+        return (self.sample_rate, self.scan_plan.samples_per_frame, self.scan_plan.samples_per_line, block)
+
+
+    def update_tasks(self):
+        '''
+        Apply changed settings (scan_amplitude, scan_pattern, im_size, sample_rate, ...) to
+        the existing tasks, doing no more than necessary. Returns what was done:
+        'rewrite'      only the waveforms changed. They are written to the AO buffer.
+        'reconfigure'  the sample rate or the frame length changed. The timing and buffers of
+                       the existing tasks are changed and they are committed again.
+        'recreate'     something that defines the tasks themselves (see _task_structure)
+                       changed. The tasks are closed and created again.
+        None           there are no tasks. The settings apply when they are created.
+        Acquisition is re-started if it was running.
+        '''
+        if isinstance(self.h_task_ao, list) or not self._task_settings:
+            return None
+
+        was_acquiring = self._acquiring
         self.stop_acquisition()
+
+        self.generateScanWaveforms() # Plans are cached, so this is cheap if nothing changed
+        if self._task_structure() != self._task_settings['structure']:
+            self.close_tasks()
+            self.set_up_tasks()
+            action = 'recreate'
+        elif self._task_timing() != self._task_settings['timing']:
+            self._reconfigure_tasks()
+            action = 'reconfigure'
+        else:
+            self._write_waveforms()
+            action = 'rewrite'
+
+        if was_acquiring:
+            self.start_acquisition()
+        return action
+
+
+    def _reconfigure_tasks(self):
+        # New timing and buffer sizes for the existing tasks
+        self._configure_output_task()
+        self.h_task_ai.register_every_n_samples_acquired_into_buffer_event(0, None) # Remove the callback
+        self._configure_input_task()
+
+        # The clock periods depend on the frame so these cheap tasks are simply re-created
+        for task in self.h_task_clocks:
+            task.close()
+        self.h_task_clocks = []
+        if self.export_clocks:
+            self._set_up_clock_tasks()
+
+        if self.commit_tasks:
+            self._commit()
+        self._task_settings['timing'] = self._task_timing()
+
+
+    def set_scan_pattern(self, pattern=None):
+        '''
+        Switch to a different scan pattern (see scanPatterns.py). Call with no arguments to
+        return to the default square raster. If the number of samples per frame changes
+        the tasks are re-configured.
+        '''
+        self.scan_pattern = pattern
+        self.update_tasks()
+
+
+    def load_profile(self, name):
+        '''
+        Apply a profile (see scanPlan.py): a profile name such as 'standard_256' or the path
+        to a TOML file. If tasks exist they are updated with the new parameters.
+        '''
+        profile = scanPlan.read_profile(name)
+
+        for key, value in profile.get('scanner', {}).items():
+            setattr(self, key, value)
+        for key, value in profile.get('galvo', {}).items():
+            setattr(self.galvo_limiter, key, value)
+        # Profiles without a [pattern] section use the default im_size raster
+        self.scan_pattern = pattern_from_spec(profile['pattern']) if 'pattern' in profile else None
+        self.profile = name
+
+        self.update_tasks()
+
+
+    def set_amplitude(self,amplitude):
         self.scan_amplitude=amplitude
-        self.generateScanWaveforms()
-        self.h_task_ao.write(self.waveforms, timeout=2)
-        self.start_acquisition()
+        self.update_tasks()
 
 
 
     # House-keeping methods follow
+    def _import_daq(self):
+        '''
+        Import the DAQmx module. This is done only when tasks are created so that code
+        which just needs waveforms or frame processing starts quickly and does not need
+        NI-DAQmx to be installed. Called again after simulated changes, it switches module.
+        '''
+        if getattr(self._daq, '__name__', None) == ('simulatedDAQ' if self.simulated else 'nidaqmx'):
+            return
+        if self.simulated:
+            import simulatedDAQ
+            self._daq = simulatedDAQ
+        else:
+            import nidaqmx
+            import nidaqmx.stream_readers
+            import nidaqmx.stream_writers
+            self._daq = nidaqmx
+
+
     def _task_created(self):
         '''
         Return True if a task has been created
         '''
 
-        if isinstance(self.h_task_ao,nidaqmx.task.Task) or isinstance(self.h_task_ai,nidaqmx.task.Task):
+        if not isinstance(self.h_task_ao,list) or not isinstance(self.h_task_ai,list):
             return True
         else:
             print('No tasks created: run the set_up_tasks method')
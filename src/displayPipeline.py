@@ -0,0 +1,245 @@
+'''
+ Convert frames for display off the GUI thread
+
+ displayPipeline
+
+
+ Description:
+  Handing float64 frames straight to pyqtgraph means it re-scales and copies every frame
+  on the GUI thread, while the DAQ callback waits. A displayPipeline instead:
+  - accepts frames from the acquisition callback with submit(), which never blocks. If
+    the display falls behind, intermediate frames are skipped for display only: every
+    frame is still acquired. A frame from a framePool is submitted with a reference to
+    its buffer, which is released once the frame has been converted or skipped.
+  - converts the newest frame to uint8 in a worker thread. Levels are either fixed or
+    set from percentiles of a subsampled copy of the frame. 16 bit integer frames (raw
+    counts) go through a cached 65536 entry lookup table instead of arithmetic.
+  - writes into one of three preallocated buffers (triple buffering), so the worker never
+    writes into the buffer being drawn and never waits for the GUI.
+  - is polled by a Qt timer (60 Hz by default) in the GUI thread, which passes the newest
+    contiguous uint8 buffer to a row-major ImageItem with levels (0,255). pyqtgraph can
+    then wrap the buffer in a QImage without scaling or copying it.
+
+  Qt is imported only by attach(), so the conversion can be used and benchmarked headless.
+
+
+  Usage:
+  import displayPipeline
+  D = displayPipeline.displayPipeline(levels=(0, 1))   # Fixed levels
+  D = displayPipeline.displayPipeline()                # Percentile levels
+  D.attach(image_item)   # A pg.ImageItem(axisOrder='row-major')
+  D.submit(frame)        # From the acquisition callback
+
+  basicScanner uses one of these for its display:
+  b.display.levels = (-0.2, 1)
+  b.display.levels = None  # Back to percentile levels
+
+'''
+
+import threading
+import time
+import numpy as np
+from pipelineTrace import NULL_TRACER
+
+class displayPipeline():
+
+    # Intensity levels mapped to 0 and 255. If None they are set from the percentiles
+    # below, measured on every subsample'th pixel along each axis of each frame.
+    levels = None
+    percentiles = (0.5, 99.5)
+    subsample = 8
+
+    refresh_rate = 60       # Display updates per second
+
+    # Counters
+    frames_submitted = 0
+    frames_converted = 0
+    frames_displayed = 0
+    frames_skipped = 0      # Frames replaced by a newer one before they were converted
+    frames_failed = 0       # Frames whose conversion raised. The worker carries on.
+    last_error = None       # The exception raised by the last failed conversion
+    convert_time = 0        # Duration of the last conversion in seconds
+
+    tracer = NULL_TRACER    # Records conversions and draws when tracing. See pipelineTrace.py
+
+    _pending = None         # Newest submitted frame, waiting for the worker
+    _pending_lease = None   # The frameBuffer reference that came with it, if any
+    _new_frame = []         # threading.Condition guarding _pending
+    _buffers = []           # Three uint8 display buffers
+    _ready = None           # Index of the newest converted buffer, if not yet displayed
+    _displayed = None       # Index of the buffer currently shown
+    _swap_lock = []
+    _running = False
+
+    _scratch = []           # float32 work buffer for the conversion of float frames
+    _lut = []               # uint8 lookup table for 16 bit frames
+    _lut_key = None         # (dtype, low, high) the lookup table was built for
+    _current_levels = (0, 1)
+
+    _image_item = []
+    _timer = []
+
+
+
+    def __init__(self, levels=None):
+        self.levels = levels
+        self._new_frame = threading.Condition()
+        self._swap_lock = threading.Lock()
+        self._running = True
+        threading.Thread(target=self._worker, name='display worker', daemon=True).start()
+    #close constructor
+
+
+    def submit(self, frame, lease=None):
+        '''
+        Offer a frame for display. Returns immediately. The frame must not be modified
+        after it has been submitted. lease is a reference to the frameBuffer holding the
+        frame (see framePool.py), which the display releases when it is done with it.
+        '''
+        with self._new_frame:
+            skipped = self._pending_lease
+            if self._pending is not None:
+                self.frames_skipped += 1
+            self._pending = frame
+            self._pending_lease = lease
+            self.frames_submitted += 1
+            self._new_frame.notify()
+        if skipped is not None:
+            skipped.release()
+    #close submit
+
+
+    def _worker(self):
+        while True:
+            with self._new_frame:
+                self._new_frame.wait_for(lambda: self._pending is not None or not self._running)
+                if not self._running:
+                    return
+                frame = self._pending
+                lease = self._pending_lease
+                self._pending = None
+                self._pending_lease = None
+
+            try:
+                self._show(frame)
+            except Exception as err:
+                # A bad frame must not stop the display, nor keep its pool buffer
+                self.frames_failed += 1
+                self.last_error = err
+                if self.frames_failed == 1:
+                    print('Display conversion failed: %r. Further failures are counted in frames_failed.' % err)
+            finally:
+                if lease is not None:
+                    lease.release()
+    #close _worker
+
+
+    def _show(self, frame):
+        # Convert a frame into a free buffer and mark it as ready to be drawn
+        t0 = time.perf_counter()
+        with self._swap_lock:
+            # Write into the buffer that is neither waiting to be shown nor on screen
+            if not self._buffers or self._buffers[0].shape != frame.shape:
+                self._buffers = [np.empty(frame.shape, dtype=np.uint8) for ii in range(3)]
+                self._ready = None
+                self._displayed = None
+            index = ({0, 1, 2} - {self._ready, self._displayed}).pop()
+            buf = self._buffers[index]
+
+        with self.tracer.span('convert'):
+            self.convert(frame, out=buf)
+
+        with self._swap_lock:
+            self._ready = index
+        self.frames_converted += 1
+        self.convert_time = time.perf_counter() - t0
+    #close _show
+
+
+    def convert(self, frame, out=None):
+        '''
+        Convert a 2D frame to uint8 using the current levels. Returns out.
+        '''
+        frame = np.asarray(frame)
+        if out is None:
+            out = np.empty(frame.shape, dtype=np.uint8)
+
+        low, high = self._get_levels(frame)
+
+        if frame.dtype in (np.int16, np.uint16):
+            # Raw integer data: a single table look-up per pixel
+            np.take(self._get_lut(frame.dtype, low, high), frame.view(np.uint16), out=out)
+            return out
+
+        if not isinstance(self._scratch, np.ndarray) or self._scratch.shape != frame.shape:
+            self._scratch = np.empty(frame.shape, dtype=np.float32)
+        s = self._scratch
+        np.subtract(frame, low, out=s, casting='unsafe')
+        np.multiply(s, 255/max(high - low, np.finfo(np.float32).eps), out=s)
+        np.clip(s, 0, 255, out=s)
+        np.copyto(out, s, casting='unsafe')
+        return out
+    #close convert
+
+
+    def _get_levels(self, frame):
+        if self.levels is not None:
+            self._current_levels = self.levels
+        else:
+            sample = frame[::self.subsample, ::self.subsample]
+            low, high = np.percentile(sample, self.percentiles)
+            self._current_levels = (float(low), float(high))
+        return self._current_levels
+    #close _get_levels
+
+
+    def _get_lut(self, dtype, low, high):
+        # The table is indexed by the raw 16 bit pattern of each pixel and is only rebuilt
+        # when the levels change by at least one count
+        key = (np.dtype(dtype), int(np.floor(low)), int(np.ceil(high)))
+        if key != self._lut_key:
+            values = np.arange(65536, dtype=np.uint16).view(dtype).astype(np.float32)
+            self._lut = np.clip((values - key[1]) * (255/max(key[2] - key[1], 1)), 0, 255).astype(np.uint8)
+            self._lut_key = key
+        return self._lut
+    #close _get_lut
+
+
+    def attach(self, image_item):
+        '''
+        Display converted frames on a pg.ImageItem, created with axisOrder='row-major',
+        refreshed by a timer running in the GUI thread.
+        '''
+        from pyqtgraph.Qt import QtCore
+        self._image_item = image_item
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(int(1000/self.refresh_rate))
+    #close attach
+
+
+    def refresh(self):
+        '''
+        Show the newest converted frame, if there is one. Runs in the GUI thread.
+        '''
+        with self._swap_lock:
+            if self._ready is None:
+                return
+            self._displayed = self._ready
+            self._ready = None
+            buf = self._buffers[self._displayed]
+        with self.tracer.span('draw'):
+            self._image_item.setImage(buf, autoLevels=False, levels=(0, 255))
+        self.frames_displayed += 1
+    #close refresh
+
+
+    def close(self):
+        if not isinstance(self._timer, list):
+            self._timer.stop()
+        with self._new_frame:
+            self._running = False
+            self._new_frame.notify()
+    #close close
+
+#close class displayPipeline
@@ -0,0 +1,240 @@
+'''
+ Frame reconstruction from the measured mirror positions
+
+ feedbackScanner
+
+
+ Description:
+  basicScanner puts each sample in the pixel that was commanded when it was acquired.
+  When the scan is faster than the mirrors can follow, the mirrors lag and round off the
+  command and the image is shifted and distorted, increasingly so towards the turn-arounds.
+  phase_offset only corrects a constant delay. Most galvo servo drivers output the actual
+  mirror position, so this class records the X and Y position feedback alongside the
+  detector and puts every sample in the pixel the beam was really at.
+
+  The map from command volts to pixels is fitted (least squares, linear in X and Y) from
+  the scan plan's own waveforms and pixel map when the plan is built. That holds only for
+  raster patterns, including ROIs: the rows of a line scan are repetitions and the pixels
+  of a point scan are points, not positions. Frames of line and point patterns are
+  therefore always assembled from the command signal, as if position_source were
+  'command'. Each frame the feedback is converted to command volts with
+  feedback_gain and feedback_offset, mapped to pixels and the samples are accumulated with
+  two np.bincount calls: the detector signal weighted by pixel, and the number of samples
+  in each pixel. Each pixel is the mean of its samples. Samples that land outside the frame
+  are discarded, as are those acquired during the fly-back unless use_flyback is True. Pixels
+  no sample landed in are 0. The per-sample arrays are preallocated, so the only arrays
+  allocated each frame are the two per-pixel results of np.bincount.
+
+  pixel_binning works as in basicScanner. phase_offset now delays the feedback relative
+  to the detector, to correct for any delay in the feedback electronics. The samples at
+  the start (or, if it is negative, the end) of the frame that then have no feedback are
+  discarded.
+
+  Set position_source = 'command' to assemble frames from the command signal, as
+  basicScanner does, from the same recording: e.g. to compare the two.
+
+  Wiring instructions:
+  - As basicScanner
+  - The X mirror position output of the servo driver to x_feedback_channel (AI1 by default)
+    and the Y to y_feedback_channel (AI2 by default)
+
+  The feedback scale differs between drivers, often 0.5 or 0.8 V per degree of mirror
+  rotation against 0.5 or 1 V per degree for the command. Set feedback_gain and
+  feedback_offset so that gain*feedback + offset is in command volts: with the scan stopped
+  and the mirrors parked, feedback should then read the same as the command.
+
+
+  Usage:
+  import feedbackScanner
+  F = feedbackScanner.feedbackScanner(autoconnect=False)
+  F.feedback_gain = (1.25, 1.25)
+  F.set_up_tasks()
+  F.setup_plot()
+  F.start_acquisition()
+
+  Without hardware the simulated mirrors lag with simulatedDAQ.mirror_time_constant:
+  F = feedbackScanner.feedbackScanner(simulated=True)
+
+'''
+
+import numpy as np
+from basicScanner import basicScanner
+
+class feedbackScanner(basicScanner):
+
+    x_feedback_channel = 'ai1'  # AI channel recording the X mirror position
+    y_feedback_channel = 'ai2'  # AI channel recording the Y mirror position
+    feedback_voltage_range = 10 # Feedback is acquired at +/- this number of volts
+
+    # Conversion of the feedback of each axis (X, Y) to command volts: gain*feedback + offset
+    feedback_gain = (1, 1)
+    feedback_offset = (0, 0)
+
+    position_source = 'feedback'    # Place samples by the 'feedback' or the 'command' signal
+    use_flyback = False         # If True, samples acquired during the fly-back are used too
+
+    _reader = []                # nidaqmx AnalogMultiChannelReader
+    _raw = []                   # Preallocated detector, X, Y by samples array for one frame
+    _pixel_map = None           # 3 x 2 least squares map from (X, Y, 1) volts to (column, row). None if not a raster.
+    _in_frame = []              # True for the samples of the plan that are in a pixel, False for the fly-back
+    _work = {}                  # Preallocated arrays for assembling frames
+
+
+
+    def _set_up_input_task(self):
+        self.h_task_ai = self._daq.Task('simplescannerai')
+        self.h_task_ai.ai_channels.add_ai_voltage_chan('%s/ai0' % self.dev_name)
+        for chan in (self.x_feedback_channel, self.y_feedback_channel):
+            self.h_task_ai.ai_channels.add_ai_voltage_chan('%s/%s' % (self.dev_name, chan),
+                                                           min_val=-self.feedback_voltage_range,
+                                                           max_val=self.feedback_voltage_range)
+        self._reader = self._daq.stream_readers.AnalogMultiChannelReader(self.h_task_ai.in_stream)
+        self._configure_input_task()
+    #close _set_up_input_task
+
+
+    def _configure_input_task(self):
+        super()._configure_input_task()
+        self._raw = np.zeros((3, self._points_to_plot))
+    #close _configure_input_task
+
+
+    def _task_structure(self):
+        structure = super()._task_structure()
+        structure.update(x_feedback_channel=self.x_feedback_channel, y_feedback_channel=self.y_feedback_channel,
+                         feedback_voltage_range=self.feedback_voltage_range)
+        return structure
+    #close _task_structure
+
+
+    def _read_raw_block(self):
+        first_sample = self.h_task_ai.in_stream.curr_read_pos
+        self._reader.read_many_sample(self._raw, number_of_samples_per_channel=self._raw.shape[1])
+        return first_sample, self._raw
+    #close _read_raw_block
+
+
+    def _build_engine(self):
+        super()._build_engine()
+        self._work = {}
+
+        self._pixel_map = None
+        pattern_type = self.scan_plan.parameters['pattern'].get('type', 'raster')
+        if pattern_type != 'raster':
+            if self.position_source == 'feedback':
+                print('Feedback only maps raster patterns to pixels: frames of this %s pattern are '
+                      'assembled from the command signal' % pattern_type)
+            return
+
+        # Fit column and row as linear functions of the command volts, using the samples of the plan
+        # that are in a pixel. The fitted map places the pixel centres at whole numbers.
+        pixel_index = self.scan_plan.pixel_index
+        in_frame = pixel_index >= 0
+        rows, cols = np.divmod(pixel_index[in_frame], self.scan_plan.frame_shape[1])
+        x, y = self.scan_plan.waveforms[0], self.scan_plan.waveforms[1]
+        design = np.column_stack((x[in_frame], y[in_frame], np.ones(rows.shape[0])))
+        self._pixel_map = np.linalg.lstsq(design, np.column_stack((cols, rows)), rcond=None)[0]
+
+        self._in_frame = in_frame
+    #close _build_engine
+
+
+    def _buffer(self, name, n, dtype=np.float64):
+        # A preallocated array of n samples, re-allocated only when the frame length changes
+        buf = self._work.get(name)
+        if buf is None or buf.shape[0] != n:
+            buf = self._work[name] = np.empty(n, dtype=dtype)
+        return buf
+    #close _buffer
+
+
+    def _frame_shape(self, data):
+        # One detector channel, however many rows the raw block has
+        return self._engine.frame_shape
+    #close _frame_shape
+
+
+    def _assemble_frame(self, data, out):
+        if self.position_source not in ('feedback', 'command'):
+            raise ValueError("position_source must be 'feedback' or 'command'")
+        if self.position_source == 'command' or self._pixel_map is None:
+            return self._engine.assemble(data[0], out=out)
+
+        n = data.shape[1]
+        rows, cols = self._engine.frame_shape
+        num_pixels = rows*cols
+        binning = max(int(self.pixel_binning), 1)
+
+        # Feedback in command volts
+        x = self._buffer('x', n)
+        y = self._buffer('y', n)
+        np.multiply(data[1], self.feedback_gain[0], out=x)
+        x += self.feedback_offset[0]
+        np.multiply(data[2], self.feedback_gain[1], out=y)
+        y += self.feedback_offset[1]
+
+        # The (binned) pixel column and row of each sample
+        pixel = self._buffer('pixel', n, np.intp)
+        index = self._buffer('index', n, np.intp)
+        position = self._buffer('position', n)
+        valid = self._buffer('valid', n, bool)
+        term = self._buffer('term', n)
+        in_range = self._buffer('in_range', n, bool)
+        valid.fill(True)
+        for axis, size, dest in ((1, rows, pixel), (0, cols, index)):
+            np.multiply(x, self._pixel_map[0, axis], out=position)
+            np.multiply(y, self._pixel_map[1, axis], out=term)
+            position += term
+            position += self._pixel_map[2, axis] + 0.5
+            position /= binning
+            np.floor(position, out=position)
+            np.copyto(dest, position, casting='unsafe')
+            np.greater_equal(position, 0, out=in_range)
+            valid &= in_range
+            np.less(position, size, out=in_range)
+            valid &= in_range
+        pixel *= cols
+        pixel += index
+
+        if not self.use_flyback and self._in_frame.shape[0] == n:
+            valid &= self._in_frame
+        np.logical_not(valid, out=in_range)
+        np.copyto(pixel, num_pixels, where=in_range)   # Discarded into an extra bin
+
+        phase = int(self.phase_offset)
+        if phase:
+            # Detector sample i is placed by the feedback of sample i - phase. Samples
+            # whose feedback would come from the other end of the frame are discarded.
+            shifted = self._buffer('shifted', n, np.intp)
+            if abs(phase) >= n:
+                shifted.fill(num_pixels)
+            elif phase > 0:
+                shifted[phase:] = pixel[:n-phase]
+                shifted[:phase] = num_pixels
+            else:
+                shifted[:n+phase] = pixel[-phase:]
+                shifted[n+phase:] = num_pixels
+            pixel = shifted
+
+        sums = np.bincount(pixel, weights=data[0], minlength=num_pixels+1)[:num_pixels]
+        counts = np.bincount(pixel, minlength=num_pixels+1)[:num_pixels]
+
+        frame = out.reshape(-1)
+        frame[...] = 0
+        filled = self._buffer('filled', num_pixels, bool)
+        np.greater(counts, 0, out=filled)
+        np.divide(sums, counts, out=frame, where=filled)
+        return out
+    #close _assemble_frame
+
+#close class feedbackScanner
+
+
+
+if __name__ == '__main__':
+    print('\nRunning demo for feedbackScanner\n\n')
+    SCANNER = feedbackScanner()
+    SCANNER.start_acquisition()
+    input('press return to stop')
+    SCANNER.stop_acquisition()
+    SCANNER.close_tasks()
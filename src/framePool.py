@@ -0,0 +1,166 @@
+'''
+ A pool of preallocated, reference counted frame buffers
+
+ framePool
+
+
+ Description:
+  Allocating a new array for every frame makes the garbage collector and page faults
+  show up as latency spikes in the acquisition callback. A framePool instead allocates
+  num_buffers frames once, in one block of memory, each starting on an alignment byte
+  boundary (64 bytes: a cache line, and enough for any SIMD instruction set).
+
+  lease() hands out a free buffer as a frameBuffer holding one reference. Every stage
+  that keeps the frame beyond the call that gave it the frame calls retain() to add a
+  reference and release() when it has finished with it. Nothing is copied. When the
+  last reference is released the buffer goes back to the pool, ready to be leased again.
+
+  If every buffer is in use, lease() waits up to timeout seconds for one to be released
+  and then returns None rather than allocating: the consumers are not keeping up and the
+  caller should drop the frame. exhausted counts these events and max_in_use shows how
+  many buffers were ever needed at once.
+
+  A frameBuffer can also wrap an array that is not from a pool (pool=None). retain and
+  release then do nothing, so stages need not care where a frame came from.
+
+
+  Usage:
+  import framePool
+  P = framePool.framePool((512, 512), 'float64', num_buffers=8)
+  lease = P.lease()
+  lease.array[:] = ...          # Fill the frame
+  display.submit(lease.array, lease.retain())   # The display releases its reference
+  lease.release()               # The buffer returns to the pool after the display's release
+
+  basicScanner assembles every frame into a buffer from its frame_pool. See
+  b.frame_pool.max_in_use and b.frames_dropped.
+
+'''
+
+import threading
+import numpy as np
+
+class frameBuffer():
+
+    array = []          # The frame
+    index = -1          # Position in the pool. -1 if not from a pool.
+
+    _pool = None
+    _refs = 0
+
+
+
+    def __init__(self, array, pool=None, index=-1):
+        self.array = array
+        self._pool = pool
+        self.index = index
+    #close constructor
+
+
+    @property
+    def refs(self):
+        return self._refs
+
+
+    def retain(self):
+        '''
+        Add a reference. Returns this frameBuffer, so it can be passed on in one go.
+        '''
+        if self._pool is not None:
+            with self._pool._lock:
+                if self._refs <= 0:
+                    raise ValueError('Retaining a frame buffer that was returned to the pool')
+                self._refs += 1
+        return self
+    #close retain
+
+
+    def release(self):
+        '''
+        Remove a reference. The last release returns the buffer to the pool.
+        '''
+        if self._pool is not None:
+            self._pool._release(self)
+    #close release
+
+#close class frameBuffer
+
+
+
+class framePool():
+
+    shape = ()
+    dtype = None
+    num_buffers = 0
+    alignment = 64          # Bytes. Every buffer starts on a multiple of this.
+
+    leases = 0              # Buffers handed out
+    exhausted = 0           # Leases refused because every buffer was in use
+    max_in_use = 0          # The most buffers ever in use at once
+
+    _memory = []            # The single allocation holding all the buffers
+    _buffers = []           # frameBuffer for each buffer
+    _free = []              # Indices of the buffers not in use
+    _lock = []              # threading.Condition guarding the reference counts and _free
+
+
+
+    def __init__(self, shape, dtype=np.float64, num_buffers=8, alignment=64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.num_buffers = int(num_buffers)
+        self.alignment = int(alignment)
+        self._lock = threading.Condition()
+
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        stride = -(-nbytes // self.alignment) * self.alignment
+        self._memory = np.zeros(stride*self.num_buffers + self.alignment, dtype=np.uint8)
+        offset = -self._memory.ctypes.data % self.alignment
+
+        self._buffers = []
+        for ii in range(self.num_buffers):
+            start = offset + ii*stride
+            array = self._memory[start:start+nbytes].view(self.dtype).reshape(self.shape)
+            self._buffers.append(frameBuffer(array, self, ii))
+        self._free = list(range(self.num_buffers))
+    #close constructor
+
+
+    @property
+    def available(self):
+        return len(self._free)
+
+
+    def lease(self, timeout=0):
+        '''
+        Return a free buffer holding one reference, waiting up to timeout seconds for one.
+        Returns None if none is free.
+        '''
+        with self._lock:
+            if not self._free and (timeout <= 0 or not self._lock.wait_for(lambda: self._free, timeout)):
+                self.exhausted += 1
+                return None
+            buf = self._buffers[self._free.pop()]
+            buf._refs = 1
+            self.leases += 1
+            self.max_in_use = max(self.max_in_use, self.num_buffers - len(self._free))
+        return buf
+    #close lease
+
+
+    def _release(self, buf):
+        with self._lock:
+            if buf._refs <= 0:
+                raise ValueError('Frame buffer %d released more times than it was retained' % buf.index)
+            buf._refs -= 1
+            if buf._refs == 0:
+                self._free.append(buf.index)
+                self._lock.notify()
+    #close _release
+
+
+    def matches(self, shape, dtype):
+        return self.shape == tuple(shape) and self.dtype == np.dtype(dtype)
+    #close matches
+
+#close class framePool
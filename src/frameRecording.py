@@ -0,0 +1,462 @@
+'''
+ Record frames to disk compressed in a thread pool, and read them back
+
+ frameRecording
+
+
+ Description:
+  A frameRecorder stores frames as 16 bit integers (or any integer type), compressed, so
+  recordings take a fraction of the disk space of raw data. Compression is far too slow
+  to run in the acquisition callback, so the callback only converts each frame into a
+  chunk of frames_per_chunk preallocated frames. Full chunks are compressed in a pool of
+  worker threads while a writer thread writes the compressed chunks in acquisition order.
+  The codecs all release the GIL, so the workers run in parallel with each other and
+  with acquisition.
+
+  Codecs, by order of preference when codec='auto':
+    zstd    the zstandard package
+    blosc   the blosc package (its own byte shuffle, using zstd internally)
+    lz4     the lz4 package: fastest, compresses least
+    zlib    the standard library, always available
+  Before compression the bytes of each chunk are shuffled, i.e. all the low bytes then
+  all the high bytes. Neighbouring pixels have similar high bytes so this typically
+  doubles the compression ratio of image data.
+
+  Files:
+    fname.frames  the compressed chunks, in order. Each is preceded by a small header
+                  (chunk number, frames, raw and compressed sizes) and is flushed as soon as
+                  it is written, so that a recording that was not closed can still be read.
+    fname.npz     the frame shape, data type, scale, codec, the index (file offset, size
+                  and first frame of every chunk) and each frame's sample clock count
+
+  Chunks are taken from a pool of max_pending preallocated chunk buffers. Should the disk
+  or the workers fall behind, write blocks until a buffer is free rather than dropping
+  frames. stalls counts how many times this happened.
+
+  A frameReader gives random access to the frames: it finds the chunk in the index and
+  decompresses only that chunk.
+
+
+  Usage:
+  Record while scanning. Analog frames are stored as int16 spanning +/- detector_voltage_range:
+  b.start_recording('session1')
+  b.stop_recording()   # {'ratio': ..., 'mb_per_second': ..., ...}
+
+  Read back:
+  import frameRecording
+  R = frameRecording.frameReader('session1')
+  frame = R[10]         # Stored integers
+  frame = R.read(10, scaled=True)  # In the units of the original frames (volts)
+  frames = R[10:20]
+
+  Directly:
+  W = frameRecording.frameRecorder('stack', dtype='uint16', codec='lz4', workers=4)
+  for frame in frames:
+      W.write(frame)
+  W.close()
+
+'''
+
+import os
+import json
+import struct
+import time
+import queue
+import threading
+import numpy as np
+from pipelineTrace import NULL_TRACER
+
+CODECS = ('zstd', 'blosc', 'lz4', 'zlib')
+_HEADER = struct.Struct('<4sIIQQ')  # Magic, chunk number, frames, raw bytes, compressed bytes
+_MAGIC = b'FRC1'
+
+
+def _file_names(fname):
+    base = fname[:-7] if fname.endswith('.frames') else fname[:-4] if fname.endswith('.npz') else fname
+    return base + '.frames', base + '.npz'
+#close _file_names
+
+
+def _load_codec(name, level=None, typesize=2):
+    '''
+    Return (name, compress, decompress, shuffles) for a codec, or for the first one that is
+    installed if name is 'auto'. shuffles is True if the codec does its own byte shuffle.
+    '''
+    if name == 'auto':
+        for name in CODECS:
+            try:
+                return _load_codec(name, level, typesize)
+            except ImportError:
+                pass
+
+    if name == 'zstd':
+        import zstandard
+        level = 3 if level is None else level
+        return name, lambda data: zstandard.compress(data, level), zstandard.decompress, False
+    if name == 'blosc':
+        import blosc
+        blosc.set_releasegil(True)
+        level = 5 if level is None else level
+        return (name, lambda data: blosc.compress(data, typesize=typesize, clevel=level,
+                                                  shuffle=blosc.SHUFFLE, cname='zstd'),
+                blosc.decompress, True)
+    if name == 'lz4':
+        import lz4.frame
+        level = 0 if level is None else level
+        return name, lambda data: lz4.frame.compress(data, compression_level=level), lz4.frame.decompress, False
+    if name == 'zlib':
+        import zlib
+        level = 1 if level is None else level
+        return name, lambda data: zlib.compress(data, level), zlib.decompress, False
+    raise ValueError('Unknown codec %s. Valid codecs are: %s' % (name, ', '.join(CODECS)))
+#close _load_codec
+
+
+def _shuffle(chunk):
+    # All the first bytes of each value, then all the second bytes, ...
+    itemsize = chunk.dtype.itemsize
+    return np.ascontiguousarray(chunk.reshape(-1).view(np.uint8).reshape(-1, itemsize).T)
+#close _shuffle
+
+
+def _unshuffle(data, dtype):
+    itemsize = np.dtype(dtype).itemsize
+    return np.ascontiguousarray(np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T).view(dtype).reshape(-1)
+#close _unshuffle
+
+
+
+class frameRecorder():
+
+    fname = ''              # Path of the .frames file
+    dtype = np.dtype('int16') # Type the frames are stored as
+    scale = 1               # Frames are multiplied by this, rounded and clipped to dtype
+    codec = ''              # The codec in use
+    frames_per_chunk = 8    # Frames compressed together
+    max_pending = 8         # Chunk buffers: the most chunks waiting to be compressed or written
+
+    frames_written = 0      # Frames handed to write
+    chunks_written = 0      # Chunks compressed and written to disk
+    raw_bytes = 0           # Bytes of the chunks written, before compression
+    compressed_bytes = 0
+    compress_seconds = 0    # Total time the workers spent compressing
+    stalls = 0              # Times write waited for a free chunk buffer
+
+    tracer = NULL_TRACER    # Records conversion, compression and writes when tracing. See pipelineTrace.py
+
+    _metadata = {}          # Extra metadata for the .npz file, e.g. from the scanner
+    _file = None
+    _pool = []              # concurrent.futures.ThreadPoolExecutor compressing the chunks
+    _pending = []           # Queue of (first frame, future, buffer, frames) in acquisition order
+    _free = []              # Queue of free chunk buffers
+    _writer = []            # Thread writing the compressed chunks
+    _chunk = None           # The chunk buffer being filled
+    _frame_in_chunk = 0
+    _frame_shape = None     # Shape of the first frame. All others must match.
+    _scratch = None         # Float buffer for scaling frames
+    _index = []             # (offset, compressed bytes, first frame, frames) of each chunk written
+    _sample_index = []      # Sample clock count of each frame
+    _error = None           # Exception raised by a worker or the writer
+    _t0 = None
+
+
+
+    def __init__(self, fname, dtype='int16', scale=1, codec='auto', level=None, frames_per_chunk=8,
+                 workers=None, max_pending=8, metadata=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.fname, self._meta_fname = _file_names(fname)
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind not in 'ui':
+            raise ValueError('Frames are recorded as integers, not %s' % self.dtype)
+        self.scale = scale
+        self.frames_per_chunk = int(frames_per_chunk)
+        self.max_pending = int(max_pending)
+        self.codec, self._compress, _, self._codec_shuffles = _load_codec(codec, level, self.dtype.itemsize)
+        self._metadata = dict(metadata or {})
+
+        self._index = []
+        self._sample_index = []
+        self._file = open(self.fname, 'wb')
+        self._pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count(),
+                                        thread_name_prefix='frameRecorder')
+        self._pending = queue.Queue()
+        self._free = queue.Queue()
+        self._writer = threading.Thread(target=self._write_chunks, name='frameRecorder writer', daemon=True)
+        self._writer.start()
+    #close constructor
+
+
+    def write(self, frame, first_sample=-1):
+        '''
+        Add one frame. Converts it to dtype in the current chunk and, if that fills the
+        chunk, hands the chunk to the workers. Called from the acquisition thread.
+        '''
+        if self._error is not None:
+            raise self._error
+        frame = np.asarray(frame)
+        if self._frame_shape is None:
+            self._start(frame.shape)
+        elif frame.shape != self._frame_shape:
+            raise ValueError('Frame of shape %s does not match the recording (%s)' % (frame.shape, self._frame_shape))
+
+        if self._chunk is None:
+            self._chunk = self._free_buffer()
+        with self.tracer.span('convert for recording'):
+            self._convert(frame, self._chunk[self._frame_in_chunk])
+        self._sample_index.append(first_sample)
+        self._frame_in_chunk += 1
+        self.frames_written += 1
+
+        if self._frame_in_chunk == self.frames_per_chunk:
+            self._submit()
+    #close write
+
+
+    def _start(self, frame_shape):
+        self._frame_shape = frame_shape
+        self._t0 = time.perf_counter()
+        self._start_time = time.time()
+        shape = (self.frames_per_chunk,) + frame_shape
+        for ii in range(self.max_pending):
+            self._free.put(np.zeros(shape, dtype=self.dtype))
+        self._write_metadata()
+    #close _start
+
+
+    def _free_buffer(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            self.stalls += 1    # The workers or the disk are not keeping up: wait for them
+            with self.tracer.span('recording stall'):
+                return self._free.get()
+    #close _free_buffer
+
+
+    def _convert(self, frame, out):
+        # Scale, round and clip into the stored type
+        if frame.dtype == self.dtype and self.scale == 1:
+            out[...] = frame
+            return
+        if self._scratch is None:
+            self._scratch = np.empty(frame.shape)
+        info = np.iinfo(self.dtype)
+        np.multiply(frame, self.scale, out=self._scratch)
+        np.rint(self._scratch, out=self._scratch)
+        np.clip(self._scratch, info.min, info.max, out=self._scratch)
+        np.copyto(out, self._scratch, casting='unsafe')
+    #close _convert
+
+
+    def _submit(self):
+        # Compress the current chunk in the pool. The writer writes it when its turn comes.
+        chunk, n = self._chunk, self._frame_in_chunk
+        first_frame = self.frames_written - n
+        future = self._pool.submit(self._compress_chunk, chunk[:n])
+        self._pending.put((first_frame, future, chunk, n))
+        self._chunk = None
+        self._frame_in_chunk = 0
+    #close _submit
+
+
+    def _compress_chunk(self, chunk):
+        # Runs in a worker thread
+        with self.tracer.span('compress'):
+            t0 = time.perf_counter()
+            data = self._compress(memoryview(chunk if self._codec_shuffles else _shuffle(chunk)).cast('B'))
+            return data, time.perf_counter() - t0
+    #close _compress_chunk
+
+
+    def _write_chunks(self):
+        # The writer thread: write chunks in acquisition order as they are compressed
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            first_frame, future, chunk, n = item
+            try:
+                data, seconds = future.result()
+                if self._error is None:
+                    with self.tracer.span('write chunk'):
+                        offset = self._file.tell()
+                        self._file.write(_HEADER.pack(_MAGIC, self.chunks_written, n, chunk[:n].nbytes, len(data)))
+                        self._file.write(data)
+                        self._file.flush()  # Readable if the recording is never closed
+                    self._index.append((offset + _HEADER.size, len(data), first_frame, n))
+                    self.chunks_written += 1
+                    self.raw_bytes += chunk[:n].nbytes
+                    self.compressed_bytes += len(data)
+                    self.compress_seconds += seconds
+            except Exception as e:
+                self._error = e
+            self._free.put(chunk)
+    #close _write_chunks
+
+
+    def _write_metadata(self):
+        metadata = dict(self._metadata)
+        metadata.update({'frame_shape': list(self._frame_shape),
+                         'dtype': self.dtype.str,
+                         'scale': self.scale,
+                         'codec': self.codec,
+                         'shuffle': not self._codec_shuffles,
+                         'frames_per_chunk': self.frames_per_chunk,
+                         'start_time': self._start_time})
+        index = np.array(self._index, dtype=np.int64).reshape(-1, 4)
+        np.savez(self._meta_fname, metadata=json.dumps(metadata, sort_keys=True),
+                 index=index, sample_index=np.array(self._sample_index[:int(index[:, 3].sum())], dtype=np.int64))
+    #close _write_metadata
+
+
+    def stats(self):
+        '''
+        Compression ratio and throughput so far. mb_per_second is the rate at which frames
+        were recorded and compress_mb_per_second the speed of one worker.
+        '''
+        seconds = time.perf_counter() - self._t0 if self._t0 is not None else 0
+        return {'frames': self.frames_written,
+                'chunks': self.chunks_written,
+                'codec': self.codec,
+                'raw_mb': self.raw_bytes/1E6,
+                'compressed_mb': self.compressed_bytes/1E6,
+                'ratio': self.raw_bytes/self.compressed_bytes if self.compressed_bytes else 0,
+                'seconds': seconds,
+                'mb_per_second': self.raw_bytes/1E6/seconds if seconds > 0 else 0,
+                'compress_mb_per_second': self.raw_bytes/1E6/self.compress_seconds if self.compress_seconds > 0 else 0,
+                'stalls': self.stalls}
+    #close stats
+
+
+    def close(self):
+        '''
+        Compress and write any frames still pending, write the index and return stats()
+        '''
+        if self._file is None:
+            return self.stats()
+        if self._frame_in_chunk > 0:
+            self._submit()
+        self._pending.put(None)
+        self._writer.join()
+        self._pool.shutdown()
+        self._file.close()
+        self._file = None
+        if self._frame_shape is not None:
+            self._write_metadata()
+
+        stats = self.stats()
+        print('Recorded %d frames to %s: %0.1f MB compressed %0.1fx with %s at %0.0f MB/s' %
+              (self.frames_written, self.fname, stats['compressed_mb'], stats['ratio'], self.codec,
+               stats['mb_per_second']))
+        if self._error is not None:
+            raise self._error
+        return stats
+    #close close
+
+#close class frameRecorder
+
+
+
+class frameReader():
+
+    metadata = {}           # Everything in the .npz file except the arrays
+    index = []              # (offset, compressed bytes, first frame, frames) of each chunk
+    sample_index = []       # Sample clock count of each frame
+    dtype = None
+    frame_shape = ()
+
+    _file = None
+    _decompress = []
+    _cached = (None, None)  # (chunk number, frames) of the last chunk decompressed
+
+
+
+    def __init__(self, fname):
+        frames_fname, meta_fname = _file_names(fname)
+        with np.load(meta_fname) as f:
+            self.metadata = json.loads(str(f['metadata']))
+            self.index = f['index']
+            self.sample_index = f['sample_index']
+        self.dtype = np.dtype(self.metadata['dtype'])
+        self.frame_shape = tuple(self.metadata['frame_shape'])
+        self._decompress = _load_codec(self.metadata['codec'], typesize=self.dtype.itemsize)[2]
+        self._file = open(frames_fname, 'rb')
+        self._cached = (None, None)
+
+        if self.index.shape[0] == 0 or self.index[-1, 0] + self.index[-1, 1] < os.path.getsize(frames_fname):
+            self.index = self._scan_chunks()  # The recording was not closed: rebuild the index
+    #close constructor
+
+
+    def _scan_chunks(self):
+        # Walk the chunk headers to build the index
+        index = []
+        size = os.path.getsize(self._file.name)
+        offset = 0
+        first_frame = 0
+        while offset + _HEADER.size <= size:
+            self._file.seek(offset)
+            magic, chunk, n, raw, compressed = _HEADER.unpack(self._file.read(_HEADER.size))
+            if magic != _MAGIC or offset + _HEADER.size + compressed > size:
+                break
+            index.append((offset + _HEADER.size, compressed, first_frame, n))
+            offset += _HEADER.size + compressed
+            first_frame += n
+        return np.array(index, dtype=np.int64).reshape(-1, 4)
+    #close _scan_chunks
+
+
+    @property
+    def num_frames(self):
+        return int(self.index[:, 3].sum())
+
+
+    def __len__(self):
+        return self.num_frames
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return np.stack([self.read(ii) for ii in range(*key.indices(self.num_frames))])
+        return self.read(key)
+
+
+    def read(self, frame, scaled=False):
+        '''
+        Return one frame, as stored or, if scaled is True, divided by the recording's scale
+        '''
+        if frame < 0:
+            frame += self.num_frames
+        if not 0 <= frame < self.num_frames:
+            raise IndexError('Frame %d is not in the recording (%d frames)' % (frame, self.num_frames))
+
+        chunk = int(np.searchsorted(self.index[:, 2], frame, side='right')) - 1
+        frames = self._read_chunk(chunk)
+        data = frames[frame - self.index[chunk, 2]]
+        if scaled:
+            return data / self.metadata['scale']
+        return data.copy()
+    #close read
+
+
+    def _read_chunk(self, chunk):
+        if self._cached[0] == chunk:
+            return self._cached[1]
+        offset, size, first_frame, n = self.index[chunk]
+        self._file.seek(offset)
+        data = self._decompress(self._file.read(size))
+        if self.metadata['shuffle']:
+            values = _unshuffle(data, self.dtype)
+        else:
+            values = np.frombuffer(data, dtype=self.dtype)
+        frames = values.reshape((n,) + self.frame_shape)
+        self._cached = (chunk, frames)
+        return frames
+    #close _read_chunk
+
+
+    def close(self):
+        self._file.close()
+    #close close
+
+#close class frameReader
@@ -0,0 +1,298 @@
+'''
+ Stream frames over the network
+
+ frameServer
+
+
+ Description:
+  A frameServer publishes image frames to any number of subscribers over TCP. Each
+  frame is sent as a fixed 32 byte header followed by the raw pixel data:
+
+    offset  size  field
+    0       4     magic bytes b'SPSF'
+    4       4     numpy dtype string, e.g. b'<f8', NUL padded
+    8       4     number of rows (uint32, little endian)
+    12      4     number of columns (uint32)
+    16      8     frame number (uint64)
+    24      8     acquisition time stamp, seconds since the epoch (float64)
+
+  The pixel data are handed straight to the socket from the numpy buffer (via a
+  memoryview) so no copy is made on the sending side.
+
+  Every subscriber has its own sender thread and a single "latest frame" slot.
+  publish never blocks: it just replaces the contents of each slot. A subscriber that
+  falls behind therefore skips frames and always receives the most recent one, rather
+  than accumulating an unbounded backlog.
+
+  frameClient is the receiving end. It has no GUI so it can be used for analysis; see
+  frameViewer.py for a viewer built on it.
+
+
+  Usage:
+  On the acquisition PC (also see acquisitionServer.py):
+  import frameServer
+  S = frameServer.frameServer(port=5555)
+  S.publish(frame)   # Call for every frame
+  S.close()
+
+  On the analysis PC:
+  C = frameServer.frameClient('daq-pc.lab', 5555)
+  frame_number, timestamp, frame = C.receive()
+
+'''
+
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from pipelineTrace import NULL_TRACER
+
+
+# Header: magic, dtype, rows, cols, frame number, time stamp
+HEADER = struct.Struct('<4s4sIIQd')
+MAGIC = b'SPSF'
+
+
+class frameServer():
+
+    host = '0.0.0.0'   # Listen on all interfaces. Use '127.0.0.1' to accept local connections only.
+    port = 5555
+
+    frames_published = 0  # Counter incremented by publish
+    tracer = NULL_TRACER  # Records publishing and sending when tracing. See pipelineTrace.py
+
+    _listen_socket = []
+    _subscribers = []     # List of _subscriber objects
+    _lock = []
+    _running = False
+
+
+
+    def __init__(self, port=None, host=None):
+        if port is not None:
+            self.port = port
+        if host is not None:
+            self.host = host
+
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listen_socket.bind((self.host, self.port))
+        self._listen_socket.listen()
+        self.port = self._listen_socket.getsockname()[1] # In case port 0 was requested
+        self._running = True
+
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        print('Serving frames on %s:%d' % (self.host, self.port))
+    #close constructor
+
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, address = self._listen_socket.accept()
+            except OSError:
+                break # Socket closed
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print('Subscriber connected from %s:%d' % address)
+            with self._lock:
+                self._subscribers.append(_subscriber(conn, self))
+    #close _accept_loop
+
+
+    def publish(self, frame, timestamp=None, lease=None):
+        '''
+        Offer a frame to all subscribers. Returns immediately. The frame must not be
+        modified after it is published. lease is a reference to the frameBuffer holding
+        the frame (see framePool.py). Each subscriber holds its own reference until it has
+        sent or skipped the frame, and this one is released before returning.
+        '''
+        try:
+            with self.tracer.span('publish'):
+                self._publish(np.ascontiguousarray(frame), timestamp, lease)
+        finally:
+            if lease is not None:
+                lease.release()
+    #close publish
+
+
+    def _publish(self, frame, timestamp, lease):
+        if frame.ndim != 2:
+            raise ValueError('Only 2D frames can be published')
+        if timestamp is None:
+            timestamp = time.time()
+
+        header = HEADER.pack(MAGIC, frame.dtype.str.encode(), frame.shape[0], frame.shape[1],
+                             self.frames_published, timestamp)
+        self.frames_published += 1
+
+        with self._lock:
+            for sub in self._subscribers:
+                sub.offer(header, frame, lease.retain() if lease is not None else None)
+    #close _publish
+
+
+    def _remove(self, sub):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+    #close _remove
+
+
+    @property
+    def num_subscribers(self):
+        return len(self._subscribers)
+    #close num_subscribers
+
+
+    def close(self):
+        self._running = False
+        self._listen_socket.close()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.close()
+    #close close
+
+#close class frameServer
+
+
+
+class _subscriber():
+    '''
+    One connected client. Holds the latest frame and sends it from its own thread.
+    '''
+
+    def __init__(self, conn, server):
+        self._conn = conn
+        self._server = server
+        self._latest = None             # (header, frame, lease) waiting to be sent
+        self._new_frame = threading.Condition()
+        self._open = True
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        threading.Thread(target=self._send_loop, name='frameServer sender', daemon=True).start()
+    #close constructor
+
+
+    def offer(self, header, frame, lease=None):
+        with self._new_frame:
+            skipped = self._latest
+            if self._open:
+                self._latest = (header, frame, lease)
+                self._new_frame.notify()
+            else:
+                self._latest, skipped = None, (header, frame, lease)
+        if skipped is not None:
+            if self._open:
+                self.frames_skipped += 1
+            _release(skipped[2])
+    #close offer
+
+
+    def _send_loop(self):
+        while self._open:
+            with self._new_frame:
+                self._new_frame.wait_for(lambda: self._latest is not None or not self._open)
+                if not self._open:
+                    break
+                header, frame, lease = self._latest
+                self._latest = None
+
+            try:
+                with self._server.tracer.span('send'):
+                    self._conn.sendall(header)
+                    self._conn.sendall(memoryview(frame).cast('B'))
+            except OSError:
+                print('Subscriber disconnected')
+                break
+            finally:
+                _release(lease)
+            self.frames_sent += 1
+
+        self.close()
+    #close _send_loop
+
+
+    def close(self):
+        with self._new_frame:
+            self._open = False
+            latest = self._latest
+            self._latest = None
+            self._new_frame.notify()
+        if latest is not None:
+            _release(latest[2])
+        try:
+            self._conn.close()
+        except OSError:
+            pass
+        self._server._remove(self)
+    #close close
+
+#close class _subscriber
+
+
+
+def _release(lease):
+    if lease is not None:
+        lease.release()
+#close _release
+
+
+
+class frameClient():
+    '''
+    Receive frames from a frameServer. Frames are received into a small set of
+    preallocated buffers which are re-used, so receive() returns a view that is only
+    valid until num_buffers further frames have been received.
+    '''
+
+    num_buffers = 3
+
+    def __init__(self, host='127.0.0.1', port=5555):
+        self._sock = socket.create_connection((host, port))
+        self._header = bytearray(HEADER.size)
+        self._buffers = [None]*self.num_buffers
+        self._next_buffer = 0
+    #close constructor
+
+
+    def _recv_into(self, view):
+        # Fill a memoryview completely from the socket
+        while len(view):
+            n = self._sock.recv_into(view)
+            if n == 0:
+                raise ConnectionError('Frame server closed the connection')
+            view = view[n:]
+    #close _recv_into
+
+
+    def receive(self):
+        '''
+        Block until the next frame arrives. Returns (frame_number, timestamp, frame).
+        '''
+        self._recv_into(memoryview(self._header))
+        magic, dtype, rows, cols, frame_number, timestamp = HEADER.unpack(self._header)
+        if magic != MAGIC:
+            raise ConnectionError('Bad frame header from server')
+
+        dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        buf = self._buffers[self._next_buffer]
+        if buf is None or buf.shape != (rows, cols) or buf.dtype != dtype:
+            buf = np.empty((rows, cols), dtype=dtype)
+            self._buffers[self._next_buffer] = buf
+        self._next_buffer = (self._next_buffer + 1) % self.num_buffers
+
+        self._recv_into(memoryview(buf).cast('B'))
+        return frame_number, timestamp, buf
+    #close receive
+
+
+    def close(self):
+        self._sock.close()
+    #close close
+
+#close class frameClient
@@ -0,0 +1,109 @@
+'''
+ View frames streamed by a frameServer
+
+ frameViewer
+
+
+ Description:
+  A thin viewer for frames published by acquisitionServer (or any frameServer). It uses
+  the same image window as basicScanner. Frames are received on a background thread
+  and the display is refreshed from a Qt timer, so the GUI never waits on the network.
+  If frames arrive faster than they can be drawn the intermediate ones are skipped.
+
+
+  Usage:
+  From the command line:
+  python frameViewer.py daq-pc.lab 5555
+
+  From Python:
+  import frameViewer
+  V = frameViewer.frameViewer('daq-pc.lab', 5555)
+
+'''
+
+import sys
+import threading
+import numpy as np
+from frameServer import frameClient
+
+class frameViewer():
+
+    refresh_interval = 33  # Display refresh interval in ms
+
+    frames_received = 0
+    frames_displayed = 0
+
+    _client = []
+    _latest = None     # The most recently received frame
+    _display = []      # Preallocated buffer holding the frame being displayed
+    _lock = []
+    _timer = []
+    _app = []
+    _win = []
+    _plot = []
+
+
+
+    def __init__(self, host='127.0.0.1', port=5555):
+        from pyqtgraph.Qt import QtCore
+        from imageWindow import image_window
+
+        self._lock = threading.Lock()
+        self._client = frameClient(host, port)
+        self._app, self._win, self._plot = image_window('Frames from %s:%d' % (host, port))
+
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self._update_display)
+        self._timer.start(self.refresh_interval)
+    #close constructor
+
+
+    def _receive_loop(self):
+        while True:
+            try:
+                frame_number, timestamp, frame = self._client.receive()
+            except (ConnectionError, OSError) as err:
+                print('Stopped receiving: %s' % err)
+                return
+            with self._lock:
+                self._latest = frame
+                self.frames_received += 1
+    #close _receive_loop
+
+
+    def _update_display(self):
+        # Runs in the GUI thread
+        with self._lock:
+            frame = self._latest
+            self._latest = None
+            if frame is None:
+                return
+            # Copy out while holding the lock: the client re-uses its receive buffers
+            if not isinstance(self._display, np.ndarray) or self._display.shape != frame.shape[::-1] \
+                    or self._display.dtype != frame.dtype:
+                self._display = np.empty(frame.shape[::-1], dtype=frame.dtype)
+            np.copyto(self._display, frame.T)
+
+        first = self.frames_displayed == 0
+        self._plot.setImage(self._display, autoLevels=first, autoHistogramRange=first)
+        self.frames_displayed += 1
+    #close _update_display
+
+
+    def close(self):
+        self._timer.stop()
+        self._client.close()
+    #close close
+
+#close class frameViewer
+
+
+
+if __name__ == '__main__':
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5555
+    VIEWER = frameViewer(host, port)
+    import pyqtgraph as pg
+    pg.exec()
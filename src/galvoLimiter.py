@@ -0,0 +1,219 @@
+'''
+ Check scan waveforms against the velocity and acceleration limits of the galvo mirrors
+
+ galvoLimiter
+
+
+ Description:
+  Galvo mirrors can be damaged by command waveforms that ask them to move or change
+  direction faster than they are able to. This class computes the per-sample velocity
+  and acceleration of every AO waveform, compares the peaks against a simple mirror
+  model and, depending on the "action" property, either rejects the waveform by raising
+  a ValueError or reshapes it until it is within limits.
+
+  Waveforms are played out with regeneration, so the jump from the last sample back to the
+  first is checked too.
+
+  Reshaping works differently for scan patterns (scanPatterns.py) and raw waveforms:
+  - Patterns are asked to lengthen their turn-arounds (e.g. the raster fly-back) and are
+    re-compiled until they pass. The image itself is unchanged; the frame rate drops slightly.
+    Reshaping stops, and the pattern is rejected, once a step no longer reduces the
+    velocity or acceleration, or the frame has grown max_growth times longer. A pattern
+    beyond max_voltage is rejected straight away: longer turn-arounds can not fix that.
+  - Raw waveforms (e.g. from waveformTester) are low-pass filtered with a progressively
+    narrower Gaussian until they pass. This rounds off sharp corners such as the
+    sawtooth fly-back.
+
+  The check is a handful of vectorised passes over preallocated buffers and takes a few
+  milliseconds for a 1024 x 1024 frame, so it can be run on every parameter change.
+
+
+  Mirror model:
+  Limits are expressed in command volts, so they depend on your scanner and on how its
+  servo driver is set up (volts per degree). The defaults are conservative guesses for a
+  small-beam galvo: set max_velocity and max_acceleration from your scanner data sheet.
+
+
+  Usage:
+  import galvoLimiter
+  L = galvoLimiter.galvoLimiter(max_velocity=5E4)
+  L.check(waveforms, sample_rate=96E3)   # Returns True or False and prints a report
+  L.limit_pattern(pattern, sample_rate=96E3)
+  waveform = L.limit_waveform(waveform, sample_rate=32E3)
+
+'''
+
+import numpy as np
+
+class galvoLimiter():
+
+    # Mirror model
+    max_velocity = 1.2E5      # Maximum command slew rate in V/s
+    max_acceleration = 3E9    # Maximum command acceleration in V/s^2
+    max_voltage = 10          # Maximum absolute command voltage
+
+    # What to do when a waveform exceeds the limits: 'reject' raises a ValueError and
+    # 'reshape' modifies the waveform or pattern until it is within limits.
+    action = 'reshape'
+
+    max_iterations = 16       # Give up reshaping after this many attempts
+    max_growth = 4            # ... or once reshaping has made the frame this many times longer
+
+    # Results of the last check
+    peak_velocity = []        # Peak absolute velocity of each channel (V/s)
+    peak_acceleration = []    # Peak absolute acceleration of each channel (V/s^2)
+
+    # Preallocated buffers holding per-sample first and second differences (V/sample
+    # and V/sample^2). These are re-used between checks of waveforms of the same size.
+    _diff = []
+    _diff2 = []
+    _sample_rate = 1
+
+
+
+    def __init__(self, max_velocity=None, max_acceleration=None, action=None):
+        if max_velocity is not None:
+            self.max_velocity = max_velocity
+        if max_acceleration is not None:
+            self.max_acceleration = max_acceleration
+        if action is not None:
+            self.action = action
+
+        if self.action not in ('reject', 'reshape'):
+            raise ValueError("action must be 'reject' or 'reshape'")
+    #close constructor
+
+
+    def measure(self, waveforms, sample_rate):
+        '''
+        Compute per-sample velocity and acceleration of a waveform (1D) or a set of
+        waveforms (one per row). Returns the peak absolute velocity (V/s) and
+        acceleration (V/s^2) of each channel.
+        '''
+        w = np.atleast_2d(waveforms)
+        if not isinstance(self._diff, np.ndarray) or self._diff.shape != w.shape:
+            # Single precision halves the memory traffic. The first differences of the
+            # waveforms are rounded to single precision as they are stored and the second
+            # differences are taken from those: ample precision for comparing against limits.
+            self._diff = np.empty(w.shape, dtype=np.float32)
+            self._diff2 = np.empty(w.shape, dtype=np.float32)
+        d = self._diff
+        d2 = self._diff2
+        self._sample_rate = sample_rate
+
+        # Cyclic first difference: d[i] = w[i+1] - w[i], wrapping at the end
+        np.subtract(w[:, 1:], w[:, :-1], out=d[:, :-1])
+        d[:, -1] = w[:, 0] - w[:, -1]
+
+        # Cyclic second difference: d2[i] = d[i] - d[i-1]
+        np.subtract(d[:, 1:], d[:, :-1], out=d2[:, 1:])
+        d2[:, 0] = d[:, 0] - d[:, -1]
+
+        self.peak_velocity = np.maximum(d.max(axis=1), -d.min(axis=1)) * sample_rate
+        self.peak_acceleration = np.maximum(d2.max(axis=1), -d2.min(axis=1)) * sample_rate**2
+
+        return self.peak_velocity, self.peak_acceleration
+    #close measure
+
+
+    @property
+    def velocity(self):
+        '''
+        Per-sample velocity (V/s) of each channel from the last call to measure
+        '''
+        return self._diff * self._sample_rate
+    #close velocity
+
+
+    @property
+    def acceleration(self):
+        '''
+        Per-sample acceleration (V/s^2) of each channel from the last call to measure
+        '''
+        return self._diff2 * self._sample_rate**2
+    #close acceleration
+
+
+    def check(self, waveforms, sample_rate, verbose=True):
+        '''
+        Return True if the waveforms are within the limits of the mirror model
+        '''
+        velocity, acceleration = self.measure(waveforms, sample_rate)
+        peak_voltage = max(np.max(waveforms), -np.min(waveforms))
+
+        ok = bool(np.all(velocity <= self.max_velocity) and
+                  np.all(acceleration <= self.max_acceleration) and
+                  peak_voltage <= self.max_voltage)
+
+        if verbose and not ok:
+            print('Waveform exceeds galvo limits: peak voltage %0.2f V (limit %0.2f), '
+                  'velocity %0.3g V/s (limit %0.3g), acceleration %0.3g V/s^2 (limit %0.3g)' %
+                  (peak_voltage, self.max_voltage, velocity.max(), self.max_velocity,
+                   acceleration.max(), self.max_acceleration))
+        return ok
+    #close check
+
+
+    def limit_pattern(self, pattern, sample_rate):
+        '''
+        Compile a scan pattern and make sure its waveforms are within limits. If they are
+        not, and action is 'reshape', the pattern's turn-arounds are lengthened until they
+        are. Raises ValueError if the pattern can not be made safe.
+        '''
+        pattern.compile()
+        peak_voltage = max(np.max(pattern.waveforms), -np.min(pattern.waveforms))
+        if peak_voltage > self.max_voltage:
+            raise ValueError('Scan pattern reaches %0.2f V, beyond the %0.2f V limit of the galvos. '
+                             'Reduce the amplitude.' % (peak_voltage, self.max_voltage))
+
+        num_samples = pattern.num_samples
+        excess = np.inf
+        for ii in range(self.max_iterations):
+            if self.check(pattern.waveforms, sample_rate, verbose=(ii == 0)):
+                if ii > 0:
+                    print('Reshaped scan pattern to meet galvo limits: now %d samples per frame' %
+                          pattern.num_samples)
+                return pattern
+
+            # How far beyond the limits the worst channel is. Reshaping stops once it no longer helps.
+            previous, excess = excess, max(np.max(self.peak_velocity)/self.max_velocity,
+                                           np.max(self.peak_acceleration)/self.max_acceleration)
+            if self.action == 'reject' or excess >= previous or not pattern.relax():
+                break
+            pattern.compile()
+            if pattern.num_samples > self.max_growth*num_samples:
+                break
+
+        raise ValueError('Scan pattern exceeds the galvo velocity or acceleration limits and can not be '
+                         'reshaped. Reduce the amplitude or the sample rate.')
+    #close limit_pattern
+
+
+    def limit_waveform(self, waveform, sample_rate):
+        '''
+        Check a raw waveform (or waveforms, one per row). If it is outside limits and
+        action is 'reshape', return a low-pass filtered copy that is within limits.
+        Raises ValueError if the waveform can not be made safe.
+        '''
+        if self.check(waveform, sample_rate):
+            return waveform
+
+        if self.action == 'reshape' and max(np.max(waveform), -np.min(waveform)) <= self.max_voltage:
+            # The waveform is cyclic so filter in the frequency domain. Start with a cut-off
+            # near the Nyquist frequency and halve it until the limits are met.
+            n = np.shape(waveform)[-1]
+            spectrum = np.fft.rfft(waveform)
+            freqs = np.fft.rfftfreq(n)
+            sigma = 0.25
+            for ii in range(self.max_iterations):
+                filtered = np.fft.irfft(spectrum*np.exp(-0.5*(freqs/sigma)**2), n=n)
+                if self.check(filtered, sample_rate, verbose=False):
+                    print('Low-pass filtered waveform to meet galvo limits (cut-off %0.1f Hz)' %
+                          (sigma*sample_rate))
+                    return filtered
+                sigma /= 2
+
+        raise ValueError('Waveform exceeds the galvo limits. Reduce the amplitude or the frequency.')
+    #close limit_waveform
+
+#close class galvoLimiter
@@ -0,0 +1,342 @@
+'''
+ A lazily built image pyramid, and a viewer that draws only what is on screen
+
+ imagePyramid
+
+
+ Description:
+  Handing a 4096 by 4096 frame or a large mosaic to pyqtgraph scales and uploads every
+  pixel on every update, although the screen shows at most a few million of them. An
+  imagePyramid holds the image (level 0) and successively 2x downsampled copies of it
+  (levels 1, 2, ...) down to a level no larger than min_size. Each level is split into
+  tiles of tile_size by tile_size pixels:
+  - update(region) marks the tiles of every downsampled level covering that region of
+    the image as out of date. Nothing is computed.
+  - region(level, ...) returns part of a level, first bringing the tiles it covers up to
+    date from the level below (and so on down to the image), each new pixel being the mean
+    of 2 by 2 pixels. Only tiles that are both out of date and looked at are computed.
+  The downsampled levels are float32. A level is half the size of the one below rounded
+  down, so the last row or column of an odd sized level is not shown at coarser levels.
+
+  The image is held by reference, not copied. Write into it (e.g. paste a tile into a
+  mosaic) and then call update with the region written. update may be called from any
+  thread: tiles are marked out of date before they are recomputed, so a region written
+  while it is being read is computed again on the next look.
+
+  A pyramidViewer shows an imagePyramid in a pan and zoom view. When the view changes or
+  the image is updated it picks the level whose pixels are closest to, without being
+  smaller than, the screen's pixels and draws only the part of that level in view, plus a
+  margin so small pans do not need a redraw. The cost of a redraw therefore depends on the
+  size of the window, not of the image. Levels are fixed (levels) or from percentiles of
+  the part drawn. Qt is imported only when a viewer is made, so imagePyramid can be
+  used and benchmarked headless.
+
+
+  Usage:
+  import imagePyramid
+  P = imagePyramid.imagePyramid(big_image)
+  V = imagePyramid.pyramidViewer(P, 'Mosaic')
+  big_image[0:512, 0:512] = tile
+  P.update((0, 512, 0, 512))    # The viewer redraws on its next refresh, if that is in view
+
+  Or, for a sequence of frames of the same size:
+  V = imagePyramid.pyramidViewer()
+  V.set_image(frame)
+
+  tiledScanner shows its mosaic in a pyramidViewer.
+
+'''
+
+import math
+import threading
+import numpy as np
+
+class imagePyramid():
+
+    tile_size = 256         # Side of the square tiles in which levels are brought up to date
+    min_size = 256          # The coarsest level is no larger than this along either axis
+
+    image = []              # Level 0: the full resolution image, held by reference
+    levels = []             # The downsampled levels, levels[0] being the image
+    version = 0             # Incremented by every update
+
+    tiles_computed = 0      # Number of tiles downsampled since this object was created
+
+    _dirty = []             # Boolean array of out of date tiles for each level (None for level 0)
+    _lock = []
+
+
+
+    def __init__(self, image, tile_size=None, min_size=None):
+        if tile_size is not None:
+            self.tile_size = int(tile_size)
+        if min_size is not None:
+            self.min_size = int(min_size)
+        self._lock = threading.Lock()
+        self.set_image(image)
+    #close constructor
+
+
+    def set_image(self, image):
+        '''
+        Use a new image. The levels are re-allocated only if its shape has changed.
+        '''
+        image = np.asarray(image)
+        if image.ndim != 2:
+            raise ValueError('An imagePyramid needs a 2D image, not one of shape %s' % (image.shape,))
+
+        with self._lock:
+            if not self.levels or self.levels[0].shape != image.shape:
+                shapes = [image.shape]
+                while max(shapes[-1]) > self.min_size and min(shapes[-1]) >= 2:
+                    shapes.append((shapes[-1][0]//2, shapes[-1][1]//2))
+                self.levels = [image] + [np.zeros(shape, dtype=np.float32) for shape in shapes[1:]]
+                self._dirty = [None] + [np.ones(self._num_tiles(shape), dtype=bool) for shape in shapes[1:]]
+            else:
+                self.levels[0] = image
+                for dirty in self._dirty[1:]:
+                    dirty[...] = True
+            self.image = image
+            self.version += 1
+    #close set_image
+
+
+    @property
+    def num_levels(self):
+        return len(self.levels)
+
+
+    def _num_tiles(self, shape):
+        return (-(-shape[0] // self.tile_size), -(-shape[1] // self.tile_size))
+    #close _num_tiles
+
+
+    def update(self, region=None):
+        '''
+        Mark region (row start, row stop, column start, column stop) of the image as
+        changed. None means the whole image.
+        '''
+        r0, r1, c0, c1 = self._clip(0, region)
+        with self._lock:
+            for level in range(1, self.num_levels):
+                scale = 2**level
+                t = self.tile_size*scale
+                # Tiles at this level covering image rows r0 to r1 and columns c0 to c1
+                self._dirty[level][r0//t:-(-r1 // t), c0//t:-(-c1 // t)] = True
+            self.version += 1
+    #close update
+
+
+    def _clip(self, level, region):
+        rows, cols = self.levels[level].shape
+        if region is None:
+            return 0, rows, 0, cols
+        r0, r1, c0, c1 = (int(v) for v in region)
+        return max(r0, 0), min(r1, rows), max(c0, 0), min(c1, cols)
+    #close _clip
+
+
+    def region(self, level, region=None):
+        '''
+        Return region (row start, row stop, column start, column stop, in the pixels of
+        that level) of a level, bringing it up to date first. The array returned is part
+        of the level, not a copy.
+        '''
+        r0, r1, c0, c1 = self._clip(level, region)
+        if level > 0 and r1 > r0 and c1 > c0:
+            self._bring_up_to_date(level, r0, r1, c0, c1)
+        return self.levels[level][r0:r1, c0:c1]
+    #close region
+
+
+    def _bring_up_to_date(self, level, r0, r1, c0, c1):
+        t = self.tile_size
+        with self._lock:
+            tiles = self._dirty[level][r0//t:-(-r1 // t), c0//t:-(-c1 // t)]
+            todo = np.argwhere(tiles) + (r0//t, c0//t)
+            tiles[...] = False  # Before computing: a concurrent update marks them again
+
+        rows, cols = self.levels[level].shape
+        for tr, tc in todo:
+            tr0, tc0 = tr*t, tc*t
+            tr1, tc1 = min(tr0 + t, rows), min(tc0 + t, cols)
+            below = self.region(level-1, (2*tr0, 2*tr1, 2*tc0, 2*tc1))
+            self._downsample(below, self.levels[level][tr0:tr1, tc0:tc1])
+            self.tiles_computed += 1
+    #close _bring_up_to_date
+
+
+    def _downsample(self, src, out):
+        # Each output pixel is the mean of a 2 by 2 block of src
+        n, m = out.shape
+        np.add(src[0:2*n:2, 0:2*m:2], src[1:2*n:2, 0:2*m:2], out=out, dtype=out.dtype)
+        out += src[0:2*n:2, 1:2*m:2]
+        out += src[1:2*n:2, 1:2*m:2]
+        out *= 0.25
+    #close _downsample
+
+
+    def choose_level(self, image_pixels_per_screen_pixel):
+        '''
+        The coarsest level whose pixels are no larger than the screen's, when each screen
+        pixel covers image_pixels_per_screen_pixel pixels of the image.
+        '''
+        if image_pixels_per_screen_pixel <= 1:
+            return 0
+        return min(int(math.log2(image_pixels_per_screen_pixel)), self.num_levels - 1)
+    #close choose_level
+
+#close class imagePyramid
+
+
+
+class pyramidViewer():
+
+    refresh_interval = 33   # Interval in ms at which updates to the image are checked for
+    margin = 0.25           # Fraction of the view drawn beyond each edge, so small pans are free
+
+    # Intensity levels. If None they are set from these percentiles, measured on every
+    # subsample'th pixel of the part drawn, each time the image changes.
+    levels = None
+    percentiles = (0.5, 99.5)
+    subsample = 4
+
+    pyramid = None          # The imagePyramid shown
+    redraws = 0             # Number of times part of a level was drawn
+
+    _shown = None           # (pyramid version, level, region) currently drawn
+    _current_levels = (0, 1)
+    _app = []
+    _win = []
+    _view = []              # pg.ViewBox
+    _item = []              # pg.ImageItem showing part of one level
+    _timer = []
+
+
+
+    def __init__(self, pyramid=None, title='', size=800):
+        import pyqtgraph as pg
+        from pyqtgraph.Qt import QtCore, QtWidgets
+
+        self._app = pg.mkQApp()
+        self._win = QtWidgets.QMainWindow()
+        self._win.resize(size, size)
+        if title:
+            self._win.setWindowTitle(title)
+        layout = pg.GraphicsLayoutWidget()
+        self._view = layout.addViewBox(lockAspect=True, invertY=True)
+        self._item = pg.ImageItem(axisOrder='row-major')
+        self._view.addItem(self._item)
+        self._win.setCentralWidget(layout)
+        self._win.show()
+
+        self._view.sigRangeChanged.connect(self.refresh)
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(self.refresh_interval)
+
+        if pyramid is not None:
+            self.set_pyramid(pyramid)
+    #close constructor
+
+
+    def set_pyramid(self, pyramid):
+        '''
+        Show an imagePyramid, zoomed out to show all of it
+        '''
+        self.pyramid = pyramid
+        self._shown = None
+        rows, cols = pyramid.image.shape
+        self._view.setRange(xRange=(0, cols), yRange=(0, rows), padding=0)
+        self.refresh()
+    #close set_pyramid
+
+
+    def set_image(self, image):
+        '''
+        Show an image, re-using the current pyramid if the image is the same size
+        '''
+        if self.pyramid is None:
+            self.set_pyramid(imagePyramid(image))
+            return
+        new_shape = self.pyramid.image.shape != np.shape(image)
+        self.pyramid.set_image(image)
+        if new_shape:
+            self.set_pyramid(self.pyramid)
+    #close set_image
+
+
+    def refresh(self):
+        '''
+        Draw the part of the right level that is in view, if it has changed. Runs in the
+        GUI thread.
+        '''
+        if self.pyramid is None:
+            return
+        P = self.pyramid
+        (x0, x1), (y0, y1) = self._view.viewRange()
+        level = P.choose_level(max((x1 - x0)/max(self._view.width(), 1), (y1 - y0)/max(self._view.height(), 1)))
+        region = self._visible_region(level)
+        version = P.version
+        if self._shown is not None and self._shown[:2] == (version, level) and self._contains(self._shown[2], region):
+            return
+
+        # Draw the view plus a margin, in whole tiles so the region changes only when a pan crosses a tile
+        region = self._expand(level, region)
+        data = P.region(level, region)
+        if data.size == 0:
+            return
+        if self._shown is None or self._shown[0] != version:
+            self._update_levels(data)
+
+        r0, r1, c0, c1 = region
+        scale = 2**level
+        self._item.setImage(data, autoLevels=False, levels=self._current_levels)
+        self._item.setRect(c0*scale, r0*scale, (c1 - c0)*scale, (r1 - r0)*scale)
+        self._shown = (version, level, region)
+        self.redraws += 1
+    #close refresh
+
+
+    def _visible_region(self, level):
+        # The part of a level in view, in the pixels of that level
+        (x0, x1), (y0, y1) = self._view.viewRange()
+        scale = 2**level
+        return (int(math.floor(y0/scale)), int(math.ceil(y1/scale)),
+                int(math.floor(x0/scale)), int(math.ceil(x1/scale)))
+    #close _visible_region
+
+
+    def _expand(self, level, region):
+        r0, r1, c0, c1 = region
+        dr, dc = int((r1 - r0)*self.margin), int((c1 - c0)*self.margin)
+        t = self.pyramid.tile_size
+        region = ((r0 - dr)//t*t, -(-(r1 + dr)//t)*t, (c0 - dc)//t*t, -(-(c1 + dc)//t)*t)
+        return self.pyramid._clip(level, region)
+    #close _expand
+
+
+    def _contains(self, outer, inner):
+        # True if the drawn region covers all of the visible part of the level
+        rows, cols = self.pyramid.levels[self._shown[1]].shape
+        r0, r1, c0, c1 = inner
+        inner = (max(r0, 0), min(r1, rows), max(c0, 0), min(c1, cols))
+        return outer[0] <= inner[0] and outer[1] >= inner[1] and outer[2] <= inner[2] and outer[3] >= inner[3]
+    #close _contains
+
+
+    def _update_levels(self, data):
+        if self.levels is not None:
+            self._current_levels = self.levels
+            return
+        low, high = np.percentile(data[::self.subsample, ::self.subsample], self.percentiles)
+        self._current_levels = (float(low), float(max(high, low + np.finfo(np.float32).eps)))
+    #close _update_levels
+
+
+    def close(self):
+        self._timer.stop()
+        self._win.close()
+    #close close
+
+#close class pyramidViewer
@@ -0,0 +1,73 @@
+'''
+ A pyqtgraph image window
+
+ imageWindow
+
+
+ Description:
+  The image window used by basicScanner and the other scanners, split out so that
+  programs that only display frames (e.g. frameViewer) can use it without pulling in
+  the acquisition code.
+
+  image_window gives a full pg.ImageView, with a histogram and level controls.
+  image_item_window gives a bare ImageItem for fast live display of frames that are
+  already scaled to uint8 (see displayPipeline.py).
+
+
+  Usage:
+  import imageWindow
+  app, win, plot = imageWindow.image_window('My images')
+  plot.setImage(im)
+
+  app, win, item = imageWindow.image_item_window('Live')
+  item.setImage(im_uint8, levels=(0, 255))
+
+'''
+
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtWidgets
+
+
+def image_window(title='', size=800):
+    '''
+    Make a window containing a pg.ImageView with the ROI and menu buttons removed.
+    Returns the QApplication, the window and the ImageView.
+    '''
+    app = pg.mkQApp()
+    win = QtWidgets.QMainWindow()
+    win.resize(size,size) # Make window size by size pixels
+    if title:
+        win.setWindowTitle(title)
+    pg.setConfigOptions(antialias=True)
+    plot = pg.ImageView()
+    win.setCentralWidget(plot)
+    win.show()
+
+    # Remove the buttons beneath to histogram
+    plot.ui.roiBtn.hide()
+    plot.ui.menuBtn.hide()
+
+    return app, win, plot
+#close image_window
+
+
+def image_item_window(title='', size=800):
+    '''
+    Make a window containing a single row-major pg.ImageItem in an aspect-locked view, with
+    no histogram to recompute on every frame. Returns the QApplication, the window and the
+    ImageItem.
+    '''
+    app = pg.mkQApp()
+    win = QtWidgets.QMainWindow()
+    win.resize(size,size)
+    if title:
+        win.setWindowTitle(title)
+    layout = pg.GraphicsLayoutWidget()
+    view = layout.addViewBox(lockAspect=True, invertY=True)
+    item = pg.ImageItem(axisOrder='row-major')
+    view.addItem(item)
+    win.setCentralWidget(layout)
+    win.show()
+
+    return app, win, item
+#close image_item_window
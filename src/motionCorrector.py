@@ -0,0 +1,273 @@
+'''
+ Online rigid motion correction using FFT phase correlation
+
+ motionCorrector
+
+
+ Description:
+  Slow drift of the sample smears frame averages. This class registers each incoming
+  frame to a running reference image using phase correlation and shifts it back into
+  register with a sub-pixel Fourier shift. It is designed to sit in the frame stream of
+  basicScanner so that everything downstream (display, averaging, recording) sees
+  corrected frames.
+
+  All the expensive set-up is done once, when the first frame arrives: the apodization
+  window, the frequency grids used to build the shift phase ramps and the reference
+  spectrum are precomputed and stored. Each subsequent frame then costs two forward
+  and two inverse real FFTs plus a handful of in-place array operations, which is
+  comfortably faster than frame rate for 512 x 512 images.
+
+  The whole-pixel shift is the peak of the phase correlation. It is refined to
+  1/upsample_factor of a pixel by evaluating the correlation on a fine grid around that
+  peak with a matrix multiply DFT of the cross-power spectrum (Guizar-Sicairos et al.,
+  Opt. Lett. 33, 156, 2008), which costs far less than upsampling the whole correlation.
+  A parabola through the peak and its neighbours is cheaper still but biased towards
+  whole pixels, by up to 0.3 pixels for the sharp peak of a phase correlation.
+
+  The shift applied to every frame is logged and may be saved to disk.
+
+  Multi-channel frames, channels by rows by columns, are registered on the plane
+  reference_channel and every plane is shifted by the same amount, so the channels stay
+  in register with each other.
+
+
+  Usage:
+  import motionCorrector
+  M = motionCorrector.motionCorrector()
+  corrected = M.correct(frame)   # Call once per frame
+  M.shifts                       # Array of [frame_number, dy, dx, peak] rows
+  M.save_shifts('shifts.csv')
+
+
+  Or from basicScanner:
+  import basicScanner
+  b = basicScanner.basicScanner()
+  b.enable_motion_correction()
+  b.start_acquisition()
+  ...
+  b.motion_corrector.save_shifts('shifts.csv')
+
+'''
+
+import numpy as np
+
+class motionCorrector():
+
+    # The reference is a running average over approximately this many frames.
+    # A larger number gives a less noisy reference but follows slow changes in
+    # the sample more sluggishly.
+    reference_frames = 20
+
+    # Shifts (in pixels) larger than this are deemed to be registration failures.
+    # The frame is then passed through uncorrected and is not added to the reference.
+    max_shift = 32
+
+    # Fraction of each image edge that is tapered by the apodization window
+    window_edge_fraction = 0.1
+
+    # Shifts are measured to 1/upsample_factor of a pixel
+    upsample_factor = 20
+
+    # Plane of multi-channel frames the shift is measured on
+    reference_channel = 0
+
+
+    # Precomputed quantities. These are built when the first frame arrives.
+    frame_shape = []   # Shape of the frames being corrected
+    _window = []       # 2D apodization window
+    _ky = []           # Column vector of angular frequencies along rows
+    _kx = []           # Row vector of angular frequencies along columns
+    _ref_spectrum = [] # Spectrum of the windowed running reference
+    _cross = []        # Preallocated buffer for the normalised cross-power spectrum
+    _ramp = []         # Preallocated buffer for the shift phase ramp
+
+    # Shift log
+    _shift_log = []    # Growable array of [frame_number, dy, dx, peak]
+    _n_logged = 0      # Number of rows of _shift_log that are in use
+    _frame_number = 0  # Counts frames passed to correct
+
+
+
+    def __init__(self, reference_frames=None, max_shift=None):
+        if reference_frames is not None:
+            self.reference_frames = reference_frames
+        if max_shift is not None:
+            self.max_shift = max_shift
+
+        self.reset()
+    #close constructor
+
+
+    def reset(self):
+        '''
+        Discard the reference and the shift log. The next frame becomes the new reference.
+        '''
+        self.frame_shape = []
+        self._ref_spectrum = []
+        self._shift_log = np.zeros((1024, 4))
+        self._n_logged = 0
+        self._frame_number = 0
+    #close reset
+
+
+    def _precompute(self, frame_shape):
+        '''
+        Build the apodization window, frequency grids and work buffers for a given frame shape.
+        '''
+        self.frame_shape = frame_shape
+        rows, cols = frame_shape
+
+        # A Tukey-like window: flat in the middle and tapered with a cosine at the edges.
+        # This stops the image borders dominating the correlation.
+        self._window = np.outer(self._taper(rows), self._taper(cols)).astype(np.float32)
+
+        # Angular frequency grids matching the layout of rfft2 output
+        self._ky = (2*np.pi*np.fft.fftfreq(rows)).reshape(-1, 1).astype(np.float32)
+        self._kx = (2*np.pi*np.fft.rfftfreq(cols)).reshape(1, -1).astype(np.float32)
+
+        spectrum_shape = (rows, cols//2 + 1)
+        self._cross = np.zeros(spectrum_shape, dtype=np.complex64)
+        self._ramp = np.zeros(spectrum_shape, dtype=np.complex64)
+    #close _precompute
+
+
+    def _taper(self, n):
+        # 1D window which is flat apart from a cosine taper at either end
+        taper = np.ones(n)
+        n_edge = max(int(n*self.window_edge_fraction), 1)
+        edge = 0.5 - 0.5*np.cos(np.pi*np.arange(n_edge)/n_edge)
+        taper[:n_edge] = edge
+        taper[-n_edge:] = edge[::-1]
+        return taper
+    #close _taper
+
+
+    def correct(self, frame):
+        '''
+        Register one frame to the running reference and return the shifted (corrected) frame.
+        The measured shift is logged. The returned array is float32 and has the same
+        shape as the input frame: rows by columns, or channels by rows by columns.
+        '''
+        frame = np.asarray(frame, dtype=np.float32)
+        image = frame[self.reference_channel] if frame.ndim == 3 else frame
+
+        if image.shape != self.frame_shape:
+            self._precompute(image.shape)
+            self._ref_spectrum = []
+
+        windowed_spectrum = np.fft.rfft2(image*self._window)
+
+        if len(self._ref_spectrum) == 0:
+            # The first frame defines the reference
+            self._ref_spectrum = windowed_spectrum.astype(np.complex64)
+            self._log_shift(0, 0, 1)
+            return frame
+
+        dy, dx, peak = self._measure_shift(windowed_spectrum)
+
+        if abs(dy) > self.max_shift or abs(dx) > self.max_shift:
+            # Registration failed. Pass the frame through untouched.
+            self._log_shift(np.nan, np.nan, peak)
+            return frame
+
+        # Shift by (-dy,-dx) by multiplying the spectrum by a phase ramp
+        np.multiply(self._ky, dy, out=self._ramp.imag)
+        self._ramp.imag += self._kx*dx
+        self._ramp.real = 0
+        np.exp(self._ramp, out=self._ramp)
+
+        # rfft2 transforms the last two axes, so every plane of a multi-channel frame gets the same shift
+        corrected = np.fft.irfft2(np.fft.rfft2(frame)*self._ramp, s=self.frame_shape).astype(np.float32)
+
+        # Update the running reference with the aligned windowed spectrum. Strictly the
+        # window should be applied after shifting but for small shifts this is negligible
+        # and saves a further FFT.
+        alpha = 1/self.reference_frames
+        windowed_spectrum *= self._ramp
+        self._ref_spectrum *= (1-alpha)
+        self._ref_spectrum += alpha*windowed_spectrum
+
+        self._log_shift(dy, dx, peak)
+        return corrected
+    #close correct
+
+
+    def _measure_shift(self, spectrum):
+        '''
+        Return the (dy,dx) shift of the frame with respect to the reference along with the
+        height of the correlation peak. The shift is refined to sub-pixel precision by
+        upsampling the correlation around its peak.
+        '''
+        np.conjugate(self._ref_spectrum, out=self._cross)
+        self._cross *= spectrum
+        self._cross /= np.abs(self._cross) + 1E-12
+        correlation = np.fft.irfft2(self._cross, s=self.frame_shape)
+
+        rows, cols = self.frame_shape
+        peak_index = np.argmax(correlation)
+        r, c = divmod(peak_index, cols)
+        peak = correlation[r, c]
+
+        # Correlation wraps around: large positive shifts are really negative shifts
+        dy = r - rows if r > rows/2 else r
+        dx = c - cols if c > cols/2 else c
+
+        if self.upsample_factor > 1:
+            dy, dx, peak = self._upsampled_peak(dy, dx, peak)
+        return dy, dx, peak
+    #close _measure_shift
+
+
+    def _upsampled_peak(self, dy, dx, peak):
+        # The peak of the correlation on a grid 1/upsample_factor pixels apart spanning
+        # 1.5 pixels around (dy, dx), evaluated directly from the half spectrum in _cross:
+        # a complex DFT along the rows, then along the columns the real part of a DFT
+        # weighted by 2 for the frequencies whose negative halves rfft2 leaves out
+        rows, cols = self.frame_shape
+        up = self.upsample_factor
+        n = int(np.ceil(1.5*up)) | 1
+        offsets = (np.arange(n) - n//2)/up
+
+        row_kernel = np.exp(1j*np.outer((dy + offsets).astype(np.float32), self._ky[:, 0]))
+        col_kernel = np.exp(1j*np.outer(self._kx[0], (dx + offsets).astype(np.float32)))
+        col_kernel[1:cols - cols//2] *= 2
+
+        fine = (row_kernel @ self._cross @ col_kernel).real/(rows*cols)
+        i, j = divmod(np.argmax(fine), n)
+        if fine[i, j] <= peak:
+            return dy, dx, peak
+        return dy + offsets[i], dx + offsets[j], fine[i, j]
+    #close _upsampled_peak
+
+
+    def _log_shift(self, dy, dx, peak):
+        # Store the shift, doubling the size of the log if it is full
+        if self._n_logged == self._shift_log.shape[0]:
+            self._shift_log = np.concatenate((self._shift_log, np.zeros_like(self._shift_log)))
+
+        self._shift_log[self._n_logged] = (self._frame_number, dy, dx, peak)
+        self._n_logged += 1
+        self._frame_number += 1
+    #close _log_shift
+
+
+    @property
+    def shifts(self):
+        '''
+        Return an array with one row per frame: frame number, dy, dx and the correlation peak height.
+        Failed registrations have NaN shifts.
+        '''
+        return self._shift_log[:self._n_logged]
+    #close shifts
+
+
+    def save_shifts(self, fname):
+        '''
+        Save the shift time series to a CSV file
+        '''
+        np.savetxt(fname, self.shifts, delimiter=',', fmt=['%d', '%0.3f', '%0.3f', '%0.4f'],
+                   header='frame,dy,dx,peak', comments='')
+        print('Saved %d shifts to %s' % (self._n_logged, fname))
+    #close save_shifts
+
+#close class motionCorrector
@@ -0,0 +1,220 @@
+'''
+ Synchronised acquisition from several DAQ devices
+
+ multiDeviceScanner
+
+
+ Description:
+  When one device does not have enough analog inputs, further devices can record more
+  detectors in step with the scan. The device named by dev_name generates the scan
+  waveforms as in basicScanner and is the "master":
+  - its AO sample clock is exported on clock_terminal
+  - its AI start trigger is exported on trigger_terminal
+  Every other device has one AI task whose sample clock is clock_terminal and whose start
+  trigger is trigger_terminal on that device. All devices therefore sample on the same
+  clock edges, starting with the same edge, and sample N on one device is sample N on every
+  other.
+
+  Wiring instructions:
+  - As basicScanner for the master device
+  - Connect clock_terminal (PFI5 by default) of the master to the same terminal of each
+    other device, and likewise trigger_terminal (PFI6). Boards in a PXI chassis or linked by
+    a RTSI cable can use RTSI lines instead.
+  - Detectors to the AI channels listed in input_devices
+
+  The tasks are started in the order that makes this work: the other devices (which
+  wait for the trigger), then the master AO task (which waits for the master's AI start
+  trigger), then the master AI task, which starts everything.
+
+  Each device's samples are read directly into its rows of one preallocated channels by
+  samples array, which is the only copy made. Before each read the devices' read positions
+  are compared so that blocks are merged by sample index: a device that is behind discards
+  samples to catch up, and if one is ahead of the master all of them skip to the next frame. The reconstructionEngine
+  assembles all rows at once into a (channels, rows, columns) frame. last_frame and
+  wait_for_frames return these multi-channel frames and display_channel selects the
+  channel displayed. Motion correction measures the shift on one channel and applies it to
+  all of them.
+
+
+  Usage:
+  import multiDeviceScanner
+  M = multiDeviceScanner.multiDeviceScanner(autoconnect=False)
+  M.input_devices = [('Dev1', 'ai0'), ('Dev2', 'ai0:3')]
+  M.set_up_tasks()
+  M.setup_plot()
+  M.start_acquisition()
+  M.channel_names   # ['Dev1/ai0', 'Dev2/ai0', ...], in the order of the frame planes
+
+  Without hardware:
+  M = multiDeviceScanner.multiDeviceScanner(simulated=True)
+
+'''
+
+import numpy as np
+from basicScanner import basicScanner
+
+class multiDeviceScanner(basicScanner):
+
+    # (device, channels) of each device to record from. The master, dev_name, must be included.
+    input_devices = [('Dev1', 'ai0'), ('Dev2', 'ai0')]
+
+    clock_terminal = 'PFI5'     # Carries the master's AO sample clock to the other devices
+    trigger_terminal = 'PFI6'   # Carries the master's AI start trigger to the other devices
+    display_channel = 0         # Plane of the frame shown on screen
+
+    channel_names = []          # Names of the recorded channels, in order
+    h_tasks_ai_other = []       # AI tasks on the devices other than the master
+
+    _input_tasks = []           # All AI tasks: the master's first
+    _readers = []               # nidaqmx AnalogMultiChannelReader for each AI task
+    _raw = []                   # Preallocated channels x samples array for one frame
+    _raw_rows = []              # The block of _raw rows that each AI task reads into
+
+
+
+    def _set_up_input_task(self):
+        devices = [dev for dev, chans in self.input_devices]
+        if self.dev_name not in devices:
+            raise ValueError('The master device %s must be one of the input_devices' % self.dev_name)
+        n = self.scan_plan.samples_per_frame
+
+        # Share the master's sample clock and start trigger
+        self.h_task_ao.export_signals.samp_clk_output_term = '/%s/%s' % (self.dev_name, self.clock_terminal)
+
+        self.h_tasks_ai_other = []
+        self._input_tasks = []
+        for dev, chans in self.input_devices:
+            if dev == self.dev_name:
+                task = self._daq.Task('simplescannerai')
+                clock_source = '/%s/ao/SampleClock' % dev
+                self.h_task_ai = task
+            else:
+                task = self._daq.Task('simplescannerai_%s' % dev)
+                clock_source = '/%s/%s' % (dev, self.clock_terminal)
+                self.h_tasks_ai_other.append(task)
+
+            task.ai_channels.add_ai_voltage_chan('%s/%s' % (dev, chans))
+            task.timing.cfg_samp_clk_timing(self.ao_sample_rate, source=clock_source, samps_per_chan=n,
+                                            sample_mode=self._daq.constants.AcquisitionType.CONTINUOUS)
+            task.in_stream.input_buf_size = self.scan_plan.input_buf_size
+
+            if task is self.h_task_ai:
+                task.export_signals.start_trig_output_term = '/%s/%s' % (dev, self.trigger_terminal)
+                task.register_every_n_samples_acquired_into_buffer_event(n, self._read_and_display_last_frame)
+            else:
+                task.triggers.start_trigger.cfg_dig_edge_start_trig('/%s/%s' % (dev, self.trigger_terminal))
+
+        # The master reads first so that it is the reference for alignment
+        self._input_tasks = [self.h_task_ai] + self.h_tasks_ai_other
+        self.channel_names = []
+        self._readers = []
+        for task in self._input_tasks:
+            self.channel_names += task.channel_names
+            self._readers.append(self._daq.stream_readers.AnalogMultiChannelReader(task.in_stream))
+
+        self._raw = np.zeros((len(self.channel_names), n))
+        self._raw_rows = []
+        first = 0
+        for task in self._input_tasks:
+            count = len(task.channel_names)
+            self._raw_rows.append(self._raw[first:first+count])
+            first += count
+    #close _set_up_input_task
+
+
+    def _start_tasks(self):
+        for task in self.h_tasks_ai_other:
+            task.start()   # Armed: wait for the master's start trigger
+        super()._start_tasks()
+    #close _start_tasks
+
+
+    def _stop_tasks(self):
+        super()._stop_tasks()
+        for task in self.h_tasks_ai_other:
+            task.stop()
+    #close _stop_tasks
+
+
+    def close_tasks(self):
+        super().close_tasks()
+        for task in self.h_tasks_ai_other:
+            task.close()
+        self.h_tasks_ai_other = []
+    #close close_tasks
+
+
+    def _all_tasks(self):
+        return super()._all_tasks() + self.h_tasks_ai_other
+    #close _all_tasks
+
+
+    def _task_structure(self):
+        # The input tasks are not split into creation and configuration, so any change to
+        # their timing re-creates them
+        structure = super()._task_structure()
+        structure.update(input_devices=[list(d) for d in self.input_devices], clock_terminal=self.clock_terminal,
+                         trigger_terminal=self.trigger_terminal, timing=self._task_timing())
+        return structure
+    #close _task_structure
+
+
+    def _read_raw_block(self):
+        n = self._raw.shape[1]
+        positions = [task.in_stream.curr_read_pos for task in self._input_tasks]
+        first_sample = positions[0]
+        if max(positions) > first_sample:
+            # Another device has read past the master, so the master has skipped samples:
+            # start the frame at the next whole frame all the devices can still provide
+            first_sample += -(-(max(positions) - first_sample) // n) * n
+
+        for task, reader, rows, position in zip(self._input_tasks, self._readers, self._raw_rows, positions):
+            if position < first_sample:
+                print('Re-aligning %s by %d samples' % (task.name, first_sample - position))
+                self._discard_samples(reader, rows, first_sample - position)
+            reader.read_many_sample(rows, number_of_samples_per_channel=n)
+        return first_sample, self._raw
+    #close _read_raw_block
+
+
+    def _discard_samples(self, reader, rows, num_samples):
+        # Read and drop samples, up to a frame at a time, into the rows the task reads into
+        # next. They are contiguous, so the reader fills them in place and nothing is allocated.
+        count, n = rows.shape
+        flat = rows.reshape(-1)
+        while num_samples > 0:
+            chunk = min(num_samples, n)
+            reader.read_many_sample(flat[:count*chunk].reshape(count, chunk), number_of_samples_per_channel=chunk)
+            num_samples -= chunk
+    #close _discard_samples
+
+
+    def _read_and_display_last_frame(self, tTask, event_type, num_samples, callback_data):
+        with self.tracer.span('frame'):
+            _im = self._read_last_frame()
+            if _im is not None:
+                self.display.submit(_im[self.display_channel], self._frame_lease.retain())
+        return 0
+    #close _read_and_display_last_frame
+
+
+    def enable_motion_correction(self, reference_frames=None, reference_channel=None):
+        '''
+        Register each multi-channel frame on one channel, display_channel by default, and
+        shift all the channels by the same amount
+        '''
+        super().enable_motion_correction(reference_frames=reference_frames)
+        self.motion_corrector.reference_channel = self.display_channel if reference_channel is None else reference_channel
+    #close enable_motion_correction
+
+#close class multiDeviceScanner
+
+
+
+if __name__ == '__main__':
+    print('\nRunning demo for multiDeviceScanner\n\n')
+    SCANNER = multiDeviceScanner()
+    SCANNER.start_acquisition()
+    input('press return to stop')
+    SCANNER.stop_acquisition()
+    SCANNER.close_tasks()
@@ -0,0 +1,160 @@
+'''
+ Oversampled acquisition: many AI samples per pixel, integrated into each pixel
+
+ oversampledScanner
+
+
+ Description:
+  basicScanner clocks AI from the AO sample clock, so the PMT is sampled once per pixel
+  and the light arriving between samples is lost. This class instead runs AI from its own
+  sample clock at an integer multiple ("oversample") of the AO rate, by default the highest
+  multiple the device supports, and averages all the AI samples that fall within each pixel.
+  This raises SNR without slowing the scan.
+
+  The two clocks are phase locked because both are divided down from the same timebase
+  and both start on the AI start trigger. The rates are chosen so that:
+    AI rate = timebase / ai_divisor
+    AO rate = AI rate / oversample
+  with ai_divisor and oversample integers, so the AO sample rate may differ slightly from
+  the requested sample_rate. sample_rate is left as requested; the rates in use are
+  reported when the tasks are set up and the AO rate is available as ao_sample_rate.
+
+  To synchronise sampling with a pulsed laser, connect the laser's sync output (divided
+  down if needed so it is within the range of the board's timebase input) to a PFI line
+  and set laser_sync_terminal and laser_rate. Both clocks are then divided from the laser
+  pulses so every AI sample has the same timing relative to a pulse.
+
+  The AI samples of one frame are integrated by the reconstructionEngine with a single
+  np.add.reduceat call over precomputed boundaries: one segment for each run of AO samples
+  that belong to the same pixel (or to the fly-back, which is discarded).
+
+
+  Usage:
+  import oversampledScanner
+  S = oversampledScanner.oversampledScanner()
+  S.start_acquisition()
+
+  With a fixed oversampling factor and a laser sync on PFI8:
+  S = oversampledScanner.oversampledScanner(autoconnect=False)
+  S.oversample = 8
+  S.laser_sync_terminal = 'PFI8'
+  S.laser_rate = 80E6
+  S.set_up_tasks()
+  S.setup_plot()
+
+'''
+
+import math
+import numpy as np
+from basicScanner import basicScanner
+
+class oversampledScanner(basicScanner):
+
+    oversample = None           # AI samples per AO sample. None means as many as possible.
+    timebase_rate = 100E6       # The board's sample clock timebase (100 MHz on X-series)
+    laser_sync_terminal = ''    # e.g. 'PFI8' to use a laser sync signal as the timebase
+    laser_rate = 80E6           # Rate of the signal at laser_sync_terminal
+
+    ai_sample_rate = []         # AI sample rate in use, set by set_up_tasks
+
+    _oversample = 1             # The oversampling factor in use
+    _reader = []                # nidaqmx AnalogSingleChannelReader
+    _data = []                  # Preallocated buffer holding one frame of AI samples
+
+
+
+    def set_up_tasks(self):
+        self._import_daq()
+        self._choose_rates()
+        super().set_up_tasks()
+    #close set_up_tasks
+
+
+    def _set_timebase(self, task):
+        # Before the tasks are committed, so they are committed with this timebase
+        if self.laser_sync_terminal:
+            task.timing.samp_clk_timebase_src = '/%s/%s' % (self.dev_name, self.laser_sync_terminal)
+            task.timing.samp_clk_timebase_rate = self.laser_rate
+    #close _set_timebase
+
+
+    def _configure_output_task(self):
+        super()._configure_output_task()
+        self._set_timebase(self.h_task_ao)
+    #close _configure_output_task
+
+
+    def _choose_rates(self):
+        # Pick integer clock divisors close to the requested AO rate. See the module help.
+        timebase = self.laser_rate if self.laser_sync_terminal else self.timebase_rate
+        max_rate = self._daq.system.Device(self.dev_name).ai_max_single_chan_rate
+
+        ai_divisor = math.ceil(timebase / max_rate)
+        if self.oversample is None:
+            oversample = max(1, round(timebase / (ai_divisor * self.sample_rate)))
+        else:
+            oversample = int(self.oversample)
+            ai_divisor = max(ai_divisor, round(timebase / (oversample * self.sample_rate)))
+
+        self._oversample = oversample
+        self.ai_sample_rate = timebase / ai_divisor
+        self._ao_rate = self.ai_sample_rate / oversample    # sample_rate keeps the requested rate
+
+        print('AI sampling at %0.4g Hz: %d samples per AO sample. AO sample rate %0.6g Hz (requested %0.6g Hz)' %
+              (self.ai_sample_rate, oversample, self._ao_rate, self.sample_rate))
+    #close _choose_rates
+
+
+    def _set_up_input_task(self):
+        n = self.scan_plan.samples_per_frame * self._oversample
+
+        self.h_task_ai = self._daq.Task('simplescannerai')
+        self.h_task_ai.ai_channels.add_ai_voltage_chan('%s/ai0' % self.dev_name)
+
+        # The AI task has its own sample clock. The AO task is still started by the AI start trigger.
+        self.h_task_ai.timing.cfg_samp_clk_timing(self.ai_sample_rate, \
+                                    samps_per_chan=n, \
+                                    sample_mode=self._daq.constants.AcquisitionType.CONTINUOUS)
+        self.h_task_ai.in_stream.input_buf_size = 2*n
+        self.h_task_ai.register_every_n_samples_acquired_into_buffer_event(n, self._read_and_display_last_frame)
+        self._set_timebase(self.h_task_ai)
+
+        self._reader = self._daq.stream_readers.AnalogSingleChannelReader(self.h_task_ai.in_stream)
+        self._data = np.zeros(n)
+    #close _set_up_input_task
+
+
+    def _task_structure(self):
+        # The rates are chosen when the tasks are created, so any change to the timing re-creates them
+        structure = super()._task_structure()
+        structure.update(oversample=self.oversample, timebase_rate=self.timebase_rate,
+                         laser_sync_terminal=self.laser_sync_terminal, laser_rate=self.laser_rate,
+                         timing=self._task_timing())
+        return structure
+    #close _task_structure
+
+
+    def _reconstruction_options(self):
+        options = super()._reconstruction_options()
+        options['oversample'] = self._oversample
+        return options
+    #close _reconstruction_options
+
+
+    def _read_raw_block(self):
+        first_sample = self.h_task_ai.in_stream.curr_read_pos // self._oversample
+        self._reader.read_many_sample(self._data, number_of_samples_per_channel=self._data.shape[0])
+        return first_sample, self._data
+    #close _read_raw_block
+
+#close class oversampledScanner
+
+
+
+if __name__ == '__main__':
+    print('\nRunning demo for oversampledScanner\n\n')
+    SCANNER = oversampledScanner()
+    SCANNER.start_acquisition()
+    input('press return to stop')
+    SCANNER.stop_acquisition()
+    SCANNER.close_tasks()
@@ -0,0 +1,158 @@
+'''
+ Photon counting acquisition built on basicScanner
+
+ photonCountingScanner
+
+
+ Description:
+  For low light imaging the PMT is followed by a discriminator and photons are counted
+  rather than the analog signal being digitised. This class replaces basicScanner's AI
+  task with a counter input task that counts discriminator pulses. The counter is sampled
+  by the AO sample clock, so there is one count per AO sample exactly as there is one
+  AI sample per AO sample in basicScanner.
+
+  The counter returns the cumulative count. Per-sample counts are obtained by differencing
+  consecutive values in uint32 arithmetic, which is correct across the counter wrapping
+  at 2**32 without any special handling. The last count of each frame is carried over to
+  difference the first sample of the next. The counts of all samples in a pixel are summed
+  to give a uint16 (or uint32, see frame_dtype) frame. Reading, differencing and assembly
+  use preallocated buffers so this keeps up at the same pixel rates as the analog path.
+
+  Frames go through the same processing, display and frame hooks (last_frame,
+  wait_for_frames) as analog ones. Raw recordings (see rawRecording.py) hold the counts
+  per sample, after differencing.
+
+  Wiring instructions:
+  - AO0 to your fast scan axis
+  - AO1 to your slow scan axis
+  - Discriminator output to the counter's source terminal (count_terminal, e.g. PFI0)
+
+  As there is no AI task, the AO task is not triggered: the counter is started first and
+  waits for the AO sample clock, which starts with the AO task. The counter is armed by the
+  AO start trigger, so it counts nothing before the scan starts and the first sample holds
+  only the photons of its own sample period.
+
+
+  Usage:
+  import photonCountingScanner
+  P = photonCountingScanner.photonCountingScanner()
+  P.start_acquisition()
+  P.stop_acquisition()
+
+  Without hardware:
+  P = photonCountingScanner.photonCountingScanner(simulated=True)
+
+'''
+
+import numpy as np
+from basicScanner import basicScanner
+
+class photonCountingScanner(basicScanner):
+
+    counter = 'ctr2'         # Counter used to count photons. ctr0 and ctr1 may be used by the clocks.
+    count_terminal = 'PFI0'  # Terminal at which the discriminator pulses arrive
+    frame_dtype = np.uint16  # Data type of the frames. Pixel counts are clipped to its range.
+
+    _reader = []             # nidaqmx CounterReader for fast reads into _cumulative
+    _cumulative = []         # Preallocated buffer of cumulative counts for one frame
+    _counts = []             # Preallocated buffer of per-sample counts for one frame
+    _last_count = np.uint32(0) # Cumulative count at the end of the previous frame
+
+
+    def _set_up_input_task(self):
+        # Count photons on a counter sampled by the AO sample clock
+        self.h_task_ai = self._daq.Task('simplescannerci')
+        chan = self.h_task_ai.ci_channels.add_ci_count_edges_chan('%s/%s' % (self.dev_name, self.counter),
+                                                                  edge=self._daq.constants.Edge.RISING,
+                                                                  initial_count=0)
+        chan.ci_count_edges_term = '/%s/%s' % (self.dev_name, self.count_terminal)
+        self._configure_input_task()
+    #close _set_up_input_task
+
+
+    def _configure_input_task(self):
+        self.h_task_ai.timing.cfg_samp_clk_timing(self.ao_sample_rate, \
+                                    source='/%s/ao/SampleClock' % self.dev_name, \
+                                    samps_per_chan=self.scan_plan.callback_interval, \
+                                    sample_mode=self._daq.constants.AcquisitionType.CONTINUOUS)
+        self.h_task_ai.in_stream.input_buf_size = self.scan_plan.input_buf_size
+
+        self.h_task_ai.register_every_n_samples_acquired_into_buffer_event(self.scan_plan.callback_interval,
+                                                                            self._read_and_display_last_frame)
+
+        self._reader = self._daq.stream_readers.CounterReader(self.h_task_ai.in_stream)
+        self._cumulative = np.zeros(self.scan_plan.samples_per_frame, dtype=np.uint32)
+        self._counts = np.zeros(self.scan_plan.samples_per_frame, dtype=np.uint32)
+    #close _configure_input_task
+
+
+    def _set_up_start_trigger(self):
+        # There is no AI start trigger: the AO task starts the scan (see start_acquisition).
+        # Counting starts with it. Otherwise photons arriving between starting the counter
+        # and the first AO sample would all be counted in the first sample.
+        trigger = self.h_task_ai.triggers.arm_start_trigger
+        trigger.trig_type = self._daq.constants.TriggerType.DIGITAL_EDGE
+        trigger.dig_edge_src = '/%s/ao/StartTrigger' % self.dev_name
+    #close _set_up_start_trigger
+
+
+    def _start_tasks(self):
+        self._last_count = np.uint32(0) # The counter restarts from initial_count
+        self.h_task_ai.start()   # Armed by the AO start trigger, then clocked by the AO sample clock
+        for task in self.h_task_clocks:
+            task.start()         # Armed on the AO start trigger
+        self.h_task_ao.start()
+    #close _start_tasks
+
+
+    def _stop_tasks(self):
+        self.h_task_ao.stop()
+        self.h_task_ai.stop()
+        for task in self.h_task_clocks:
+            task.stop()
+    #close _stop_tasks
+
+
+    def _read_raw_block(self):
+        # The raw block is the number of photons counted in each sample clock period
+        first_sample = self.h_task_ai.in_stream.curr_read_pos
+        n = self._cumulative.shape[0]
+        self._reader.read_many_sample_uint32(self._cumulative, number_of_samples_per_channel=n)
+
+        # Counts per sample. uint32 subtraction wraps, so a counter roll-over gives the right answer.
+        c = self._cumulative
+        np.subtract(c[1:], c[:-1], out=self._counts[1:])
+        np.subtract(c[:1], self._last_count, out=self._counts[:1], dtype=np.uint32)
+        self._last_count = c[-1]
+        return first_sample, self._counts
+    #close _read_raw_block
+
+
+    def _recording_format(self):
+        # Counts are recorded as they are
+        return {'dtype': np.dtype(self.frame_dtype).name, 'scale': 1}
+    #close _recording_format
+
+
+    def _reconstruction_options(self):
+        options = super()._reconstruction_options()
+        options['reduction'] = 'sum'
+        return options
+    #close _reconstruction_options
+
+
+    def _frame_dtype(self, counts):
+        return self.frame_dtype
+    #close _frame_dtype
+
+#close class photonCountingScanner
+
+
+
+if __name__ == '__main__':
+    print('\nRunning demo for photonCountingScanner\n\n')
+    SCANNER = photonCountingScanner()
+    SCANNER.start_acquisition()
+    input('press return to stop')
+    SCANNER.stop_acquisition()
+    SCANNER.close_tasks()
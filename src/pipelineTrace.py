@@ -0,0 +1,224 @@
+'''
+ Timeline tracing of the acquisition pipeline across threads
+
+ pipelineTrace
+
+
+ Description:
+  A frame passes through several threads: the DAQ callback thread reads and assembles it,
+  the display worker converts it, the GUI thread draws it and the recording threads
+  compress and write it. Stalls come from how these interleave, which counters and
+  averages do not show. A pipelineTracer records when each stage began and how long it
+  took, on which thread, so that a whole session can be inspected on a timeline.
+
+  Events go into a preallocated ring buffer holding capacity events: the oldest are
+  overwritten once it is full. Recording an event takes no lock: a slot is claimed with
+  an atomic counter and filled with one tuple. save() writes the events in the Chrome
+  trace event format, which is opened by https://ui.perfetto.dev or chrome://tracing. Each
+  Python thread appears as a track under its thread name. Threads not started from Python, such
+  as the DAQmx callback thread, appear as Dummy-N.
+
+  Stages are instrumented like this:
+    with self.tracer.span('assemble'):
+        ...
+  and single moments, such as a dropped frame, with self.tracer.instant('frame dropped').
+
+  Tracing is off unless enabled. Every component's tracer is then NULL_TRACER, whose
+  span() returns the same do-nothing object every time, so the cost of an instrumented
+  stage is one method call and an empty with block: well under a microsecond.
+
+
+  Usage:
+  b.enable_tracing()            # Traces the scanner, its display and any frame recording
+  b.start_acquisition()
+  ...
+  b.stop_acquisition()
+  b.save_trace('session1.json') # Open in https://ui.perfetto.dev
+  b.disable_tracing()
+
+  Or stand alone:
+  import pipelineTrace
+  T = pipelineTrace.pipelineTracer(capacity=100000)
+  with T.span('my stage'):
+      ...
+  T.save('trace.json')
+
+'''
+
+import itertools
+import json
+import os
+import threading
+import time
+
+class pipelineTracer():
+
+    enabled = True
+    capacity = 0            # Number of events held. Older events are overwritten.
+
+    _events = []            # The ring buffer: (event number, start ns, duration ns or -1, name, thread ident) per slot
+    _next = []              # itertools.count handing out event numbers. next() is atomic.
+    _thread_names = {}      # Thread ident: thread name, for every thread that recorded an event
+    _t0 = 0                 # perf_counter_ns when the tracer was created or cleared
+    _start_time = 0         # time.time() at the same moment
+
+
+
+    def __init__(self, capacity=65536):
+        self.capacity = int(capacity)
+        self.clear()
+    #close constructor
+
+
+    def clear(self):
+        '''
+        Discard all events
+        '''
+        self._events = [None]*self.capacity
+        self._next = itertools.count()
+        self._thread_names = {}
+        self._t0 = time.perf_counter_ns()
+        self._start_time = time.time()
+    #close clear
+
+
+    def span(self, name):
+        '''
+        A context manager recording the time spent in its with block as the event name
+        '''
+        return _span(self, name)
+    #close span
+
+
+    def instant(self, name):
+        '''
+        Record that name happened now
+        '''
+        self._record(name, time.perf_counter_ns(), -1)
+    #close instant
+
+
+    def _record(self, name, start, duration):
+        ident = threading.get_ident()
+        if ident not in self._thread_names:
+            self._thread_names[ident] = threading.current_thread().name
+        number = next(self._next)
+        self._events[number % self.capacity] = (number, start, duration, name, ident)
+    #close _record
+
+
+    @property
+    def num_events(self):
+        # Events recorded since the last clear, including any overwritten: one more than
+        # the highest event number held
+        return max((slot[0] + 1 for slot in self._events if slot is not None), default=0)
+
+
+    def events(self):
+        '''
+        The events held, oldest first, as (name, thread name, start, duration) in seconds
+        from the creation of the tracer. Duration is None for instants. Call this with
+        acquisition stopped: events being recorded while it runs may be missed.
+        '''
+        return [(name, self._thread_names.get(ident, str(ident)), (start - self._t0)/1E9,
+                 None if duration < 0 else duration/1E9)
+                for start, duration, name, ident in self._held()]
+    #close events
+
+
+    def _held(self):
+        # The events in the ring buffer, oldest first, skipping any slot not yet filled
+        return [slot[1:] for slot in sorted(slot for slot in self._events if slot is not None)]
+    #close _held
+
+
+    def to_chrome_trace(self):
+        '''
+        The events as a Chrome trace event format dictionary, times in microseconds
+        '''
+        pid = os.getpid()
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'SimplePyScanner'}}]
+        for ident, name in list(self._thread_names.items()):
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': ident, 'args': {'name': name}})
+
+        for start, duration, name, ident in self._held():
+            event = {'name': name, 'pid': pid, 'tid': ident, 'ts': (start - self._t0)/1E3}
+            if duration < 0:
+                event.update(ph='i', s='t')
+            else:
+                event.update(ph='X', dur=duration/1E3)
+            trace.append(event)
+
+        num_events = self.num_events
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms',
+                'otherData': {'start_time': self._start_time, 'events_recorded': num_events,
+                              'events_lost': max(num_events - self.capacity, 0)}}
+    #close to_chrome_trace
+
+
+    def save(self, fname):
+        '''
+        Write the events to fname as Chrome trace JSON, for https://ui.perfetto.dev or
+        chrome://tracing. Returns the number of events written.
+        '''
+        trace = self.to_chrome_trace()
+        with open(fname, 'w') as f:
+            json.dump(trace, f)
+        num_events = len(trace['traceEvents']) - len(self._thread_names) - 1
+        print('Wrote %d trace events to %s' % (num_events, fname))
+        return num_events
+    #close save
+
+#close class pipelineTracer
+
+
+
+class _span():
+    __slots__ = ('_tracer', '_name', '_start')
+
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self._tracer._record(self._name, self._start, time.perf_counter_ns() - self._start)
+        return False
+
+#close class _span
+
+
+
+class _nullSpan():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+#close class _nullSpan
+
+
+
+class _nullTracer():
+    '''
+    Stands in for a pipelineTracer when tracing is off. Records nothing.
+    '''
+    enabled = False
+    _span = _nullSpan()
+
+    def span(self, name):
+        return self._span
+
+    def instant(self, name):
+        pass
+
+#close class _nullTracer
+
+
+NULL_TRACER = _nullTracer()
@@ -0,0 +1,312 @@
+'''
+ Record raw sample blocks and replay them through the frame processing pipeline
+
+ rawRecording
+
+
+ Description:
+  A rawRecorder writes every raw block a scanner reads from the DAQ, before any
+  processing, so that reconstruction settings (pixel mapping, averaging, motion
+  correction, ...) can be tuned offline on exactly what the hardware produced. It writes
+  two files:
+    fname.raw  a sequence of fixed size records, one per frame: the sample clock count of
+               the block's first sample (int64) followed by the block's samples in the
+               scanner's native data type (float64 volts, uint32 photon counts, ...)
+    fname.npz  the AO waveforms, the sample-to-pixel map, the scan plan parameters, the
+               scanner settings needed to rebuild the same processing, the block shape
+               and data type and the time recording started
+  Records are written in the acquisition callback with a single unbuffered write each,
+  so a recording is readable up to its last complete record even if it is not closed.
+
+  A rawReplay is the other end. configure() sets up a scanner with the recorded settings
+  on the simulated DAQ (see simulatedDAQ.py), so no hardware is needed, then makes itself
+  the scanner's raw_source. replay() calls the scanner's DAQ callback once per recorded
+  block. Everything from the callback onwards runs unchanged: the scanner reads the next
+  block from the recording rather than from the DAQ. Blocks are memory mapped, so nothing
+  is copied before the scanner's own assembly step.
+
+  Replay runs either in real time, with blocks delivered at the rate they were acquired,
+  or as fast as possible, which measures the maximum throughput of the processing
+  pipeline. replay() returns the frames per second and samples per second achieved.
+
+
+  Usage:
+  Record while scanning:
+  b.start_raw_recording('session1')
+  b.stop_raw_recording()
+
+  Replay later, with or without hardware:
+  import basicScanner, rawRecording
+  b = basicScanner.basicScanner(autoconnect=False)
+  R = rawRecording.rawReplay('session1')
+  R.configure(b)
+  b.setup_plot()
+  b.enable_motion_correction()
+  R.replay(realtime=False)   # {'frames': ..., 'frames_per_second': ..., 'samples_per_second': ...}
+  b.set_reconstruction(phase_offset=2)
+  R.replay(realtime=False)   # The same data, reconstructed differently
+
+  R.start(realtime=True)     # Or in a background thread, leaving the GUI responsive
+  R.stop()
+
+  The scanner must be of the same class as the one recorded (R.metadata['scanner']).
+
+'''
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from scanPatterns import pattern_from_spec
+
+
+# Scanner attributes recorded so that replay rebuilds the same processing. Those a
+# scanner does not have are skipped.
+SETTINGS = ('dev_name', 'detector_voltage_range', 'im_size', 'phase_offset', 'pixel_binning',
+            'timebase_rate', 'laser_sync_terminal', 'laser_rate', 'counter', 'count_terminal',
+            'input_devices', 'clock_terminal', 'trigger_terminal', 'display_channel',
+            'frames_per_trial', 'trigger_edge', 'x_feedback_channel', 'y_feedback_channel',
+            'feedback_voltage_range', 'feedback_gain', 'feedback_offset', 'position_source', 'use_flyback')
+
+
+def _file_names(fname):
+    base = fname[:-4] if fname.endswith(('.raw', '.npz')) else fname
+    return base + '.raw', base + '.npz'
+#close _file_names
+
+
+
+class rawRecorder():
+
+    fname = ''              # Path of the .raw file
+    blocks_written = 0
+    bytes_written = 0
+
+    _file = None
+    _scanner = []
+    _lock = []
+    _block_shape = None     # Shape and type of the first block. All others must match.
+    _block_dtype = None
+
+
+
+    def __init__(self, fname, scanner):
+        self.fname, self._meta_fname = _file_names(fname)
+        self._scanner = scanner
+        self._lock = threading.Lock()
+        self._file = open(self.fname, 'wb', buffering=0)
+        self._start_time = time.time()
+    #close constructor
+
+
+    def write(self, first_sample, block):
+        '''
+        Append one raw block. Called by the scanner for every block it reads.
+        '''
+        block = np.ascontiguousarray(block)
+        with self._lock:
+            if self._file is None:
+                return
+            if self._block_shape is None:
+                self._block_shape = block.shape
+                self._block_dtype = block.dtype
+                self._write_metadata()
+            elif block.shape != self._block_shape or block.dtype != self._block_dtype:
+                raise ValueError('Raw block of shape %s %s does not match the recording (%s %s)' %
+                                 (block.shape, block.dtype, self._block_shape, self._block_dtype))
+
+            self._file.write(np.int64(first_sample).tobytes() + memoryview(block).cast('B'))
+            self.blocks_written += 1
+            self.bytes_written += 8 + block.nbytes
+    #close write
+
+
+    def _write_metadata(self):
+        S = self._scanner
+        settings = {name: getattr(S, name) for name in SETTINGS if hasattr(S, name)}
+        if hasattr(S, '_oversample'):
+            settings['oversample'] = S._oversample  # The factor in use, not the requested one
+
+        metadata = {'scanner': type(S).__name__,
+                    'sample_rate': float(S.ao_sample_rate),
+                    'plan_key': S.scan_plan.key,
+                    'plan_parameters': S.scan_plan.parameters,
+                    'settings': settings,
+                    'block_shape': list(self._block_shape),
+                    'block_dtype': self._block_dtype.str,
+                    'start_time': self._start_time}
+        np.savez(self._meta_fname, waveforms=S.scan_plan.waveforms, pixel_index=S.scan_plan.pixel_index,
+                 metadata=json.dumps(metadata, sort_keys=True))
+    #close _write_metadata
+
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        print('Recorded %d raw blocks (%0.1f MB) to %s' % (self.blocks_written, self.bytes_written/1E6, self.fname))
+    #close close
+
+#close class rawRecorder
+
+
+
+class rawReplay():
+
+    realtime = True         # Deliver blocks at the recorded rate. False: as fast as possible.
+
+    metadata = {}           # Everything recorded in the .npz file except the arrays
+    waveforms = []          # The recorded AO waveforms
+    pixel_index = []        # The recorded sample-to-pixel map
+    next_block = 0          # Index of the block read_block returns next
+
+    _records = []           # Memory mapped records: fields first_sample and data
+    _scanner = None
+    _thread = None
+    _stop = []
+    _result = {}
+
+
+
+    def __init__(self, fname):
+        raw_fname, meta_fname = _file_names(fname)
+        with np.load(meta_fname) as f:
+            self.metadata = json.loads(str(f['metadata']))
+            self.waveforms = f['waveforms']
+            self.pixel_index = f['pixel_index']
+
+        record = np.dtype([('first_sample', '<i8'),
+                           ('data', np.dtype(self.metadata['block_dtype']), tuple(self.metadata['block_shape']))])
+        num_records = os.path.getsize(raw_fname) // record.itemsize
+        if num_records > 0:
+            self._records = np.memmap(raw_fname, dtype=record, mode='r', shape=(num_records,))
+        else:
+            self._records = np.zeros(0, dtype=record)
+        self._stop = threading.Event()
+    #close constructor
+
+
+    @property
+    def num_blocks(self):
+        return self._records.shape[0]
+
+
+    def configure(self, scanner):
+        '''
+        Give scanner the recorded settings, create its tasks on the simulated DAQ and make
+        this recording its source of raw blocks. Existing tasks are closed.
+        '''
+        if type(scanner).__name__ != self.metadata['scanner']:
+            print('Warning: recorded with a %s but replaying through a %s' %
+                  (self.metadata['scanner'], type(scanner).__name__))
+
+        if not isinstance(scanner.h_task_ao, list):
+            scanner.stop_acquisition()
+            scanner.close_tasks()
+
+        for name, value in self.metadata['settings'].items():
+            setattr(scanner, name, value)
+
+        parameters = self.metadata['plan_parameters']
+        scanner.scan_pattern = pattern_from_spec(parameters['pattern'])
+        scanner.scan_amplitude = parameters['scan_amplitude']
+        scanner.sample_rate = parameters['sample_rate']
+        for name, value in parameters['galvo'].items():
+            setattr(scanner.galvo_limiter, name, value)
+
+        # Tasks are created on the simulated DAQ but never started
+        scanner.simulated = True
+        scanner._daq = []
+        scanner.set_up_tasks()
+
+        if scanner.scan_plan.key != self.metadata['plan_key'] or \
+                not np.array_equal(scanner.scan_plan.pixel_index, self.pixel_index):
+            print('Warning: the scan plan differs from the recorded one. Check PLAN_VERSION.')
+
+        scanner.raw_source = self
+        self._scanner = scanner
+        self.next_block = 0
+    #close configure
+
+
+    def read_block(self):
+        '''
+        Return the next recorded (first_sample, block). The block is a read-only view of
+        the file. Called by the scanner in place of reading the DAQ.
+        '''
+        if self.next_block >= self.num_blocks:
+            raise IndexError('End of the recording (%d blocks)' % self.num_blocks)
+        record = self._records[self.next_block]
+        self.next_block += 1
+        return int(record['first_sample']), record['data']
+    #close read_block
+
+
+    def replay(self, realtime=None, first_block=0, num_blocks=None):
+        '''
+        Feed blocks to the configured scanner through its DAQ callback. Blocks until done
+        and returns a dict of throughput statistics.
+        '''
+        if self._scanner is None:
+            raise ValueError('Call configure first')
+        if realtime is None:
+            realtime = self.realtime
+        last = self.num_blocks if num_blocks is None else min(self.num_blocks, first_block + num_blocks)
+        first_block = min(first_block, last)
+
+        S = self._scanner
+        n = self.metadata['block_shape'][-1]        # Raw samples per channel in a block
+        samples_per_frame = self.pixel_index.shape[0] # AO samples, the unit of first_sample
+        rate = self.metadata['sample_rate']
+        self.next_block = first_block
+        self._stop.clear()
+
+        if first_block < last:
+            t0_sample = int(self._records[first_block]['first_sample'])
+        t0 = time.perf_counter()
+        for ii in range(first_block, last):
+            if self._stop.is_set():
+                break
+            if realtime:
+                # A block is available once its last sample has been acquired
+                due = t0 + (int(self._records[ii]['first_sample']) - t0_sample + samples_per_frame)/rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            S._read_and_display_last_frame(None, 1, n, None)
+        elapsed = time.perf_counter() - t0
+
+        frames = self.next_block - first_block
+        self._result = {'frames': frames,
+                        'seconds': elapsed,
+                        'frames_per_second': frames/elapsed if elapsed > 0 else 0,
+                        'samples_per_second': frames*n/elapsed if elapsed > 0 else 0}
+        return self._result
+    #close replay
+
+
+    def start(self, realtime=None, first_block=0, num_blocks=None):
+        '''
+        Replay in a background thread
+        '''
+        self.stop()
+        self._thread = threading.Thread(target=self.replay, args=(realtime, first_block, num_blocks),
+                                        daemon=True)
+        self._thread.start()
+    #close start
+
+
+    def stop(self):
+        '''
+        Stop a replay started with start() and return its statistics
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self._result
+    #close stop
+
+#close class rawReplay
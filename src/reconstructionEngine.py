@@ -0,0 +1,311 @@
+'''
+ Turn blocks of raw samples into frames
+
+ reconstructionEngine
+
+
+ Description:
+  Every scanner assembles frames the same way: each raw sample belongs to one pixel (or
+  is discarded) according to the scan plan's pixel index map, and each pixel receives
+  the mean (analog signals) or the sum (photon counts) of its samples. A
+  reconstructionEngine precomputes everything about that mapping once, so that
+  assembling a frame is at most three vectorised passes over preallocated buffers:
+  - gather: only if some pixel's samples are not contiguous (e.g. a line scan that
+    revisits points), a take() puts the samples in pixel order
+  - reduce: only if some pixel has more than one sample, np.add.reduceat sums each run
+    of samples belonging to one pixel
+  - scatter: a take() writes one value per pixel into the frame, followed by a multiply
+    by 1/(samples per pixel) if any pixel has more than one sample or none at all
+  A raster with one sample per pixel therefore costs a single take().
+
+  The mapping is built from:
+  pixel_index   the plan's sample-to-pixel map, which also encodes the line direction
+                (bidirectional rasters simply list the pixels of odd lines backwards)
+                and the fill fraction (samples outside the imaged part of each line are -1)
+  oversample    raw samples per AO sample (see oversampledScanner.py)
+  phase         delay in raw samples between the command signal and the detector signal
+                (e.g. the mirrors lagging the command). Tune this on a bidirectional scan
+                until odd and even lines line up.
+  binning       combine blocks of binning x binning pixels into one
+  reduction     'mean' or 'sum'
+
+  A block may have several channels: a 1D block gives a (rows, cols) frame and a 2D
+  (channels, samples) block gives a (channels, rows, cols) frame.
+
+  If numba is installed a compiled kernel performs the gather, reduce and scale for
+  floating point frames in one pass (use_numba=None picks it automatically). Otherwise,
+  or for integer frames, the numpy path is used. Both give the same result.
+
+  An engine keeps scratch buffers between calls, so use one engine per thread.
+
+
+  Usage:
+  import reconstructionEngine
+  E = reconstructionEngine.reconstructionEngine.from_plan(scanner.scan_plan, phase=3)
+  frame = E.assemble(raw_samples)
+  E.assemble(raw_samples, out=frame)   # Re-use a frame
+
+  Scanners build their engine from their plan. To change it while scanning:
+  b.set_reconstruction(phase_offset=3, pixel_binning=2)
+
+'''
+
+import numpy as np
+
+_numba_kernel = None     # The compiled kernel, or False if numba is not available
+
+
+
+class reconstructionEngine():
+
+    reduction = 'mean'      # Each pixel is the 'mean' or the 'sum' of its samples
+    use_numba = None        # None: use numba if it is installed. True/False: force on/off.
+
+    frame_shape = ()        # (rows, cols) of the output frames
+    num_samples = 0         # Raw samples per channel in each block
+    num_pixels = 0
+    samples_per_pixel = []  # Number of raw samples assigned to each pixel
+
+    _order = None           # Gather indices putting the samples in pixel order. None if they already are.
+    _seg_starts = []        # Start of each run of samples belonging to one pixel, for reduceat
+    _seg_ends = []
+    _reduce = True          # False if no pixel has more than one sample: reduceat is skipped
+    _take_index = []        # For each pixel, the index of its value in the reduced (or raw) samples
+    _scale = None           # 1/samples per pixel (0 if none), or None if every pixel has one sample
+    _unvisited = []         # Pixels that receive no samples
+    _scratch = {}           # Preallocated work buffers, by name
+
+
+
+    def __init__(self, pixel_index, frame_shape, oversample=1, phase=0, binning=1, reduction='mean', use_numba=None):
+        if reduction not in ('mean', 'sum'):
+            raise ValueError("reduction must be 'mean' or 'sum'")
+        self.reduction = reduction
+        self.use_numba = use_numba
+        self._scratch = {}
+
+        pixel = np.repeat(np.asarray(pixel_index, dtype=np.int64), int(oversample))
+        if phase:
+            # The sample acquired at t shows the pixel that was commanded at t - phase
+            pixel = np.roll(pixel, int(phase))
+
+        rows, cols = frame_shape
+        if binning > 1:
+            binning = int(binning)
+            r, c = np.divmod(pixel, cols)
+            rows, cols = rows//binning, cols//binning
+            keep = (pixel >= 0) & (r < rows*binning) & (c < cols*binning)
+            pixel = np.where(keep, (r//binning)*cols + c//binning, -1)
+
+        self.frame_shape = (rows, cols)
+        self.num_pixels = rows*cols
+        self.num_samples = pixel.shape[0]
+        self._prepare(pixel)
+    #close constructor
+
+
+    @classmethod
+    def from_plan(cls, plan, **kwargs):
+        '''
+        Build an engine for a scanPlan (or a compiled scanPattern)
+        '''
+        return cls(plan.pixel_index, plan.frame_shape, **kwargs)
+    #close from_plan
+
+
+    def _prepare(self, pixel):
+        # Split the samples into segments: runs of consecutive samples in the same pixel
+        starts = np.flatnonzero(np.diff(pixel)) + 1
+        starts = np.concatenate(([0], starts))
+        run_pixel = pixel[starts]
+        valid = run_pixel >= 0
+        runs_per_pixel = np.bincount(run_pixel[valid], minlength=self.num_pixels)
+
+        if np.all(runs_per_pixel <= 1):
+            # Every pixel's samples are contiguous: reduce them where they are
+            self._order = None
+            n = self.num_samples
+        else:
+            # Sort the samples by pixel first. The sort is stable so samples stay in time order.
+            samples = np.flatnonzero(pixel >= 0)
+            self._order = samples[np.argsort(pixel[samples], kind='stable')]
+            pixel = pixel[self._order]
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(pixel)) + 1))
+            run_pixel = pixel[starts]
+            valid = run_pixel >= 0
+            n = self._order.shape[0]
+
+        lengths = np.diff(np.append(starts, n))
+        segments = np.flatnonzero(valid)
+        seg_pixel = run_pixel[segments]
+
+        self.samples_per_pixel = np.bincount(seg_pixel, weights=lengths[segments],
+                                             minlength=self.num_pixels).astype(np.int64)
+        visited = self.samples_per_pixel > 0
+        self._unvisited = np.flatnonzero(~visited)
+
+        # Skip the reduction altogether when no pixel has more than one sample
+        self._reduce = bool(np.any(lengths[segments] > 1))
+        self._seg_starts = starts
+        self._seg_ends = starts + lengths
+        self._take_index = np.zeros(self.num_pixels, dtype=np.intp)
+        self._take_index[seg_pixel] = segments if self._reduce else starts[segments]
+
+        if self.reduction == 'mean' and (self._reduce or self._unvisited.shape[0] > 0):
+            self._scale = np.zeros(self.num_pixels)
+            self._scale[visited] = 1/self.samples_per_pixel[visited]
+        else:
+            self._scale = None
+    #close _prepare
+
+
+    @property
+    def fill_fraction(self):
+        '''
+        Fraction of the raw samples that are assigned to a pixel
+        '''
+        return float(self.samples_per_pixel.sum()) / max(self.num_samples, 1)
+    #close fill_fraction
+
+
+    def assemble(self, data, out=None):
+        '''
+        Turn one block of raw samples, of shape (num_samples,) or (channels, num_samples),
+        into a frame of shape frame_shape or (channels,) + frame_shape. The frame is
+        written into out if it is supplied, otherwise a new float64 frame (uint32 for sums
+        of integer samples) is returned. Integer sums are clipped to the range of out.
+        '''
+        data = np.asarray(data)
+        if data.shape[-1] != self.num_samples:
+            raise ValueError('Expected blocks of %d samples per channel, got %d' % (self.num_samples, data.shape[-1]))
+        single = data.ndim == 1
+        data2d = data.reshape(-1, self.num_samples)
+        channels = data2d.shape[0]
+
+        integer_sum = self.reduction == 'sum' and data.dtype.kind in 'ui'
+        if out is None:
+            out = np.empty(((channels,) if not single else ()) + self.frame_shape,
+                           dtype=np.uint32 if integer_sum else np.float64)
+        flat = out.reshape(channels, self.num_pixels)
+        if not np.shares_memory(flat, out):
+            raise ValueError('out must be a contiguous array')
+
+        if not integer_sum and out.dtype == np.float64 and self._numba():
+            _numba_kernel(data2d, self._identity_order() if self._order is None else self._order,
+                          self._seg_starts, self._seg_ends, self._take_index if self._reduce else
+                          self._seg_index(), self._numba_scale(), flat)
+            return out
+
+        # Gather
+        src = data2d
+        if self._order is not None:
+            src = np.take(data2d, self._order, axis=1, out=self._buffer('gathered', (channels, self._order.shape[0]),
+                                                                        data.dtype))
+        # Reduce
+        if self._reduce:
+            acc = (np.uint64 if data.dtype.kind == 'u' else np.int64) if integer_sum else np.float64
+            src = np.add.reduceat(src, self._seg_starts, axis=1, dtype=acc,
+                                  out=self._buffer('sums', (channels, self._seg_starts.shape[0]), acc))
+        elif not integer_sum and src.dtype.kind != 'f':
+            # Integer samples (e.g. unscaled ADC codes) are averaged as floats
+            converted = self._buffer('float', src.shape, np.float64)
+            np.copyto(converted, src)
+            src = converted
+
+        # Scatter into the frame and scale
+        clip = integer_sum and out.dtype.kind in 'ui' and np.iinfo(out.dtype).max < np.iinfo(src.dtype).max
+        if out.dtype == src.dtype and not clip:
+            np.take(src, self._take_index, axis=1, out=flat)
+            values = flat
+        else:
+            values = np.take(src, self._take_index, axis=1,
+                             out=self._buffer('values', (channels, self.num_pixels), src.dtype))
+
+        if self._scale is not None:
+            np.multiply(values, self._scale, out=values, casting='unsafe')
+        elif self._unvisited.shape[0] > 0:
+            values[:, self._unvisited] = 0
+        if clip:
+            np.minimum(values, np.iinfo(out.dtype).max, out=values)
+        if values is not flat:
+            np.copyto(flat, values, casting='unsafe')
+        return out
+    #close assemble
+
+
+    def _buffer(self, name, shape, dtype):
+        buf = self._scratch.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._scratch[name] = buf
+        return buf
+    #close _buffer
+
+
+    # numba support
+    def _numba(self):
+        if self.use_numba is False:
+            return False
+        available = _load_numba_kernel()
+        if self.use_numba and not available:
+            raise ImportError('use_numba is True but numba is not installed')
+        return available
+    #close _numba
+
+
+    def _identity_order(self):
+        if 'identity' not in self._scratch:
+            self._scratch['identity'] = np.arange(self.num_samples, dtype=np.intp)
+        return self._scratch['identity']
+    #close _identity_order
+
+
+    def _seg_index(self):
+        # Without a reduction _take_index points at samples: map it back to segments
+        if 'seg_index' not in self._scratch:
+            self._scratch['seg_index'] = np.searchsorted(self._seg_starts, self._take_index).astype(np.intp)
+        return self._scratch['seg_index']
+    #close _seg_index
+
+
+    def _numba_scale(self):
+        if self._scale is not None:
+            return self._scale
+        if 'ones' not in self._scratch:
+            ones = np.ones(self.num_pixels)
+            ones[self._unvisited] = 0
+            self._scratch['ones'] = ones
+        return self._scratch['ones']
+    #close _numba_scale
+
+#close class reconstructionEngine
+
+
+
+def _load_numba_kernel():
+    '''
+    Compile the numba kernel the first time it is needed. Returns False if numba is not
+    installed.
+    '''
+    global _numba_kernel
+    if _numba_kernel is not None:
+        return _numba_kernel is not False
+    try:
+        import numba
+    except ImportError:
+        _numba_kernel = False
+        return False
+
+    @numba.njit(parallel=True, fastmath=False)
+    def kernel(data, order, seg_starts, seg_ends, pixel_segment, scale, out):
+        for c in range(data.shape[0]):
+            for p in numba.prange(out.shape[1]):
+                s = pixel_segment[p]
+                total = 0.0
+                for k in range(seg_starts[s], seg_ends[s]):
+                    total += data[c, order[k]]
+                out[c, p] = total*scale[p]
+
+    _numba_kernel = kernel
+    return True
+#close _load_numba_kernel
@@ -0,0 +1,246 @@
+'''
+ Detector overload monitor checking every block of samples as it is acquired
+
+ safetyMonitor
+
+
+ Description:
+  PMTs are damaged by too much light: room light reaching the detector, a laser power
+  set too high or a very bright structure held in the beam. The damage builds up over
+  seconds, so the image is the wrong place to notice it: a frame may last a second. A
+  safetyMonitor checks each block of raw samples as soon as it is read, with two
+  vectorised reductions over the block:
+  - the fraction of samples at or beyond saturation_level (the PMT amplifier or the ADC
+    clipping) must not exceed max_saturated_fraction
+  - the mean level must not exceed max_mean_level. None disables this check.
+  Set polarity to -1 if the detector signal goes negative with more light.
+
+  When either limit is exceeded the monitor trips: it calls every function in actions
+  with the reason, in order, on the thread that did the check, e.g. to zero the PMT gain
+  control voltage, close a shutter or stop the scan. An action that raises does not stop
+  the others from running. The monitor stays tripped, and does nothing more, until
+  reset() is called.
+
+  reaction_time is the longest time allowed between a sample being acquired and the
+  actions having run. Blocks last at most half of it (see block_samples), which leaves
+  the other half for the DAQ to deliver the block and the check and actions to run.
+  Blocks must divide the frame evenly and last at least min_block_time. If no length
+  between the two fits the frame, the shortest longer block is used and a warning
+  printed: choose a frame length with more divisors, e.g. a power of 2 samples per line.
+  basicScanner reads the AI buffer in blocks of this length when a monitor is enabled.
+  The simulated DAQ produces samples every simulatedDAQ.block_duration seconds, which
+  bounds the latency that can be reached without hardware.
+
+  Every check records its detection latency: the time between the last sample of the
+  block being acquired (from its sample number and the time acquisition started) and the
+  check finishing. report() summarises these, the cost of the checks and, if it tripped,
+  how long after the offending block the actions had completed. Latencies assume that
+  acquisition runs continuously from start(), so are not meaningful for triggered scans.
+
+
+  Usage:
+  b = basicScanner.basicScanner()
+  b.enable_safety_monitor(max_mean_level=0.5, reaction_time=0.01)
+  b.safety_monitor.actions.insert(0, safetyMonitor.output_action(gain_task, 0))
+  b.start_acquisition()
+  ...
+  b.safety_monitor.report()
+
+  Or stand alone, on blocks from any source:
+  import safetyMonitor
+  M = safetyMonitor.safetyMonitor(saturation_level=0.98, actions=[my_action])
+  M.start(sample_rate)
+  M.check(block, end_sample)    # end_sample: sample number just after the block
+
+  In the simulated microscope, simulatedDAQ.sample.background adds light everywhere.
+
+'''
+
+import time
+import numpy as np
+
+class safetyMonitor():
+
+    saturation_level = 1.0          # Volts at or beyond which a sample is saturated
+    max_saturated_fraction = 0.25   # Trip if more than this fraction of a block is saturated
+    max_mean_level = None           # Trip if the mean of a block exceeds this many volts. None: not checked
+    polarity = 1                    # -1 if more light makes the detector signal more negative
+    reaction_time = 0.01            # Seconds allowed from a sample being acquired to the actions having run
+    min_block_time = 0.001          # Blocks last at least this many seconds, so the DAQ is not read too often
+
+    actions = []                    # Called as action(reason) when the monitor trips
+
+    tripped = False
+    trip_reason = ''
+    trip = {}                       # Sample number and latencies of the trip. See report()
+
+    blocks_checked = 0
+    check_time = 0                  # Total seconds spent in check
+    num_latencies = 4096            # Detection latencies of this many recent blocks are kept
+
+    _latencies = []                 # Ring buffer of detection latencies in seconds
+    _sample_rate = 0
+    _t0 = 0                         # perf_counter when acquisition started
+    _saturated = []                 # Preallocated boolean array for the saturation test
+
+
+
+    def __init__(self, actions=None, **settings):
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise AttributeError('safetyMonitor has no setting %s' % name)
+            setattr(self, name, value)
+        self.actions = [] if actions is None else list(actions)
+        self._latencies = np.zeros(self.num_latencies)
+        self._saturated = np.empty(0, dtype=bool)
+        self.reset()
+    #close constructor
+
+
+    def block_samples(self, samples_per_frame, samples_per_line, sample_rate):
+        '''
+        The number of samples to check at a time: the largest that divides the frame evenly
+        and lasts between min_block_time and half of reaction_time, preferring whole lines.
+        If there is none, the shortest that divides the frame and lasts at least
+        min_block_time.
+        '''
+        target = max(int(self.reaction_time*sample_rate/2), 1)
+        shortest = min(max(int(np.ceil(self.min_block_time*sample_rate)), 1), samples_per_frame)
+        divisors = set()
+        for d in range(1, int(np.sqrt(samples_per_frame)) + 1):
+            if samples_per_frame % d == 0:
+                divisors.update((d, samples_per_frame//d))
+
+        fitting = sorted(d for d in divisors if shortest <= d <= target)
+        if fitting:
+            lines = [d for d in fitting if d % samples_per_line == 0]
+            return (lines or fitting)[-1]
+
+        block = min(d for d in divisors if d >= shortest)
+        print('Safety monitor: blocks of %0.1f ms, the shortest of at least min_block_time that divide a '
+              'frame of %d samples, exceed half of reaction_time (%0.1f ms). Reactions may take longer.' %
+              (1E3*block/sample_rate, samples_per_frame, 1E3*self.reaction_time/2))
+        return block
+    #close block_samples
+
+
+    def start(self, sample_rate):
+        '''
+        Call as acquisition starts: sample n is then taken to be acquired n/sample_rate
+        seconds later
+        '''
+        self._sample_rate = float(sample_rate)
+        self._t0 = time.perf_counter()
+    #close start
+
+
+    def reset(self):
+        '''
+        Re-arm after a trip and clear the statistics
+        '''
+        self.tripped = False
+        self.trip_reason = ''
+        self.trip = {}
+        self.blocks_checked = 0
+        self.check_time = 0
+    #close reset
+
+
+    def check(self, block, end_sample):
+        '''
+        Check a block of raw samples that ends just before sample number end_sample, and
+        trip if it breaks a limit. Returns True if the monitor is tripped.
+        '''
+        if self.tripped:
+            return True
+        t_start = time.perf_counter()
+
+        n = block.size
+        if self._saturated.shape != block.shape:
+            self._saturated = np.empty(block.shape, dtype=bool)
+        if self.polarity < 0:
+            np.less_equal(block, -self.saturation_level, out=self._saturated)
+        else:
+            np.greater_equal(block, self.saturation_level, out=self._saturated)
+        saturated = np.count_nonzero(self._saturated)/n
+        mean = block.mean()*self.polarity
+
+        reason = ''
+        if saturated > self.max_saturated_fraction:
+            reason = '%0.1f%% of samples saturated' % (100*saturated)
+        elif self.max_mean_level is not None and mean > self.max_mean_level:
+            reason = 'mean level %0.3f V' % mean
+
+        t_end = time.perf_counter()
+        acquired = self._t0 + end_sample/self._sample_rate if self._sample_rate else t_start
+        self._latencies[self.blocks_checked % self.num_latencies] = t_end - acquired
+        self.blocks_checked += 1
+        self.check_time += t_end - t_start
+
+        if reason:
+            self._trip(reason, end_sample, acquired, t_end - acquired)
+        return self.tripped
+    #close check
+
+
+    def _trip(self, reason, end_sample, acquired, detection_latency):
+        self.tripped = True
+        self.trip_reason = reason
+        for action in self.actions:
+            try:
+                action(reason)
+            except Exception as err:
+                print('Safety action %r failed: %s' % (action, err))
+        self.trip = {'sample': end_sample, 'reason': reason, 'detection_latency': detection_latency,
+                     'reaction_latency': time.perf_counter() - acquired}
+        print('Safety monitor tripped at sample %d (%s). Actions completed %0.1f ms after acquisition.' %
+              (end_sample, reason, 1E3*self.trip['reaction_latency']))
+    #close _trip
+
+
+    def report(self):
+        '''
+        Print and return the number of blocks checked, the mean cost of a check in
+        microseconds, the detection latency (mean, 99th percentile and maximum, in ms), the
+        worst case reaction time (a block's duration plus the longest detection latency)
+        and, if tripped, the time from the end of the offending block to its actions having
+        run.
+        '''
+        latencies = self._latencies[:min(self.blocks_checked, self.num_latencies)]*1E3
+        stats = {'blocks_checked': self.blocks_checked,
+                 'check_us': 1E6*self.check_time/max(self.blocks_checked, 1),
+                 'latency_ms_mean': float(latencies.mean()) if latencies.size else float('nan'),
+                 'latency_ms_p99': float(np.percentile(latencies, 99)) if latencies.size else float('nan'),
+                 'latency_ms_max': float(latencies.max()) if latencies.size else float('nan'),
+                 'tripped': self.tripped}
+        if self.tripped:
+            stats['reason'] = self.trip_reason
+            stats['reaction_ms'] = 1E3*self.trip['reaction_latency']
+        if latencies.size and self._sample_rate:
+            stats['worst_case_ms'] = 1E3*self._saturated.size/self._sample_rate + stats['latency_ms_max']
+
+        print('Safety monitor: %d blocks checked at %0.1f us each. Detection latency %0.1f ms mean, '
+              '%0.1f ms 99th percentile, %0.1f ms max.' % (stats['blocks_checked'], stats['check_us'],
+              stats['latency_ms_mean'], stats['latency_ms_p99'], stats['latency_ms_max']))
+        if 'worst_case_ms' in stats:
+            print('Worst case reaction %0.1f ms against a reaction_time of %0.1f ms' %
+                  (stats['worst_case_ms'], 1E3*self.reaction_time))
+        if self.tripped:
+            print('Tripped (%s): actions completed %0.1f ms after acquisition' % (stats['reason'], stats['reaction_ms']))
+        return stats
+    #close report
+
+#close class safetyMonitor
+
+
+
+def output_action(task, value=0):
+    '''
+    An action that writes value to an on demand (software timed) AO or DO task: e.g. one
+    driving a PMT gain control voltage or a shutter. Create the task beforehand so that
+    tripping costs only the write.
+    '''
+    def action(reason):
+        task.write(value)
+    return action
+#close output_action
@@ -0,0 +1,431 @@
+'''
+ Scan patterns: rasters, ROIs, line scans and random-access point scans
+
+ scanPatterns
+
+
+ Description:
+  The fewer samples we spend on parts of the sample we don't care about, the higher the
+  frame rate. This module describes scan patterns as objects which are "compiled" into:
+  - waveforms: a 2 by N array of AO voltages (row 0 is X, the fast axis, row 1 is Y)
+  - pixel_index: a length N integer array giving, for each sample, the flat index of the
+    pixel in the output frame it belongs to. Samples with an index of -1 (e.g. those
+    acquired during the mirror fly-back) are discarded.
+  - frame_shape: the (rows, columns) shape of the assembled frame
+
+  Because the sample to pixel map is computed once, assembling a frame from a block of
+  raw samples is one or two vectorised passes however complicated the scan path (see
+  reconstructionEngine.py).
+
+  All positions are given in normalised units: -1 to +1 spans the full field of view.
+  They are multiplied by the pattern's amplitude (in volts) when compiled.
+
+  The following patterns are available:
+  rasterPattern - rectangular (not necessarily square) rasters and sub-region (ROI) rasters
+  linePattern   - repeated scans along an arbitrary poly-line path (produces a kymograph)
+  pointPattern  - random-access scanning: dwell at a list of points
+
+
+  Usage:
+  import scanPatterns
+  P = scanPatterns.rasterPattern(rows=128, cols=512, amplitude=2)
+  P.compile()
+  P.waveforms.shape
+  frame = P.assemble(raw_samples)
+
+  Scan only a region of a 512 x 512 field of view:
+  P = scanPatterns.rasterPattern(rows=512, cols=512, roi=(100, 200, 50, 450))
+
+  Acquire on both the forward and the return stroke of the fast axis:
+  P = scanPatterns.rasterPattern(rows=512, cols=512, bidirectional=True, flyback_samples=16)
+
+  Use with basicScanner:
+  import basicScanner
+  b = basicScanner.basicScanner()
+  b.set_scan_pattern(scanPatterns.linePattern(path=[(-1,-1), (1,1)], points_per_line=256))
+
+'''
+
+import numpy as np
+from reconstructionEngine import reconstructionEngine
+
+class scanPattern():
+    '''
+    Base class for scan patterns. Subclasses implement _build, which must return the
+    waveforms in normalised units, the pixel index of each sample and the frame shape.
+    '''
+
+    amplitude = 1       # Scale factor (volts) applied to the normalised waveforms
+    samples_per_line = 0  # Number of AO samples in one line of the pattern (used for line clocks)
+
+    waveforms = []      # 2 x N array of AO voltages. Populated by compile
+    pixel_index = []    # Length N array of flat pixel indexes. -1 means "discard"
+    frame_shape = ()    # (rows, columns) of the assembled frame
+
+    _inv_counts = []    # 1/(number of samples per pixel), zero for unvisited pixels
+    _engines = {}       # reconstructionEngine for each reduction, built when first needed
+
+
+    def compile(self):
+        '''
+        Build the waveforms and the sample-to-pixel map. Returns self so calls can be chained.
+        '''
+        waveforms, pixel_index, frame_shape = self._build()
+
+        self.waveforms = waveforms * self.amplitude
+        self.pixel_index = pixel_index.astype(np.int64)
+        self.frame_shape = tuple(frame_shape)
+        self._prepare_assembly()
+        return self
+    #close compile
+
+
+    def _build(self):
+        raise NotImplementedError('%s does not implement _build' % self.__class__.__name__)
+    #close _build
+
+
+    def spec(self):
+        '''
+        Return a dict of plain values (pattern type and constructor arguments, without the
+        amplitude) from which pattern_from_spec can re-create the pattern. Used by
+        scanPlan.py to identify a pattern and by profiles to describe one.
+        '''
+        raise NotImplementedError('%s does not implement spec' % self.__class__.__name__)
+    #close spec
+
+
+    def relax(self):
+        '''
+        Make the pattern gentler on the mirrors by lengthening its turn-arounds. Returns
+        False if the pattern has nothing that can be relaxed. Call compile afterwards.
+        '''
+        return False
+    #close relax
+
+
+    @property
+    def num_samples(self):
+        return self.pixel_index.shape[0]
+    #close num_samples
+
+
+    @property
+    def num_pixels(self):
+        return int(np.prod(self.frame_shape))
+    #close num_pixels
+
+
+    @property
+    def fill_fraction(self):
+        '''
+        Fraction of the samples that are assigned to a pixel: the rest are turn-arounds
+        '''
+        return float(np.mean(self.pixel_index >= 0))
+    #close fill_fraction
+
+
+    def _prepare_assembly(self):
+        counts = np.bincount(self.pixel_index[self.pixel_index >= 0], minlength=self.num_pixels)
+        self._inv_counts = np.zeros(self.num_pixels)
+        self._inv_counts[counts > 0] = 1/counts[counts > 0]
+        self._engines = {}
+    #close _prepare_assembly
+
+
+    def engine(self, reduction='mean'):
+        '''
+        Return the reconstructionEngine used by assemble (or, for reduction='sum', by
+        assemble_counts)
+        '''
+        if reduction not in self._engines:
+            self._engines[reduction] = reconstructionEngine(self.pixel_index, self.frame_shape, reduction=reduction)
+        return self._engines[reduction]
+    #close engine
+
+
+    def assemble(self, data, out=None):
+        '''
+        Turn one frame's worth of raw samples (a 1D array of length num_samples) into a
+        frame of shape frame_shape. Pixels visited by several samples receive the mean.
+        If out is supplied the frame is written into it.
+        '''
+        return self.engine().assemble(np.asarray(data).ravel(), out)
+    #close assemble
+
+
+    def assemble_counts(self, data, out=None):
+        '''
+        As assemble, but each pixel receives the sum of its samples rather than the mean.
+        Used for photon counts. out may be an unsigned integer array (uint32 by default), in
+        which case sums that exceed its range are clipped.
+        '''
+        if out is None:
+            out = np.empty(self.frame_shape, dtype=np.uint32)
+        return self.engine('sum').assemble(np.asarray(data).ravel(), out)
+    #close assemble_counts
+
+#close class scanPattern
+
+
+
+class rasterPattern(scanPattern):
+    '''
+    A rectangular raster. rows and cols define the full field of view in pixels; pixels
+    are square so the Y scan range is amplitude*rows/cols. An optional ROI restricts the
+    scan to a sub-region of the field, keeping the same pixel size:
+        roi = (first_row, last_row, first_col, last_col)  (last_* are exclusive)
+
+    With flyback_samples=0 the X mirror jumps straight back at the end of each line, exactly
+    as in basicScanner. Setting it >0 inserts a smooth turn-around that is discarded from
+    the image.
+
+    If bidirectional is True every other line is scanned from right to left, so there is
+    no fly-back: the turn-around at the end of each line just reverses the X mirror. The
+    pixel map lists the pixels of the return lines backwards, so frames are assembled
+    the right way round. Mirror lag shifts forward and return lines in opposite
+    directions; correct it with the phase of the reconstructionEngine.
+    '''
+
+    def __init__(self, rows=256, cols=256, amplitude=1, roi=None, flyback_samples=0, bidirectional=False):
+        self.rows = rows
+        self.cols = cols
+        self.amplitude = amplitude
+        self.roi = roi
+        self.flyback_samples = flyback_samples
+        self.bidirectional = bidirectional
+    #close constructor
+
+
+    def _build(self):
+        if self.roi is None:
+            r0, r1, c0, c1 = 0, self.rows, 0, self.cols
+        else:
+            r0, r1, c0, c1 = self.roi
+            if not (0 <= r0 < r1 <= self.rows and 0 <= c0 < c1 <= self.cols):
+                raise ValueError('ROI %s lies outside the %d by %d field' % (str(self.roi), self.rows, self.cols))
+
+        n_rows = r1 - r0
+        n_cols = c1 - c0
+        n_fb = self.flyback_samples
+        self.samples_per_line = n_cols + n_fb
+        y_scale = self.rows/self.cols
+
+        # X: one line of the full field, cropped to the ROI
+        x_full = np.linspace(-1, 1, self.cols)
+        x_line = x_full[c0:c1]
+
+        # Y is a continuous ramp over the full field, from +1 (top) to -1 (bottom), exactly
+        # as the basicScanner waveform. We pick out the samples that fall in the ROI.
+        n_full = self.rows*self.cols
+        rr, cc = np.meshgrid(np.arange(r0, r1), np.arange(c0, c1), indexing='ij')
+        y_pixels = y_scale * (1 - 2*(rr*self.cols + cc)/max(n_full-1, 1))
+
+        # Direction of each line: +1 left to right, -1 right to left
+        direction = np.ones(n_rows)
+        if self.bidirectional:
+            direction[1::2] = -1
+        reverse = direction < 0
+
+        x = np.empty((n_rows, n_cols + n_fb))
+        y = np.empty((n_rows, n_cols + n_fb))
+        x[:, :n_cols] = x_line
+        x[reverse, :n_cols] = x_line[::-1]
+        y[:, :n_cols] = y_pixels
+
+        if n_fb > 0:
+            # X moves to the start of the next line and Y to its first pixel along cubics
+            # that match the scan velocity at both ends.
+            x_slope = x_line[1] - x_line[0] if n_cols > 1 else 0
+            x_next = np.roll(x[:, 0], -1)
+            x[:, n_cols:] = _hermite(x[:, n_cols-1:n_cols], x_next[:, np.newaxis], (direction*x_slope)[:, np.newaxis],
+                                     (np.roll(direction, -1)*x_slope)[:, np.newaxis], n_fb)
+            y_slope = -2*y_scale/max(n_full-1, 1)
+            y_next = np.roll(y_pixels[:, 0], -1)
+            y[:, n_cols:] = _hermite(y_pixels[:, -1:], y_next[:, np.newaxis], y_slope, y_slope, n_fb)
+
+        pixel_index = -np.ones((n_rows, n_cols + n_fb), dtype=np.int64)
+        pixel_index[:, :n_cols] = np.arange(n_rows*n_cols).reshape(n_rows, n_cols)
+        pixel_index[reverse, :n_cols] = pixel_index[reverse, n_cols-1::-1]
+
+        waveforms = np.stack((x.ravel(), y.ravel()))
+        return waveforms, pixel_index.ravel(), (n_rows, n_cols)
+    #close _build
+
+
+    def spec(self):
+        return {'type': 'raster', 'rows': self.rows, 'cols': self.cols,
+                'roi': None if self.roi is None else [int(v) for v in self.roi],
+                'flyback_samples': self.flyback_samples, 'bidirectional': bool(self.bidirectional)}
+    #close spec
+
+
+    def relax(self):
+        self.flyback_samples = max(2*self.flyback_samples, 8)
+        return True
+    #close relax
+
+#close class rasterPattern
+
+
+
+class linePattern(scanPattern):
+    '''
+    Repeatedly scan along a poly-line path. path is a sequence of (x,y) vertices in
+    normalised units. The path is sampled at points_per_line equally spaced points and
+    scanned num_lines times per frame, producing a (num_lines, points_per_line) kymograph.
+    If the path is not closed the mirrors return to its start during flyback_samples
+    samples that are discarded.
+    '''
+
+    def __init__(self, path, points_per_line=256, num_lines=256, amplitude=1, flyback_samples=32):
+        self.path = np.asarray(path, dtype=float)
+        self.points_per_line = points_per_line
+        self.num_lines = num_lines
+        self.amplitude = amplitude
+        self.flyback_samples = flyback_samples
+    #close constructor
+
+
+    def _build(self):
+        if self.path.ndim != 2 or self.path.shape[1] != 2 or self.path.shape[0] < 2:
+            raise ValueError('path must be a sequence of at least two (x,y) vertices')
+
+        # Interpolate evenly along the arc length of the path
+        seg_lengths = np.sqrt((np.diff(self.path, axis=0)**2).sum(axis=1))
+        arc = np.concatenate(([0], np.cumsum(seg_lengths)))
+        s = np.linspace(0, arc[-1], self.points_per_line)
+        line = np.stack((np.interp(s, arc, self.path[:,0]), np.interp(s, arc, self.path[:,1])))
+
+        closed = np.allclose(self.path[0], self.path[-1])
+        n_fb = 0 if closed else self.flyback_samples
+        self.samples_per_line = self.points_per_line + n_fb
+
+        one_line = np.empty((2, self.samples_per_line))
+        one_line[:, :self.points_per_line] = line
+        if n_fb > 0:
+            one_line[:, self.points_per_line:] = _hermite(line[:, -1:], line[:, :1], 0, 0, n_fb)
+
+        line_index = -np.ones(self.samples_per_line, dtype=np.int64)
+        line_index[:self.points_per_line] = np.arange(self.points_per_line)
+
+        waveforms = np.tile(one_line, self.num_lines)
+        pixel_index = (line_index + self.points_per_line*np.arange(self.num_lines).reshape(-1, 1))
+        pixel_index[:, self.points_per_line:] = -1
+
+        return waveforms, pixel_index.ravel(), (self.num_lines, self.points_per_line)
+    #close _build
+
+
+    def spec(self):
+        return {'type': 'line', 'path': self.path.tolist(), 'points_per_line': self.points_per_line,
+                'num_lines': self.num_lines, 'flyback_samples': self.flyback_samples}
+    #close spec
+
+
+    def relax(self):
+        if np.allclose(self.path[0], self.path[-1]):
+            return False
+        self.flyback_samples = max(2*self.flyback_samples, 8)
+        return True
+    #close relax
+
+#close class linePattern
+
+
+
+class pointPattern(scanPattern):
+    '''
+    Random-access scanning. The beam dwells for dwell_samples at each (x,y) point, in
+    normalised units, moving between points over transit_samples samples with zero
+    velocity at either end. The frame is a single row with one pixel per point.
+    '''
+
+    def __init__(self, points, dwell_samples=10, transit_samples=20, amplitude=1):
+        self.points = np.asarray(points, dtype=float)
+        self.dwell_samples = dwell_samples
+        self.transit_samples = transit_samples
+        self.amplitude = amplitude
+    #close constructor
+
+
+    def _build(self):
+        if self.points.ndim != 2 or self.points.shape[1] != 2:
+            raise ValueError('points must be a sequence of (x,y) pairs')
+
+        n_points = self.points.shape[0]
+        n_per_point = self.dwell_samples + self.transit_samples
+        self.samples_per_line = n_points*n_per_point
+
+        start = self.points.T                      # 2 x n_points
+        stop = np.roll(start, -1, axis=1)          # Next point (the last returns to the first)
+
+        segments = np.empty((2, n_points, n_per_point))
+        segments[:, :, :self.dwell_samples] = start[:, :, np.newaxis]
+        if self.transit_samples > 0:
+            segments[:, :, self.dwell_samples:] = _hermite(start[:, :, np.newaxis], stop[:, :, np.newaxis],
+                                                           0, 0, self.transit_samples)
+
+        pixel_index = -np.ones((n_points, n_per_point), dtype=np.int64)
+        pixel_index[:, :self.dwell_samples] = np.arange(n_points).reshape(-1, 1)
+
+        return segments.reshape(2, -1), pixel_index.ravel(), (1, n_points)
+    #close _build
+
+
+    def spec(self):
+        return {'type': 'point', 'points': self.points.tolist(), 'dwell_samples': self.dwell_samples,
+                'transit_samples': self.transit_samples}
+    #close spec
+
+
+    def relax(self):
+        self.transit_samples = max(2*self.transit_samples, 8)
+        return True
+    #close relax
+
+#close class pointPattern
+
+
+
+# Names used for the "type" of a pattern in spec() and in profiles
+PATTERN_TYPES = {'raster': rasterPattern, 'line': linePattern, 'point': pointPattern}
+
+
+
+def pattern_from_spec(spec, amplitude=1):
+    '''
+    Create a pattern from a dict such as those returned by spec() or read from the
+    [pattern] table of a profile, e.g. {'type': 'raster', 'rows': 128, 'cols': 512}
+    '''
+    spec = dict(spec)
+    pattern_type = spec.pop('type', 'raster')
+    if pattern_type not in PATTERN_TYPES:
+        raise ValueError("Unknown pattern type '%s'. Valid types are: %s" %
+                         (pattern_type, ', '.join(PATTERN_TYPES)))
+    try:
+        return PATTERN_TYPES[pattern_type](amplitude=amplitude, **spec)
+    except TypeError as err:
+        raise ValueError('Bad %s pattern specification: %s' % (pattern_type, err)) from None
+#close pattern_from_spec
+
+
+
+def _hermite(p0, p1, m0, m1, n):
+    '''
+    Evaluate n interior points of a cubic Hermite spline running from p0 to p1 with
+    slopes m0 and m1 (in units per sample). Inputs broadcast against each other and the
+    samples run along a new last axis.
+    '''
+    n_intervals = n + 1
+    t = np.arange(1, n_intervals)/n_intervals
+    t2 = t*t
+    t3 = t2*t
+    h00 = 2*t3 - 3*t2 + 1
+    h10 = t3 - 2*t2 + t
+    h01 = -2*t3 + 3*t2
+    h11 = t3 - t2
+
+    # Slopes are per sample so scale by the number of samples in the interval
+    return h00*p0 + h10*m0*n_intervals + h01*p1 + h11*m1*n_intervals
+#close _hermite
@@ -0,0 +1,385 @@
+'''
+ Configuration profiles and precomputed scan plans
+
+ scanPlan
+
+
+ Description:
+  Scan parameters may be collected in a profile: a TOML file describing one of your
+  standard imaging modes. Profiles live in the "profiles" directory next to this file
+  (or anywhere else if you give a path). For example, profiles/standard_256.toml:
+
+    [scanner]
+    dev_name = "Dev1"
+    sample_rate = 96000
+    scan_amplitude = 1
+
+    [pattern]
+    type = "raster"
+    rows = 256
+    cols = 256
+
+  Sections:
+  [scanner]          attributes of basicScanner (dev_name, sample_rate, scan_amplitude,
+                     detector_voltage_range, im_size, export_clocks, line_clock_terminal,
+                     frame_clock_terminal)
+  [pattern]          a scan pattern: "type" is raster, line or point and the remaining keys
+                     are the arguments of the pattern class in scanPatterns.py
+  [galvo]            overrides of the galvoLimiter mirror model (max_velocity, max_acceleration,
+                     max_voltage, action)
+  [waveformTester]   attributes of waveformTester (dev_name, sample_rate, waveform_type,
+                     galvo_amplitude, pixels_per_line, num_reps_per_acq)
+
+  Unknown sections and keys are rejected so that typos do not silently fall back to defaults.
+
+  A scan plan is everything derived from the parameters before acquisition starts: the AO
+  waveforms (already checked by the galvo limiter), the sample-to-pixel map, the buffer
+  size and the callback interval. Plans are immutable and are identified by a hash of the
+  parameters that produced them. get_plan compiles a plan only the first time a given set
+  of parameters is seen. After that it comes from memory or from an .npz file in cache_dir,
+  so switching between imaging modes, or starting up in one, does not regenerate anything.
+  Every scan amplitude is a different plan, so both caches are bounded: the max_plans
+  most recently used plans are kept in memory and the max_cache_files most recently used
+  files on disk. Older ones are dropped and would simply be compiled again. Once a plan's
+  waveforms have been converted to the AO's int16 codes (see codes), the plan keeps only
+  the codes, a quarter of the size of the float64 waveforms.
+
+  The cache is not invalidated if the pattern code changes: bump PLAN_VERSION when it does,
+  or call clear_cache().
+
+
+  Usage:
+  import basicScanner
+  b = basicScanner.basicScanner(profile='standard_256')
+  b.load_profile('fast_128')    # Switch mode while scanning
+
+  Without a scanner:
+  import scanPlan
+  plan = scanPlan.get_plan(scanPlan.plan_parameters(pattern_spec, 1, 96E3, limiter))
+  plan.waveforms, plan.pixel_index, plan.input_buf_size
+  plan.codes(scaling)     # The waveforms as int16 AO codes, cached with the plan. See aoScaling.py
+
+'''
+
+import os
+import json
+import hashlib
+import weakref
+from collections import OrderedDict
+import numpy as np
+from scanPatterns import scanPattern, pattern_from_spec
+
+
+# Increment this whenever a change to scanPatterns or galvoLimiter alters the waveforms
+# produced from a given set of parameters. Plans cached by older versions are then ignored.
+PLAN_VERSION = 1
+
+profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+cache_dir = os.path.join(os.path.expanduser('~'), '.simplepyscanner', 'plans')
+use_cache = True        # Set to False to always compile plans (e.g. to benchmark compilation)
+max_plans = 32          # Plans kept in memory
+max_cache_files = 256   # Plan files kept in cache_dir
+
+# Keys allowed in each profile section
+PROFILE_KEYS = {
+    'scanner': ('dev_name', 'sample_rate', 'scan_amplitude', 'detector_voltage_range', 'im_size',
+                'export_clocks', 'line_clock_terminal', 'frame_clock_terminal'),
+    'pattern': None,    # Checked by pattern_from_spec
+    'galvo': ('max_velocity', 'max_acceleration', 'max_voltage', 'action'),
+    'waveformTester': ('dev_name', 'sample_rate', 'waveform_type', 'galvo_amplitude',
+                       'pixels_per_line', 'num_reps_per_acq'),
+}
+
+_plans = OrderedDict()  # Plans loaded in this session, by key, least recently used first
+
+
+
+class scanPlan():
+    '''
+    An immutable, compiled scan. Create with get_plan rather than directly.
+    '''
+
+    def __init__(self, key, parameters, waveforms, pixel_index, frame_shape, samples_per_line, inv_counts):
+        waveforms = np.asarray(waveforms, dtype=np.float64)
+        pixel_index = np.asarray(pixel_index, dtype=np.int64)
+        inv_counts = np.asarray(inv_counts, dtype=np.float64)
+        for a in (waveforms, pixel_index, inv_counts):
+            a.flags.writeable = False
+
+        samples_per_frame = pixel_index.shape[0]
+        values = {
+            'key': key,                                     # Hash of the parameters
+            'parameters': parameters,                       # The dict the plan was compiled from
+            'pixel_index': pixel_index,                     # Sample-to-pixel map (-1 discards)
+            'inv_counts': inv_counts,                       # 1/(samples per pixel)
+            'frame_shape': tuple(int(v) for v in frame_shape),
+            'samples_per_line': int(samples_per_line),
+            'samples_per_frame': samples_per_frame,
+            'callback_interval': samples_per_frame,         # AI samples between callbacks (one frame)
+            'input_buf_size': 2*samples_per_frame,          # AI buffer: a multiple of the callback interval
+            'frame_rate': parameters['sample_rate']/samples_per_frame,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_waveforms', waveforms)  # Float waveforms, until they are converted to codes
+        object.__setattr__(self, '_volts', None)           # Weak reference to the float waveforms after that
+        object.__setattr__(self, '_codes', {})             # int16 AO codes of the waveforms, by scaling
+    #close constructor
+
+
+    @property
+    def waveforms(self):
+        '''
+        2 x N AO waveforms in volts. Once the plan has been converted to int16 codes it
+        keeps only those, and the float waveforms are alive only while something else
+        holds them (e.g. the scanner using the plan). If they have been freed they are
+        derived again from the codes: the voltages the DAC produces.
+        '''
+        if self._waveforms is not None:
+            return self._waveforms
+        waveforms = self._volts()
+        if waveforms is None:
+            from aoScaling import codes_to_volts
+            scaling, codes = next(iter(self._codes.items()))
+            waveforms = codes_to_volts(codes, scaling)
+            waveforms.flags.writeable = False
+            object.__setattr__(self, '_volts', weakref.ref(waveforms))
+        return waveforms
+    #close waveforms
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Scan plans are immutable. Change the parameters and call get_plan.')
+    #close __setattr__
+
+
+    def pattern(self):
+        '''
+        Return a pattern object that assembles frames for this plan. Nothing is recomputed:
+        it shares the plan's (read-only) arrays.
+        '''
+        P = scanPattern()
+        P.amplitude = self.parameters['scan_amplitude']
+        P.waveforms = self.waveforms
+        P.pixel_index = self.pixel_index
+        P.frame_shape = self.frame_shape
+        P.samples_per_line = self.samples_per_line
+        P._inv_counts = self.inv_counts
+        P._engines = {}
+        return P
+    #close pattern
+
+
+    def save(self, fname):
+        # Uncompressed so that loading is limited only by disk speed
+        np.savez(fname, waveforms=self.waveforms, pixel_index=self.pixel_index.astype(np.int32),
+                 inv_counts=self.inv_counts, frame_shape=np.array(self.frame_shape),
+                 samples_per_line=self.samples_per_line,
+                 parameters=json.dumps(self.parameters, sort_keys=True))
+    #close save
+
+
+    @classmethod
+    def load(cls, fname, key):
+        with np.load(fname) as f:
+            return cls(key, json.loads(str(f['parameters'])), f['waveforms'], f['pixel_index'],
+                       f['frame_shape'], f['samples_per_line'], f['inv_counts'])
+    #close load
+
+
+
+    def codes(self, scaling):
+        '''
+        The waveforms as int16 AO codes for a device's scaling (see aoScaling.py). They are
+        converted the first time a scaling is seen and then kept with the plan, in place
+        of the float64 waveforms: a quarter of the memory.
+        '''
+        codes = self._codes.get(scaling)
+        if codes is None:
+            from aoScaling import volts_to_codes
+            waveforms = self.waveforms
+            codes = volts_to_codes(waveforms, scaling)
+            codes.flags.writeable = False
+            self._codes[scaling] = codes
+            if self._waveforms is not None:
+                object.__setattr__(self, '_volts', weakref.ref(waveforms))
+                object.__setattr__(self, '_waveforms', None)
+        return codes
+    #close codes
+
+#close class scanPlan
+
+
+
+def read_profile(name):
+    '''
+    Read and validate a profile. name is either the name of a file in profile_dir (without
+    the .toml extension) or a path to a TOML file. Returns a dict of sections.
+    '''
+    fname = name
+    if not os.path.isfile(fname):
+        fname = os.path.join(profile_dir, name + '.toml')
+    if not os.path.isfile(fname):
+        raise ValueError("Profile '%s' not found. Available profiles: %s" %
+                         (name, ', '.join(list_profiles())))
+
+    # TOML support is part of the standard library from Python 3.11. Before that, profiles
+    # need the tomli package, but nothing else in this module does.
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ValueError('Reading profiles needs Python 3.11 or later, or the tomli package') from None
+
+    with open(fname, 'rb') as f:
+        try:
+            profile = tomllib.load(f)
+        except tomllib.TOMLDecodeError as err:
+            raise ValueError('Could not parse profile %s: %s' % (fname, err)) from None
+
+    for section, values in profile.items():
+        if section not in PROFILE_KEYS or not isinstance(values, dict):
+            raise ValueError("Unknown section [%s] in profile %s. Valid sections are: %s" %
+                             (section, fname, ', '.join(PROFILE_KEYS)))
+        allowed = PROFILE_KEYS[section]
+        if allowed is None:
+            continue
+        for key in values:
+            if key not in allowed:
+                raise ValueError("Unknown key '%s' in section [%s] of profile %s. Valid keys are: %s" %
+                                 (key, section, fname, ', '.join(allowed)))
+
+    if 'pattern' in profile:
+        # Fail now, rather than when scanning starts, if the pattern is malformed
+        pattern_from_spec(profile['pattern'])
+
+    return profile
+#close read_profile
+
+
+def list_profiles():
+    '''
+    Return the names of the profiles in profile_dir
+    '''
+    if not os.path.isdir(profile_dir):
+        return []
+    return sorted(f[:-5] for f in os.listdir(profile_dir) if f.endswith('.toml'))
+#close list_profiles
+
+
+def plan_parameters(pattern_spec, scan_amplitude, sample_rate, limiter):
+    '''
+    Collect everything that affects a plan into a dict of plain values
+    '''
+    # Round trip through a pattern object so that equivalent specs (e.g. with and without
+    # default arguments) give the same key
+    pattern_spec = pattern_from_spec(pattern_spec).spec()
+    return {'pattern': pattern_spec,
+            'scan_amplitude': float(scan_amplitude),
+            'sample_rate': float(sample_rate),
+            'galvo': {'max_velocity': float(limiter.max_velocity),
+                      'max_acceleration': float(limiter.max_acceleration),
+                      'max_voltage': float(limiter.max_voltage),
+                      'action': limiter.action}}
+#close plan_parameters
+
+
+def plan_key(parameters):
+    '''
+    Hash of a parameter dict. Identical parameters always give the same key.
+    '''
+    text = json.dumps(parameters, sort_keys=True) + 'v%d' % PLAN_VERSION
+    return hashlib.sha1(text.encode()).hexdigest()
+#close plan_key
+
+
+def get_plan(parameters, limiter=None):
+    '''
+    Return the plan for a dict produced by plan_parameters. The plan is compiled only if
+    it is neither in memory nor in the disk cache.
+    '''
+    key = plan_key(parameters)
+    if use_cache:
+        if key in _plans:
+            _plans.move_to_end(key)
+            return _plans[key]
+        fname = os.path.join(cache_dir, key + '.npz')
+        if os.path.isfile(fname):
+            try:
+                plan = scanPlan.load(fname, key)
+                os.utime(fname)     # Most recently used
+            except (OSError, ValueError, KeyError) as err:
+                print('Ignoring unreadable cached plan %s: %s' % (fname, err))
+            else:
+                _remember(key, plan)
+                return plan
+
+    plan = compile_plan(parameters, limiter)
+
+    if use_cache:
+        _remember(key, plan)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            plan.save(os.path.join(cache_dir, key + '.npz'))
+            _prune_cache_dir()
+        except OSError as err:
+            print('Could not cache scan plan: %s' % err)
+    return plan
+#close get_plan
+
+
+def _remember(key, plan):
+    # Keep a plan in memory, forgetting the least recently used beyond max_plans
+    _plans[key] = plan
+    while len(_plans) > max(max_plans, 1):
+        _plans.popitem(last=False)
+#close _remember
+
+
+def _prune_cache_dir():
+    # Delete the least recently used plan files beyond max_cache_files
+    files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.npz')]
+    if len(files) <= max_cache_files:
+        return
+    files.sort(key=os.path.getmtime)
+    for fname in files[:len(files) - max_cache_files]:
+        try:
+            os.remove(fname)
+        except OSError:
+            pass    # Removed by another process
+#close _prune_cache_dir
+
+
+def compile_plan(parameters, limiter=None):
+    '''
+    Build a plan from scratch: compile the pattern and check it against the galvo limits.
+    '''
+    if limiter is None:
+        from galvoLimiter import galvoLimiter
+        limiter = galvoLimiter(action=parameters['galvo']['action'])
+        for name, value in parameters['galvo'].items():
+            setattr(limiter, name, value)
+    for name, value in parameters['galvo'].items():
+        if getattr(limiter, name) != value:
+            raise ValueError('The galvo limiter does not match the plan parameters (%s)' % name)
+
+    pattern = pattern_from_spec(parameters['pattern'], amplitude=parameters['scan_amplitude'])
+    limiter.limit_pattern(pattern, parameters['sample_rate'])
+    return scanPlan(plan_key(parameters), parameters, pattern.waveforms, pattern.pixel_index,
+                    pattern.frame_shape, pattern.samples_per_line, pattern._inv_counts)
+#close compile_plan
+
+
+def clear_cache():
+    '''
+    Forget all plans, in memory and on disk
+    '''
+    _plans.clear()
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        if f.endswith('.npz'):
+            os.remove(os.path.join(cache_dir, f))
+#close clear_cache
@@ -0,0 +1,987 @@
+'''
+ A simulated NI DAQmx device for running the scanners without hardware
+
+ simulatedDAQ
+
+
+ Description:
+  This module mimics the parts of the nidaqmx API that are used in this repository:
+  Task objects with AI and AO voltage channels, counter pulse outputs, sample clock timing,
+  digital edge start triggers, input and output streams and "every N samples" callbacks. It can therefore
+  be used in place of nidaqmx to develop, test and benchmark the scanning software on
+  a machine with no NI hardware or drivers.
+
+  The simulation works like this:
+  - An AO task that is started (directly, or by its start trigger) runs a clock thread
+    which plays out the written waveform cyclically, as with regeneration on a real board.
+  - AI tasks whose sample clock is the AO sample clock of the same device acquire one
+    sample per AO sample. Each AI channel is "wired" to a signal:
+      'sample'     - a simulated specimen imaged at the current beam position (default for ai0)
+      'x_feedback' - the X mirror position signal (default for ai1)
+      'y_feedback' - the Y mirror position signal (default for ai2)
+      'ao0', 'ao1' - a copy of an AO command signal
+      'ctr0', ...  - the output of a counter pulse task (0 or 5 V), to record clock outputs
+      'noise'      - noise only (default for other channels)
+  - Counter input tasks counting edges (add_ci_count_edges_chan) count photons from the
+    specimen at the current beam position: on average photons_per_volt photons per sample
+    for each volt of 'sample' signal. They are clocked like AI tasks and, like the real
+    thing, return the cumulative count as uint32, wrapping at 2**32.
+  - Counter output tasks generate pulse trains in ticks of a source terminal, such as the
+    AO sample clock. They are evaluated on demand so they have no thread of their own.
+  - The mirrors are modelled as a first order low-pass filter with time constant
+    mirror_time_constant. Because the AO waveform is cyclic, the steady state mirror
+    position is computed once, in the frequency domain, when the waveform is written.
+  - An AI task with its own (onboard) sample clock runs its own clock thread. If its device
+    has an AO task with a waveform, the beam positions are taken from that task's waveform
+    in proportion to the two sample rates, i.e. the clocks are perfectly phase locked as
+    they are on a real board when both are divided down from the same timebase.
+  - Several devices may be used at once. Signals exported to a PFI terminal (a sample clock
+    via export_signals.samp_clk_output_term or a start trigger via start_trig_output_term)
+    appear on the PFI terminal of the same number on every simulated device, as if the
+    PFI lines of all the boards were wired together.
+  - Callbacks run on the clock thread, just as DAQmx callbacks run on a driver thread.
+  - Tasks with a FINITE sample mode stop after samps_per_chan samples. If their start
+    trigger is retriggerable they re-arm instead and acquire again on the next trigger,
+    appending to the same input buffer. send_trigger('PFI0') simulates an external digital
+    edge, e.g. from a stimulus generator, arriving at a PFI terminal.
+  - Starting a task that has not been committed costs commit_time seconds, which stands
+    in for the driver verifying the task and reserving and committing its resources. A
+    task committed explicitly with control(constants.TaskMode.TASK_COMMIT) pays this once
+    and returns to the committed state when it is stopped. Changing its timing, buffers
+    or callback un-commits it, as on real hardware.
+
+  By default samples are produced in real time. Set simulatedDAQ.realtime = False to
+  produce them as fast as possible, which is useful for benchmarking.
+
+  AO channels report the volts to codes scaling of an ideal 16 bit DAC spanning
+  +/- ao_voltage_range in ao_dev_scaling_coeff, and stream_writers.AnalogUnscaledWriter
+  accepts int16 codes.
+
+  As in nidaqmx, read returns a list for one channel and a list of lists, one per
+  channel, otherwise. The stream_readers stand-ins read straight into numpy arrays.
+
+
+  Usage:
+  import basicScanner
+  b = basicScanner.basicScanner(simulated=True)
+  b.start_acquisition()
+
+  Change what the "microscope" is looking at:
+  import simulatedDAQ
+  simulatedDAQ.sample = simulatedDAQ.simulatedSample(my_image)
+  simulatedDAQ.sample.drift = (0.01, 0)   # Volts per second, to test motion correction
+  simulatedDAQ.sample.background = 2      # Flood the detector, to test the safety monitor
+
+'''
+
+import enum
+import re
+import threading
+import time
+import numpy as np
+
+
+# Module configuration
+realtime = True                 # If False, samples are produced as fast as possible
+mirror_time_constant = 100E-6   # Time constant (s) of the simulated galvo mirrors
+ao_voltage_range = 10           # Full scale of the simulated 16 bit AO DACs: +/- this many volts
+block_duration = 0.01           # The clock thread produces samples in blocks of about this many seconds
+wiring = {}                     # Maps 'Dev1/ai0' style names to signals. See wire()
+photons_per_volt = 2            # Mean photons counted per sample per volt of specimen signal
+ai_max_rate = 2E6               # Maximum single channel AI sample rate of the simulated devices
+commit_time = 0.02              # Time (s) taken to reserve and commit a task's resources
+
+_default_wiring = {'ai0': 'sample', 'ai1': 'x_feedback', 'ai2': 'y_feedback'}
+_tasks = []                     # All tasks that have not been closed
+_tasks_lock = threading.RLock()
+
+
+class constants():
+    '''
+    Stand-ins for the nidaqmx.constants enums used in this repository
+    '''
+    class AcquisitionType(enum.Enum):
+        FINITE = 10178
+        CONTINUOUS = 10123
+
+    class RegenerationMode(enum.Enum):
+        ALLOW_REGENERATION = 10097
+        DONT_ALLOW_REGENERATION = 10158
+
+    class Edge(enum.Enum):
+        RISING = 10280
+        FALLING = 10171
+
+    class Level(enum.Enum):
+        HIGH = 10192
+        LOW = 10214
+
+    class TriggerType(enum.Enum):
+        DIGITAL_EDGE = 10150
+        NONE = 10230
+
+    class CountDirection(enum.Enum):
+        COUNT_UP = 10128
+        COUNT_DOWN = 10124
+
+    class TaskMode(enum.Enum):
+        TASK_START = 0
+        TASK_STOP = 1
+        TASK_VERIFY = 2
+        TASK_COMMIT = 3
+        TASK_RESERVE = 4
+        TASK_UNRESERVE = 5
+        TASK_ABORT = 6
+#close class constants
+
+
+
+class DaqError(Exception):
+    '''
+    Raised where a real device would raise nidaqmx.errors.DaqError
+    '''
+    def __init__(self, message, error_code=-1):
+        super().__init__('%s\nStatus Code: %d' % (message, error_code))
+        self.error_code = error_code
+#close class DaqError
+
+
+
+def wire(dev_name, terminal, signal):
+    '''
+    Connect a simulated AI terminal (e.g. 'ai0') on a device to a signal. See the module
+    help for the available signals.
+    '''
+    wiring['%s/%s' % (dev_name, terminal)] = signal
+#close wire
+
+
+
+class simulatedSample():
+    '''
+    The specimen seen by the simulated microscope. The image spans +/- field_voltage on
+    both scan axes: row 0 is at +field_voltage on Y and column 0 at -field_voltage on X.
+    Away from focal_plane the image is blurred by a Gaussian whose standard deviation, in
+    pixels of the image, is the distance from it divided by depth_of_field.
+    '''
+
+    field_voltage = 2.5   # Volts at the edge of the image
+    noise = 0.02          # Standard deviation of additive noise (V)
+    drift = (0, 0)        # Sample drift in X and Y (V/s)
+    background = 0        # Volts added everywhere, e.g. room light reaching the detector
+    z = 0                 # Position of the focus in microns. See stages.simulatedZStage
+    focal_plane = 0       # z at which the specimen is sharp
+    depth_of_field = 2    # Microns of defocus that blur the image by one pixel
+
+    def __init__(self, image=None):
+        self._image = None if image is None else np.asarray(image, dtype=np.float64)
+        self._rng = np.random.default_rng()
+        self._defocused = {}  # Blurred images by blur in hundredths of a pixel
+    #close constructor
+
+
+    @property
+    def image(self):
+        # The default image is built on first use so importing this module stays fast
+        if self._image is None:
+            self._image = self._default_image()
+        return self._image
+    #close image
+
+
+    def _default_image(self, n=512):
+        # An EM grid with some bright "cells" so there is structure at all scales
+        rng = np.random.default_rng(42)
+        yy, xx = np.mgrid[0:n, 0:n]
+        image = 0.6*(((xx % 64) > 8) & ((yy % 64) > 8))
+        for ii in range(60):
+            cy, cx = rng.integers(0, n, 2)
+            r = rng.integers(3, 12)
+            image += 0.4*np.exp(-((yy-cy)**2 + (xx-cx)**2)/(2*r**2))
+        return image
+    #close _default_image
+
+
+    def _image_at_focus(self):
+        # The image as seen at the current z, blurred by FFT. Cached as a sweep revisits planes.
+        blur = int(round(100*abs(self.z - self.focal_plane)/self.depth_of_field))
+        if blur == 0:
+            return self.image
+        if blur not in self._defocused:
+            if len(self._defocused) > 32:
+                self._defocused.clear()
+            sigma = blur/100
+            rows, cols = self.image.shape
+            fy = np.fft.fftfreq(rows)[:, np.newaxis]
+            fx = np.fft.rfftfreq(cols)[np.newaxis, :]
+            kernel = np.exp(-2*(np.pi*sigma)**2*(fx**2 + fy**2))
+            self._defocused[blur] = np.fft.irfft2(np.fft.rfft2(self.image)*kernel, s=self.image.shape)
+        return self._defocused[blur]
+    #close _image_at_focus
+
+
+    def signal(self, x, y, t=0):
+        '''
+        Return the detector voltage with the beam at positions (x,y) at time t (s)
+        '''
+        image = self._image_at_focus()
+        rows, cols = image.shape
+        x = x - self.drift[0]*t
+        y = y - self.drift[1]*t
+        ix = np.rint((x/self.field_voltage + 1) * 0.5*(cols-1)).astype(np.intp)
+        iy = np.rint((1 - y/self.field_voltage) * 0.5*(rows-1)).astype(np.intp)
+        np.clip(ix, 0, cols-1, out=ix)
+        np.clip(iy, 0, rows-1, out=iy)
+        out = image[iy, ix]
+        if self.background:
+            out += self.background
+        if self.noise > 0:
+            out += self._rng.normal(0, self.noise, out.shape)
+        return out
+    #close signal
+
+#close class simulatedSample
+
+
+sample = simulatedSample()
+
+
+
+def _parse_physical_channels(physical_channel):
+    '''
+    Turn 'Dev1/ai0:2' or 'Dev1/ao0, Dev1/ao1' into ('Dev1', ['ai0', 'ai1', 'ai2'])
+    '''
+    dev_name = None
+    names = []
+    for chan in physical_channel.split(','):
+        chan = chan.strip().lstrip('/')
+        dev, terminal = chan.split('/', 1)
+        dev_name = dev
+        match = re.fullmatch(r'([a-z]+)(\d+)(?::(\d+))?', terminal)
+        if match is None:
+            names.append(terminal)
+            continue
+        prefix, first, last = match.group(1), int(match.group(2)), match.group(3)
+        last = first if last is None else int(last)
+        names.extend('%s%d' % (prefix, ii) for ii in range(first, last+1))
+    return dev_name, names
+#close _parse_physical_channels
+
+
+
+class _channelCollection():
+    def __init__(self, task):
+        self._task = task
+        self.channel_names = []
+
+    def _add(self, physical_channel):
+        dev_name, names = _parse_physical_channels(physical_channel)
+        self._task._dev_name = dev_name
+        self.channel_names.extend(names)
+
+    def add_ai_voltage_chan(self, physical_channel, *args, **kwargs):
+        self._add(physical_channel)
+
+    def add_ao_voltage_chan(self, physical_channel, *args, **kwargs):
+        self._add(physical_channel)
+
+    def add_ci_count_edges_chan(self, counter, name_to_assign_to_channel='', edge=constants.Edge.RISING,
+                                initial_count=0, count_direction=constants.CountDirection.COUNT_UP):
+        self._add(counter)
+        self._task._count = int(initial_count)
+        chan = _ciChannel()
+        return chan
+
+    def add_co_pulse_chan_ticks(self, counter, source_terminal, name_to_assign_to_channel='',
+                                idle_state=constants.Level.LOW, initial_delay=0, low_ticks=100, high_ticks=100):
+        self._add(counter)
+        chan = _coChannel(source_terminal, idle_state, initial_delay, low_ticks, high_ticks)
+        self._task._pulse = chan
+        return chan
+
+    def __len__(self):
+        return len(self.channel_names)
+
+    def __getitem__(self, index):
+        return _aoChannel()
+#close class _channelCollection
+
+
+
+class _aoChannel():
+    @property
+    def ao_dev_scaling_coeff(self):
+        # Volts to DAC codes: an ideal, uncalibrated 16 bit DAC
+        return [0.0, 32767/ao_voltage_range]
+#close class _aoChannel
+
+
+
+class _ciChannel():
+    # A counter input. The terminal is only recorded: photons come from the specimen.
+    ci_count_edges_term = ''
+#close class _ciChannel
+
+
+
+class _coChannel():
+    # A counter pulse output. co_pulse_term is only recorded: there are no real terminals.
+    def __init__(self, source_terminal, idle_state, initial_delay, low_ticks, high_ticks):
+        self.co_pulse_term = ''
+        self.co_pulse_ticks_clk_src = source_terminal
+        self.co_pulse_idle_state = idle_state
+        self.co_pulse_ticks_initial_delay = int(initial_delay)
+        self.co_pulse_low_ticks = int(low_ticks)
+        self.co_pulse_high_ticks = int(high_ticks)
+        if initial_delay < 2 or low_ticks < 2 or high_ticks < 2:
+            raise DaqError('Pulse ticks and initial delay must be at least 2', -200077)
+
+    def level(self, ticks):
+        # Output level (True is high) at the given tick numbers since the task started.
+        # The output idles for initial_delay ticks then repeats high_ticks high, low_ticks low.
+        period = self.co_pulse_high_ticks + self.co_pulse_low_ticks
+        phase = (ticks - self.co_pulse_ticks_initial_delay) % period
+        active = (ticks >= self.co_pulse_ticks_initial_delay) & (phase < self.co_pulse_high_ticks)
+        if self.co_pulse_idle_state == constants.Level.HIGH:
+            return ~active
+        return active
+#close class _coChannel
+
+
+
+class _timing():
+    samp_clk_rate = 1000
+    samp_clk_src = ''
+    samp_clk_timebase_src = ''      # Recorded only: all simulated clocks are locked anyway
+    samp_clk_timebase_rate = 100E6
+    samp_quant_samp_mode = constants.AcquisitionType.FINITE
+    samp_quant_samp_per_chan = 1000
+
+    def __init__(self, task):
+        self._task = task
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=None, samps_per_chan=1000):
+        self._task._committed = False
+        self.samp_clk_rate = rate
+        self.samp_clk_src = source
+        if sample_mode is not None:
+            self.samp_quant_samp_mode = sample_mode
+        self.samp_quant_samp_per_chan = int(samps_per_chan)
+
+    def cfg_implicit_timing(self, sample_mode=None, samps_per_chan=1000):
+        if sample_mode is not None:
+            self.samp_quant_samp_mode = sample_mode
+        self.samp_quant_samp_per_chan = int(samps_per_chan)
+#close class _timing
+
+
+
+class _startTrigger():
+    source = ''
+    retriggerable = False
+
+    def cfg_dig_edge_start_trig(self, trigger_source, trigger_edge=None):
+        self.source = trigger_source
+
+    def disable_start_trig(self):
+        self.source = ''
+#close class _startTrigger
+
+
+
+class _armStartTrigger():
+    # Only recorded: simulated counters count nothing until their sample clock ticks
+    trig_type = constants.TriggerType.NONE
+    dig_edge_src = ''
+    dig_edge_edge = constants.Edge.RISING
+#close class _armStartTrigger
+
+
+
+class _exportSignals():
+    samp_clk_output_term = ''
+    start_trig_output_term = ''
+#close class _exportSignals
+
+
+
+class _triggers():
+    def __init__(self):
+        self.start_trigger = _startTrigger()
+        self.arm_start_trigger = _armStartTrigger()
+#close class _triggers
+
+
+
+class _inStream():
+    def __init__(self, task):
+        self._task = task
+        self._input_buf_size = 0
+
+    @property
+    def input_buf_size(self):
+        if self._input_buf_size > 0:
+            return self._input_buf_size
+        return max(self._task.timing.samp_quant_samp_per_chan, 10000)
+
+    @input_buf_size.setter
+    def input_buf_size(self, value):
+        self._task._committed = False
+        self._input_buf_size = int(value)
+
+    @property
+    def avail_samp_per_chan(self):
+        return self._task._total_acquired - self._task._read_pos
+
+    @property
+    def curr_read_pos(self):
+        return self._task._read_pos
+
+    @property
+    def total_samp_per_chan_acquired(self):
+        return self._task._total_acquired
+#close class _inStream
+
+
+
+class _outStream():
+    regen_mode = constants.RegenerationMode.ALLOW_REGENERATION
+
+    def __init__(self, task):
+        self._task = task
+        self._output_buf_size = 0
+
+    @property
+    def output_buf_size(self):
+        if self._output_buf_size > 0:
+            return self._output_buf_size
+        return self._task._command.shape[1] if len(self._task._command) else 0
+
+    @output_buf_size.setter
+    def output_buf_size(self, value):
+        self._task._committed = False
+        self._output_buf_size = int(value)
+#close class _outStream
+
+
+
+class Task():
+    '''
+    A simulated DAQmx task. See the module help.
+    '''
+
+    def __init__(self, new_task_name=''):
+        self.name = new_task_name
+        self.ai_channels = _channelCollection(self)
+        self.ao_channels = _channelCollection(self)
+        self.co_channels = _channelCollection(self)
+        self.ci_channels = _channelCollection(self)
+        self.timing = _timing(self)
+        self.triggers = _triggers()
+        self.export_signals = _exportSignals()
+        self.in_stream = _inStream(self)
+        self.out_stream = _outStream(self)
+
+        self._dev_name = ''
+        self._state = 'idle'          # 'idle', 'armed' (waiting for trigger) or 'running'
+        self._command = []            # AO: channels x samples command waveform
+        self._actual = []             # AO: steady state mirror positions
+        self._buffer = []             # AI: channels x input_buf_size ring buffer
+        self._total_acquired = 0
+        self._read_pos = 0
+        self._every_n = 0
+        self._callback = None
+        self._next_event = 0
+        self._data_ready = threading.Condition()
+        self._clock_thread = None
+        self._stop_clock = threading.Event()
+        self._n_done = 0              # Clock master: samples generated so far
+        self._pulse = None            # Counter output: the _coChannel
+        self._first_tick = 0          # Counter output: master sample number of the first tick
+        self._count = 0               # Counter input: current cumulative count
+        self._committed = False       # True after control(TASK_COMMIT), until reconfigured
+        self._run_first = 0           # Input: _total_acquired when the task last started running
+
+        with _tasks_lock:
+            _tasks.append(self)
+    #close constructor
+
+
+    @property
+    def channel_names(self):
+        collections = (self.ai_channels, self.ao_channels, self.ci_channels, self.co_channels)
+        return ['%s/%s' % (self._dev_name, name) for c in collections for name in c.channel_names]
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    # Task configuration
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval, callback_method):
+        self._committed = False
+        if callback_method is None:
+            self._every_n = 0
+            self._callback = None
+        else:
+            self._every_n = int(sample_interval)
+            self._callback = callback_method
+    #close register_every_n_samples_acquired_into_buffer_event
+
+
+    def write(self, data, auto_start=False, timeout=10.0):
+        '''
+        Write a waveform to an AO task. data is 1D for one channel, otherwise channels by samples.
+        '''
+        if len(self.ao_channels) == 0:
+            raise DaqError('Task %s has no AO channels to write to' % self.name)
+
+        command = np.array(data, dtype=np.float64, ndmin=2)
+        if command.shape[0] != len(self.ao_channels):
+            raise DaqError('Write data has %d channels but the task has %d' %
+                           (command.shape[0], len(self.ao_channels)), -200524)
+
+        self._command = command
+        self._actual = self._mirror_response(command)
+        return command.shape[1]
+    #close write
+
+
+    def _mirror_response(self, command):
+        # Steady state response of a first order low-pass to the cyclic command waveform
+        n = command.shape[1]
+        freqs = np.fft.rfftfreq(n, 1/self.timing.samp_clk_rate)
+        response = 1/(1 + 2j*np.pi*freqs*mirror_time_constant)
+        return np.fft.irfft(np.fft.rfft(command, axis=1)*response, n=n, axis=1)
+    #close _mirror_response
+
+
+    # Starting and stopping
+    def control(self, action):
+        if action == constants.TaskMode.TASK_COMMIT:
+            if not self._committed:
+                time.sleep(commit_time)
+                self._committed = True
+        elif action == constants.TaskMode.TASK_UNRESERVE:
+            self._committed = False
+        elif action == constants.TaskMode.TASK_START:
+            self.start()
+        elif action in (constants.TaskMode.TASK_STOP, constants.TaskMode.TASK_ABORT):
+            self.stop()
+    #close control
+
+
+    def start(self):
+        if self._state != 'idle':
+            raise DaqError('Task %s has already been started' % self.name, -200479)
+
+        if not self._committed:
+            time.sleep(commit_time)   # Implicitly committed, and un-committed again by stop
+
+        if self._is_input():
+            self._allocate_buffer()
+
+        if self.triggers.start_trigger.source:
+            self._state = 'armed'
+            return
+
+        self._run()
+    #close start
+
+
+    def _run(self):
+        # Begin acquisition or generation. Fires this task's start trigger.
+        self._state = 'running'
+        self._run_first = self._total_acquired
+
+        if self._pulse is not None:
+            self._first_tick = _clock_position(self._pulse.co_pulse_ticks_clk_src)
+
+        if len(self.ao_channels) > 0:
+            # Before the clock starts, so tasks triggered by this see its first tick
+            _fire_trigger('/%s/ao/StartTrigger' % self._dev_name)
+
+        if self._is_clock_master():
+            self._n_done = 0
+            self._stop_clock.clear()
+            self._clock_thread = threading.Thread(target=self._clock_loop, name='%s clock' % self.name, daemon=True)
+            self._clock_thread.start()
+
+        if len(self.ai_channels) > 0:
+            # Exported first so that tasks on other devices are running before a clock starts
+            if self.export_signals.start_trig_output_term:
+                _fire_trigger(self.export_signals.start_trig_output_term)
+            _fire_trigger('/%s/ai/StartTrigger' % self._dev_name)
+    #close _run
+
+
+    def stop(self):
+        self._state = 'idle'
+        if self._clock_thread is not None:
+            self._stop_clock.set()
+            if threading.current_thread() is not self._clock_thread:
+                self._clock_thread.join()
+            self._clock_thread = None
+        with self._data_ready:
+            self._data_ready.notify_all()
+    #close stop
+
+
+    def close(self):
+        self.stop()
+        with _tasks_lock:
+            if self in _tasks:
+                _tasks.remove(self)
+    #close close
+
+
+    def is_task_done(self):
+        return self._state == 'idle'
+    #close is_task_done
+
+
+    # Reading
+    def read(self, number_of_samples_per_channel=1, timeout=10.0):
+        data = self._read_array(number_of_samples_per_channel, timeout)
+        if data.shape[0] == 1:
+            return data[0].tolist()
+        return data.tolist()
+    #close read
+
+
+    def _read_array(self, number_of_samples_per_channel, timeout):
+        # The next samples, channels by samples, as used by read and the stream readers
+        n = int(number_of_samples_per_channel)
+        if n > self.in_stream.input_buf_size:
+            raise DaqError('Requested %d samples but the buffer holds only %d' %
+                           (n, self.in_stream.input_buf_size), -200229)
+
+        with self._data_ready:
+            if not self._data_ready.wait_for(lambda: self.in_stream.avail_samp_per_chan >= n or
+                                             self._state == 'idle', timeout):
+                raise DaqError('Timed out waiting for samples', -200284)
+            if self.in_stream.avail_samp_per_chan < n:
+                raise DaqError('Task %s stopped before the samples were acquired' % self.name, -200284)
+
+            if self._total_acquired - self._read_pos > self._buffer.shape[1]:
+                raise DaqError('Samples were overwritten before they could be read. Increase the '
+                               'buffer size or read more frequently', -200279)
+
+            buf_size = self._buffer.shape[1]
+            idx = (self._read_pos + np.arange(n)) % buf_size
+            data = self._buffer[:, idx]
+            self._read_pos += n
+        return data
+    #close _read_array
+
+
+    # Simulation internals
+    def _is_input(self):
+        return len(self.ai_channels) > 0 or len(self.ci_channels) > 0
+    #close _is_input
+
+
+    def _allocate_buffer(self):
+        if len(self.ci_channels) > 0:
+            self._buffer = np.zeros((len(self.ci_channels), self.in_stream.input_buf_size), dtype=np.uint32)
+        else:
+            self._buffer = np.zeros((len(self.ai_channels), self.in_stream.input_buf_size))
+        self._total_acquired = 0
+        self._read_pos = 0
+        self._next_event = self._every_n
+    #close _allocate_buffer
+
+
+    def _is_clock_master(self):
+        # Tasks with an onboard sample clock drive the simulation
+        if self._pulse is not None:
+            return False
+        src = self.timing.samp_clk_src
+        return src is None or src == '' or src.lower() == 'onboardclock'
+    #close _is_clock_master
+
+
+    def _clock_source_name(self):
+        # The terminal at which this task's sample clock appears
+        kind = 'ao' if len(self.ao_channels) > 0 else 'ai'
+        return '/%s/%s/SampleClock' % (self._dev_name, kind)
+    #close _clock_source_name
+
+
+    def _followers(self):
+        # Running input tasks clocked by this task, directly or through an exported clock
+        my_clocks = {_terminal_key(self._clock_source_name())}
+        if self.export_signals.samp_clk_output_term:
+            my_clocks.add(_terminal_key(self.export_signals.samp_clk_output_term))
+        with _tasks_lock:
+            return [t for t in _tasks if t is not self and t._state == 'running' and
+                    t._is_input() and _terminal_key(t.timing.samp_clk_src) in my_clocks]
+    #close _followers
+
+
+    def _clock_loop(self):
+        rate = self.timing.samp_clk_rate
+        block = max(int(rate*block_duration), 1)
+        finite = self.timing.samp_quant_samp_mode == constants.AcquisitionType.FINITE
+        n_done = 0
+        t0 = time.perf_counter()
+
+        while not self._stop_clock.is_set():
+            n = min(block, self.timing.samp_quant_samp_per_chan - n_done) if finite else block
+            if realtime:
+                # Samples become available once the last of them has been acquired, not before
+                delay = t0 + (n_done + n)/rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            positions = self._positions(n_done, n)
+            acquiring = self._followers()
+            if len(self.ai_channels) > 0:
+                acquiring.insert(0, self)
+            for task in acquiring:
+                task._acquire(n_done, n, positions, self)
+            # Only once every task has the block, as a callback may read from any of them
+            for task in acquiring:
+                task._dispatch_events()
+            n_done += n
+            self._n_done = n_done
+
+            # Finite tasks stop, or re-arm, once they have all their samples. This is done
+            # under the lock so a trigger finds the tasks either all running or all armed.
+            with _tasks_lock:
+                for task in acquiring:
+                    if task is not self:
+                        task._finish_if_done()
+                if self._finish_if_done():
+                    break
+    #close _clock_loop
+
+
+    def _finish_if_done(self):
+        # A finite task stops after samp_quant_samp_per_chan samples, or re-arms if its
+        # start trigger is retriggerable. Returns True if it has finished.
+        if self.timing.samp_quant_samp_mode != constants.AcquisitionType.FINITE or self._state != 'running':
+            return False
+        done = self._total_acquired - self._run_first if self._is_input() else self._n_done
+        if done < self.timing.samp_quant_samp_per_chan:
+            return False
+
+        trigger = self.triggers.start_trigger
+        self._state = 'armed' if trigger.retriggerable and trigger.source else 'idle'
+        with self._data_ready:
+            self._data_ready.notify_all()
+        return True
+    #close _finish_if_done
+
+
+    def _positions(self, first_sample, n):
+        # Command and actual mirror positions for n samples starting at first_sample
+        if len(self._command) > 0:
+            idx = (first_sample + np.arange(n)) % self._command.shape[1]
+            return self._command[:, idx], self._actual[:, idx]
+
+        # An input task with its own clock: follow the AO task of the same device
+        with _tasks_lock:
+            source = [t for t in _tasks if t._dev_name == self._dev_name and len(t._command) > 0]
+        if not source:
+            zeros = np.zeros((2, n))
+            return zeros, zeros
+        source = source[0]
+        ratio = source.timing.samp_clk_rate / self.timing.samp_clk_rate
+        idx = np.floor((first_sample + np.arange(n)) * ratio).astype(np.intp) % source._command.shape[1]
+        return source._command[:, idx], source._actual[:, idx]
+    #close _positions
+
+
+    def _acquire(self, first_sample, n, positions, master):
+        # Generate n samples for each input channel and store them
+        command, actual = positions
+        x = actual[0]
+        y = actual[1] if actual.shape[0] > 1 else np.zeros(n)
+        t = first_sample/master.timing.samp_clk_rate
+
+        if len(self.ci_channels) > 0:
+            self._store(self._count_photons(x, y, t))
+            return
+
+        block = np.empty((len(self.ai_channels), n))
+        for ii, chan in enumerate(self.ai_channels.channel_names):
+            signal = wiring.get('%s/%s' % (self._dev_name, chan), _default_wiring.get(chan, 'noise'))
+            if signal == 'sample':
+                block[ii] = sample.signal(x, y, t)
+            elif signal == 'x_feedback':
+                block[ii] = x
+            elif signal == 'y_feedback':
+                block[ii] = y
+            elif signal.startswith('ao') and int(signal[2:]) < command.shape[0]:
+                block[ii] = command[int(signal[2:])]
+            elif signal.startswith('ctr'):
+                block[ii] = 5.0*_counter_output(self._dev_name, signal, first_sample, n)
+            else:
+                block[ii] = np.random.normal(0, sample.noise, n)
+
+        self._store(block)
+    #close _acquire
+
+
+    def _count_photons(self, x, y, t):
+        # Cumulative photon count at each sample, as a counter input would return it
+        rate = np.maximum(sample.signal(x, y, t), 0) * photons_per_volt
+        cumulative = np.cumsum(sample._rng.poisson(rate), dtype=np.uint64) + self._count
+        self._count = int(cumulative[-1])
+        return cumulative.astype(np.uint32).reshape(1, -1) # Wraps modulo 2**32
+    #close _count_photons
+
+
+    def _store(self, block):
+        n = block.shape[1]
+        buf_size = self._buffer.shape[1]
+        with self._data_ready:
+            start = self._total_acquired % buf_size
+            first = min(n, buf_size - start)
+            self._buffer[:, start:start+first] = block[:, :first]
+            if first < n:
+                self._buffer[:, :n-first] = block[:, first:]
+            self._total_acquired += n
+            self._data_ready.notify_all()
+    #close _store
+
+
+    def _dispatch_events(self):
+        # Run the every n samples callback for each interval completed
+        while self._callback is not None and self._every_n > 0 and \
+                self._total_acquired >= self._next_event and self._state == 'running':
+            self._next_event += self._every_n
+            self._callback(id(self), 1, self._every_n, None)
+    #close _dispatch_events
+
+#close class Task
+
+
+
+class stream_readers():
+    '''
+    Stand-ins for the nidaqmx.stream_readers classes used in this repository
+    '''
+    class CounterReader():
+        def __init__(self, in_stream):
+            self._task = in_stream._task
+
+        def read_many_sample_uint32(self, data, number_of_samples_per_channel=1, timeout=10.0):
+            data[:number_of_samples_per_channel] = self._task._read_array(number_of_samples_per_channel, timeout)[0]
+            return number_of_samples_per_channel
+
+    class AnalogMultiChannelReader():
+        def __init__(self, in_stream):
+            self._task = in_stream._task
+
+        def read_many_sample(self, data, number_of_samples_per_channel=1, timeout=10.0):
+            data[:, :number_of_samples_per_channel] = self._task._read_array(number_of_samples_per_channel, timeout)
+            return number_of_samples_per_channel
+
+    class AnalogSingleChannelReader():
+        def __init__(self, in_stream):
+            self._task = in_stream._task
+
+        def read_many_sample(self, data, number_of_samples_per_channel=1, timeout=10.0):
+            data[:number_of_samples_per_channel] = self._task._read_array(number_of_samples_per_channel, timeout)[0]
+            return number_of_samples_per_channel
+#close class stream_readers
+
+
+
+class stream_writers():
+    '''
+    Stand-ins for the nidaqmx.stream_writers classes used in this repository
+    '''
+    class AnalogUnscaledWriter():
+        def __init__(self, task_out_stream, auto_start=False):
+            self._task = task_out_stream._task
+
+        def write_int16(self, data, timeout=10.0):
+            # Back to volts with the linear scaling of the simulated DAC
+            if data.dtype != np.int16 or not data.flags.c_contiguous:
+                raise DaqError('write_int16 needs a C contiguous int16 array', -200012)
+            offset, gain = _aoChannel().ao_dev_scaling_coeff
+            return self._task.write((data - offset)/gain, timeout=timeout)
+#close class stream_writers
+
+
+
+class system():
+    '''
+    Stand-in for nidaqmx.system
+    '''
+    class Device():
+        def __init__(self, name):
+            self.name = name
+
+        @property
+        def ai_max_single_chan_rate(self):
+            return ai_max_rate
+#close class system
+
+
+
+def _fire_trigger(terminal):
+    # Start all armed tasks waiting on this trigger terminal
+    terminal = _terminal_key(terminal)
+    with _tasks_lock:
+        waiting = [t for t in _tasks if t._state == 'armed' and
+                   _terminal_key(t.triggers.start_trigger.source) == terminal]
+    # Counters first, so they see the first tick of any clock started by the same trigger
+    waiting.sort(key=lambda t: t._pulse is None)
+    for task in waiting:
+        task._run()
+#close _fire_trigger
+
+
+
+def send_trigger(terminal):
+    '''
+    Simulate an external digital edge arriving at terminal (e.g. 'PFI0' or '/Dev1/PFI0').
+    Tasks armed on that terminal start. Returns the number of tasks started.
+    '''
+    with _tasks_lock:
+        armed = [t for t in _tasks if t._state == 'armed']
+        _fire_trigger(terminal)
+        return sum(t._state == 'running' for t in armed)
+#close send_trigger
+
+
+
+def _clock_position(terminal):
+    # Number of samples already produced by the running task whose clock is at terminal
+    terminal = terminal.lower()
+    with _tasks_lock:
+        for t in _tasks:
+            if t._clock_thread is not None and t._clock_source_name().lower() == terminal:
+                return t._n_done
+    return 0
+#close _clock_position
+
+
+def _counter_output(dev_name, counter, first_sample, n):
+    # Output level of a running counter pulse task for n master clock samples. The task is
+    # assumed to be ticked by the clock of the task being acquired. Low if it is not running.
+    with _tasks_lock:
+        for t in _tasks:
+            if t._pulse is not None and t._state == 'running' and t._dev_name == dev_name and \
+                    counter in t.co_channels.channel_names:
+                ticks = first_sample - t._first_tick + np.arange(n)
+                return t._pulse.level(ticks).astype(np.float64)
+    return np.zeros(n)
+#close _counter_output
+
+
+
+def _terminal_key(terminal):
+    # Normalise a terminal name for comparison. PFI lines are the same on every device.
+    terminal = str(terminal).lower().lstrip('/')
+    name = terminal.split('/')[-1]
+    if name.startswith('pfi'):
+        return name
+    return terminal
+#close _terminal_key
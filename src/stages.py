@@ -0,0 +1,235 @@
+'''
+ Stage interface for moving the sample
+
+ stages
+
+
+ Description:
+  Scanning code that needs to move the sample (e.g. tiledScanner) talks to a stage
+  through the small interface defined by the "stage" class below. To drive a real
+  stage, subclass it and implement move_to and get_position using your stage's own
+  API. The simulatedStage class implements the interface with no hardware so that
+  the rest of the software can be developed and tested on any machine.
+
+  Focus is moved by a z stage: anything implementing the smaller zStage interface.
+  aoZStage drives a piezo objective positioner (or any z drive with an analog input) from
+  an AO channel. simulatedZStage moves the focus of the simulated microscope (see
+  simulatedDAQ.py), so that autofocus can be tried without hardware.
+
+  All positions are in microns.
+
+
+  Usage:
+  import stages
+  S = stages.simulatedStage()
+  S.move_to(x=100, y=-50)
+  S.get_position()
+
+  Z = stages.aoZStage(dev_name='Dev2', channel='ao0')
+  Z.microns_per_volt = 40
+  Z.move_to(12.5)
+
+'''
+
+import time
+
+class stage():
+    '''
+    Base class for stages. Subclasses must implement move_to and get_position.
+    '''
+
+    def move_to(self, x=None, y=None):
+        '''
+        Move to the absolute position (x,y) in microns and return once the move has
+        completed. Axes that are None are not moved.
+        '''
+        raise NotImplementedError('%s does not implement move_to' % self.__class__.__name__)
+    #close move_to
+
+
+    def get_position(self):
+        '''
+        Return the current (x,y) position in microns
+        '''
+        raise NotImplementedError('%s does not implement get_position' % self.__class__.__name__)
+    #close get_position
+
+#close class stage
+
+
+
+class simulatedStage(stage):
+    '''
+    A stage with no hardware. Moves take a realistic amount of time so that the
+    throughput of tiled acquisitions can be assessed.
+    '''
+
+    speed = 5000        # Travel speed in microns per second
+    settle_time = 0.02  # Time in seconds to wait after each move
+
+    x = 0   # Current position in microns
+    y = 0
+
+
+    def move_to(self, x=None, y=None):
+        distance = 0
+        if x is not None:
+            distance = max(distance, abs(x - self.x))
+            self.x = x
+        if y is not None:
+            distance = max(distance, abs(y - self.y))
+            self.y = y
+
+        if distance > 0:
+            time.sleep(distance/self.speed + self.settle_time)
+    #close move_to
+
+
+    def get_position(self):
+        return (self.x, self.y)
+    #close get_position
+
+#close class simulatedStage
+
+
+
+class zStage():
+    '''
+    Base class for z stages. Subclasses must implement move_to and get_position.
+    '''
+
+    def move_to(self, z):
+        '''
+        Move to z in microns and return once the move has settled
+        '''
+        raise NotImplementedError('%s does not implement move_to' % self.__class__.__name__)
+    #close move_to
+
+
+    def get_position(self):
+        '''
+        Return the current z position in microns
+        '''
+        raise NotImplementedError('%s does not implement get_position' % self.__class__.__name__)
+    #close get_position
+
+
+    def limits(self):
+        '''
+        Return the lowest and highest z in microns that the stage can move to
+        '''
+        return float('-inf'), float('inf')
+    #close limits
+
+#close class zStage
+
+
+
+class aoZStage(zStage):
+    '''
+    A z drive controlled by a voltage from an AO channel, e.g. a piezo objective
+    positioner. The voltage is written by an on demand (software timed) task. An X series
+    board runs only one AO task at a time, so use a channel on a device other than the
+    scanner's. The position of the drive can not be read back, so it is moved to park_z
+    when the task is created: on the first move or call to get_position.
+    '''
+
+    dev_name = 'Dev2'
+    channel = 'ao0'
+    microns_per_volt = 40   # E.g. 400 um of travel over 0 to 10 V
+    min_voltage = 0
+    max_voltage = 10
+    settle_time = 0.01      # Time in seconds for the drive to settle after each move
+    park_z = None           # z the drive is moved to when the task is created. None: mid-travel.
+    simulated = False
+
+    z = None                # Current position in microns. None until the task is created.
+
+    _task = None
+
+
+    def __init__(self, dev_name=None, channel=None, simulated=None):
+        if dev_name is not None:
+            self.dev_name = dev_name
+        if channel is not None:
+            self.channel = channel
+        if simulated is not None:
+            self.simulated = simulated
+    #close constructor
+
+
+    def move_to(self, z):
+        volts = z/self.microns_per_volt
+        if not self.min_voltage <= volts <= self.max_voltage:
+            raise ValueError('z of %0.2f um needs %0.2f V, outside the %0.1f to %0.1f V range' %
+                             (z, volts, self.min_voltage, self.max_voltage))
+        if self._task is None:
+            self._create_task()
+        self._task.write(volts)
+        self.z = z
+        time.sleep(self.settle_time)
+    #close move_to
+
+
+    def get_position(self):
+        if self._task is None:
+            self._create_task()
+        return self.z
+    #close get_position
+
+
+    def limits(self):
+        return self.min_voltage*self.microns_per_volt, self.max_voltage*self.microns_per_volt
+    #close limits
+
+
+    def _create_task(self):
+        # Created on first use, so NI-DAQmx is imported only when needed. The drive is then
+        # parked so that its position is known.
+        if self.simulated:
+            import simulatedDAQ as daq
+        else:
+            import nidaqmx as daq
+        self._task = daq.Task('simplescannerz')
+        self._task.ao_channels.add_ao_voltage_chan('%s/%s' % (self.dev_name, self.channel),
+                                                   min_val=self.min_voltage, max_val=self.max_voltage)
+        low, high = self.limits()
+        self.move_to((low + high)/2 if self.park_z is None else self.park_z)
+    #close _create_task
+
+
+    def close(self):
+        if self._task is not None:
+            self._task.close()
+            self._task = None
+    #close close
+
+#close class aoZStage
+
+
+
+class simulatedZStage(zStage):
+    '''
+    Moves the focus of the simulated microscope: the specimen is sharpest at
+    simulatedDAQ.sample.focal_plane. Moves take as long as a piezo's.
+    '''
+
+    speed = 2000        # Travel speed in microns per second
+    settle_time = 0.005 # Time in seconds to wait after each move
+
+
+    def move_to(self, z):
+        import simulatedDAQ
+        distance = abs(z - simulatedDAQ.sample.z)
+        simulatedDAQ.sample.z = z
+        if distance > 0:
+            time.sleep(distance/self.speed + self.settle_time)
+    #close move_to
+
+
+    def get_position(self):
+        import simulatedDAQ
+        return simulatedDAQ.sample.z
+    #close get_position
+
+#close class simulatedZStage
@@ -0,0 +1,274 @@
+'''
+ Tiled (mosaic) acquisition built on basicScanner
+
+ tiledScanner
+
+
+ Description:
+  Samples that are larger than one field of view are imaged as a grid of tiles which
+  are then placed side by side to form a mosaic. This class moves between tiles in one
+  of two ways:
+  - 'waveform' mode adds a DC offset to the X and Y scan waveforms so the scan pattern
+    itself is moved across a larger area. This needs no extra hardware but the total
+    area is limited by the scanner range.
+  - 'stage' mode moves the sample with a stage. Any object that implements the stage
+    interface in stages.py may be used. By default a simulatedStage is used.
+
+  The DAQmx tasks created by basicScanner are re-used for every tile: nothing is
+  re-created between tiles. In waveform mode the original waveforms are kept in a
+  buffer and the offset waveforms are written into a second, preallocated, buffer
+  that is then sent to the already-configured AO task.
+
+  Tiles are downsampled and pasted into a memory-mapped mosaic file as soon as they
+  are acquired, and a preview of the mosaic is shown in a second window.
+
+
+  Usage:
+  import tiledScanner
+  T = tiledScanner.tiledScanner()
+  T.tile_rows = 4
+  T.tile_cols = 4
+  T.start_acquisition()
+  T.acquire_mosaic()
+  T.stop_acquisition()
+  T.mosaic  # The downsampled mosaic (a numpy memmap)
+
+  The mosaic preview only draws the part in view, from a lazily built imagePyramid
+  (T.mosaic_pyramid), so it stays responsive however large the mosaic.
+
+  To use a stage:
+  import stages
+  T = tiledScanner.tiledScanner(tile_mode='stage', stage=stages.simulatedStage())
+
+'''
+
+import numpy as np
+from basicScanner import basicScanner
+from stages import simulatedStage
+from imagePyramid import imagePyramid
+
+class tiledScanner(basicScanner):
+
+    tile_rows = 3          # Number of rows of tiles
+    tile_cols = 3          # Number of columns of tiles
+    tile_overlap = 0.1     # Fractional overlap between adjacent tiles
+    tile_mode = 'waveform' # Either 'waveform' or 'stage'
+    stage = None           # Stage object used in 'stage' mode
+
+    field_of_view = 500    # Width of one tile in microns. Used to calculate stage steps.
+    max_voltage = 10       # The offset scan waveforms may not exceed +/- this many volts
+
+    frames_per_tile = 1    # Number of frames averaged to make each tile
+    settle_frames = 1      # Frames discarded after moving to each tile
+
+    mosaic_downsample = 4         # The mosaic is stored downsampled by this factor
+    mosaic_fname = 'mosaic.dat'   # The memory-mapped mosaic is written here
+    mosaic = []                   # numpy memmap holding the downsampled mosaic
+    mosaic_pyramid = None         # imagePyramid of the mosaic, for the preview
+
+    _base_waveforms = []   # The un-offset scan waveforms
+    _mosaic_viewer = []    # pyramidViewer showing the mosaic preview
+
+
+
+    def __init__(self, autoconnect=True, tile_mode=None, stage=None, simulated=None):
+        if tile_mode is not None:
+            self.tile_mode = tile_mode
+
+        if self.tile_mode == 'stage':
+            self.stage = stage if stage is not None else simulatedStage()
+        elif self.tile_mode != 'waveform':
+            raise ValueError("tile_mode must be 'waveform' or 'stage'")
+
+        super().__init__(autoconnect=autoconnect, simulated=simulated)
+    #close constructor
+
+
+    def setup_plot(self):
+        # Live view from basicScanner plus a second window for the mosaic. Only the part of
+        # the mosaic in view is drawn, at the resolution of the screen (see imagePyramid.py).
+        super().setup_plot()
+        from imagePyramid import pyramidViewer
+        self._mosaic_viewer = pyramidViewer(title='Mosaic preview')
+    #close setup_plot
+
+
+    def tile_offsets(self):
+        '''
+        Return an array of tile offsets with one row per tile in acquisition order.
+        Columns are: tile row, tile column, x offset, y offset. Offsets are in volts in
+        waveform mode and in microns in stage mode. Tiles are visited in a serpentine
+        order to minimise travel. In waveform mode the steps are those of the active scan
+        pattern's pixels, so they match where the tiles are pasted into the mosaic.
+        '''
+        if self.tile_mode == 'waveform':
+            if self.scan_plan is None:
+                self.generateScanWaveforms()
+            frame_rows, frame_cols = self.scan_plan.frame_shape
+            pitch_x, pitch_y = self._pixel_pitch()
+            step_x = pitch_x*self._tile_step(frame_cols)
+            step_y = pitch_y*self._tile_step(frame_rows)
+        else:
+            step_x = step_y = self.field_of_view*(1-self.tile_overlap)
+
+        offsets = []
+        for r in range(self.tile_rows):
+            cols = range(self.tile_cols) if r % 2 == 0 else reversed(range(self.tile_cols))
+            for c in cols:
+                # Image row 0 is at the positive end of the Y waveform and column 0
+                # at the negative end of the X waveform
+                x = (c - (self.tile_cols-1)/2) * step_x
+                y = ((self.tile_rows-1)/2 - r) * step_y
+                offsets.append((r, c, x, y))
+
+        offsets = np.array(offsets)
+
+        if self.tile_mode == 'waveform':
+            extent = (np.abs(offsets[:,2:]) + np.abs(self.scan_plan.waveforms).max(axis=1)).max()
+            if extent > self.max_voltage:
+                raise ValueError('Tiled scan pattern would reach %0.2f V. Maximum allowed is %0.2f V' %
+                                 (extent, self.max_voltage))
+        return offsets
+    #close tile_offsets
+
+
+    def acquire_mosaic(self):
+        '''
+        Acquire all tiles, pasting each into the mosaic as it arrives.
+        Acquisition must already be running. Returns the mosaic.
+        '''
+        if not self._task_created():
+            return
+
+        offsets = self.tile_offsets()
+        self._create_mosaic()
+
+        # Keep the plan's (read-only) waveforms. self.waveforms then becomes a
+        # buffer into which offset waveforms are written for each tile.
+        self._base_waveforms = self.scan_plan.waveforms
+        self.waveforms = self._base_waveforms.copy()
+
+        print('Acquiring %d tiles' % len(offsets))
+        try:
+            for r, c, x, y in offsets:
+                self._go_to_tile(x, y)
+                tile = self._acquire_tile()
+                if tile is None:
+                    print('Tile acquisition failed. Stopping.')
+                    break
+                self._paste_tile(int(r), int(c), tile)
+                self._update_mosaic_preview()
+        finally:
+            # Return to the centre of the scan area
+            self._go_to_tile(0, 0)
+            self.mosaic.flush()
+
+        return self.mosaic
+    #close acquire_mosaic
+
+
+    def _go_to_tile(self, x, y):
+        if self.tile_mode == 'stage':
+            self.stage.move_to(x=x, y=y)
+            return
+
+        # Offset the waveforms in place and re-write them to the existing AO task
+        self.stop_acquisition()
+        np.add(self._base_waveforms, np.array([[x], [y]]), out=self.waveforms)
+        self._write_waveforms()
+        self.start_acquisition()
+    #close _go_to_tile
+
+
+    def _acquire_tile(self):
+        # Discard settle frames then average frames_per_tile frames
+        if self.motion_corrector is not None:
+            self.motion_corrector.reset()
+
+        if self.settle_frames > 0 and self.wait_for_frames(self.settle_frames) is None:
+            return None
+
+        tile = None
+        for ii in range(self.frames_per_tile):
+            frame = self.wait_for_frames(1)
+            if frame is None:
+                return None
+            if tile is None:
+                tile = np.array(frame, dtype=np.float32)
+            else:
+                tile += frame
+
+        return tile / self.frames_per_tile
+    #close _acquire_tile
+
+
+    def _create_mosaic(self):
+        # Allocate the memory-mapped mosaic that will hold the downsampled tiles
+        ds = self.mosaic_downsample
+        tile_rows, tile_cols = self._pattern.frame_shape
+        rows = (self._tile_step(tile_rows)*(self.tile_rows-1) + tile_rows) // ds
+        cols = (self._tile_step(tile_cols)*(self.tile_cols-1) + tile_cols) // ds
+        self.mosaic = np.memmap(self.mosaic_fname, dtype=np.float32, mode='w+', shape=(rows, cols))
+        self.mosaic_pyramid = imagePyramid(self.mosaic)
+        if not isinstance(self._mosaic_viewer, list):
+            self._mosaic_viewer.set_pyramid(self.mosaic_pyramid)
+        print('Created %d by %d mosaic in %s' % (rows, cols, self.mosaic_fname))
+    #close _create_mosaic
+
+
+    def _paste_tile(self, r, c, tile):
+        # Downsample a tile by block averaging and write it into the mosaic
+        ds = self.mosaic_downsample
+        n = (tile.shape[0]//ds)*ds
+        m = (tile.shape[1]//ds)*ds
+        small = tile[:n,:m].reshape(n//ds, ds, m//ds, ds).mean(axis=(1,3))
+
+        r0 = (r*self._tile_step(tile.shape[0]))//ds
+        c0 = (c*self._tile_step(tile.shape[1]))//ds
+        small = small[:self.mosaic.shape[0]-r0, :self.mosaic.shape[1]-c0]
+        self.mosaic[r0:r0+small.shape[0], c0:c0+small.shape[1]] = small
+        self.mosaic_pyramid.update((r0, r0+small.shape[0], c0, c0+small.shape[1]))
+    #close _paste_tile
+
+
+    def _pixel_pitch(self):
+        # Volts between adjacent pixel columns (X) and rows (Y) of the active scan pattern,
+        # fitted to the positions of all the samples that fall in the frame. This follows
+        # any ROI, fill fraction or rectangular frame, unlike scan_amplitude.
+        plan = self.scan_plan
+        keep = plan.pixel_index >= 0
+        r, c = np.divmod(plan.pixel_index[keep], plan.frame_shape[1])
+        pitch = []
+        for index, position in ((c, plan.waveforms[0, keep]), (r, plan.waveforms[1, keep])):
+            index = index - index.mean()
+            if not np.any(index):
+                raise ValueError('The scan pattern does not span a 2D field, so it cannot be tiled')
+            pitch.append(abs(np.dot(index, position) / np.dot(index, index)))
+        return pitch
+    #close _pixel_pitch
+
+
+    def _tile_step(self, n_pixels):
+        # Distance in pixels between the origins of adjacent tiles
+        return int(round(n_pixels*(1-self.tile_overlap)))
+    #close _tile_step
+
+
+    def _update_mosaic_preview(self):
+        if isinstance(self._mosaic_viewer, list):
+            return
+        self._mosaic_viewer.refresh()
+    #close _update_mosaic_preview
+
+#close class tiledScanner
+
+
+
+if __name__ == '__main__':
+    print('\nRunning demo for tiledScanner\n\n')
+    SCANNER = tiledScanner()
+    SCANNER.start_acquisition()
+    SCANNER.acquire_mosaic()
+    input('press return to stop')
+    SCANNER.stop_acquisition()
+    SCANNER.close_tasks()
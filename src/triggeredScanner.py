@@ -0,0 +1,204 @@
+'''
+ Externally triggered acquisition of a fixed number of frames per trial
+
+ triggeredScanner
+
+
+ Description:
+  basicScanner scans continuously from the moment it is started. For stimulus-locked
+  experiments this class instead arms the tasks once and then, every time a digital edge
+  arrives at trigger_terminal, acquires exactly frames_per_trial frames and stops. The
+  tasks are finite (frames_per_trial frames of samples) and retriggerable, so the board
+  re-arms itself in hardware at the end of each trial with no software involved: the dead
+  time between trials is only the time taken to scan the last frame out. Triggers arriving
+  during a trial are ignored by the hardware.
+
+  Each trial is assembled straight into a preallocated (frames, rows, columns) block: the
+  reconstructionEngine writes each frame into its plane of the block. When the trial is
+  complete the block itself, not a copy, is passed to every function in trial_callbacks
+  and becomes last_trial. The blocks are used in rotation from a pool of
+  num_trial_buffers, so a block handed out remains valid until num_trial_buffers - 1 more
+  trials have been acquired. Consumers that need it longer must copy it. Callbacks run on
+  the DAQ callback thread so should return quickly, e.g. by queueing the block.
+
+  Frames are also displayed, counted and raw recorded (see rawRecording.py) exactly as in
+  basicScanner. frame_sample_index counts samples acquired, which do not include the
+  time between trials. trial_sample_index holds the frame_sample_index of each trial's
+  first frame.
+
+  Wiring instructions:
+  - As basicScanner
+  - The trigger, e.g. from the stimulus generator, to trigger_terminal (PFI0 by default)
+
+  The line and frame clocks (see basicScanner) count the AO sample clock, which only runs
+  during trials. A trial being a whole number of frames, they stay in step from trial to trial.
+
+
+  Usage:
+  import triggeredScanner
+  T = triggeredScanner.triggeredScanner(autoconnect=False)
+  T.frames_per_trial = 20
+  T.trial_callbacks.append(lambda trial, block: my_queue.put((trial, block)))
+  T.set_up_tasks()
+  T.setup_plot()
+  T.start_acquisition()      # Arms the tasks. Nothing happens until the first trigger.
+  block = T.wait_for_trials(1)
+
+  Without hardware, triggers are sent with simulatedDAQ.send_trigger:
+  T = triggeredScanner.triggeredScanner(simulated=True)
+  T.start_acquisition()
+  import simulatedDAQ
+  simulatedDAQ.send_trigger('PFI0')
+  T.wait_for_trials(1)
+
+'''
+
+import numpy as np
+from basicScanner import basicScanner
+from framePool import frameBuffer
+
+class triggeredScanner(basicScanner):
+
+    frames_per_trial = 10       # Frames acquired on each trigger
+    trigger_terminal = 'PFI0'   # Terminal at which the trial triggers arrive
+    trigger_edge = 'rising'     # 'rising' or 'falling'
+    num_trial_buffers = 3       # Number of preallocated trial blocks used in rotation
+
+    # Functions called with (trial number, block) as each trial completes. See the module help.
+    trial_callbacks = []
+
+    last_trial = None           # The block of the most recent complete trial
+    trials_acquired = 0         # Number of complete trials since this object was created
+    trial_sample_index = []     # frame_sample_index of the first frame of each trial
+
+    _trial_blocks = []          # The preallocated pool of trial blocks
+    _block = None               # The block being filled
+    _frame_in_trial = 0         # Index of the next frame within the current trial
+
+
+
+    def __init__(self, autoconnect=True, simulated=None, profile=None):
+        self.trial_callbacks = []
+        self.trial_sample_index = []
+        self._trial_blocks = []
+        super().__init__(autoconnect=autoconnect, simulated=simulated, profile=profile)
+    #close constructor
+
+
+    def _sample_mode(self):
+        # Each trigger acquires (and generates) exactly frames_per_trial frames
+        return self._daq.constants.AcquisitionType.FINITE, self.frames_per_trial*self._points_to_plot
+    #close _sample_mode
+
+
+    def _set_up_start_trigger(self):
+        super()._set_up_start_trigger()   # AO follows the AI start trigger, as in basicScanner
+
+        edge = self._daq.constants.Edge.FALLING if self.trigger_edge == 'falling' else self._daq.constants.Edge.RISING
+        self.h_task_ai.triggers.start_trigger.cfg_dig_edge_start_trig('/%s/%s' % (self.dev_name, self.trigger_terminal),
+                                                                      trigger_edge=edge)
+
+        # Re-arm in hardware at the end of each trial
+        self.h_task_ai.triggers.start_trigger.retriggerable = True
+        self.h_task_ao.triggers.start_trigger.retriggerable = True
+    #close _set_up_start_trigger
+
+
+    def _task_structure(self):
+        structure = super()._task_structure()
+        structure.update(trigger_terminal=self.trigger_terminal, trigger_edge=self.trigger_edge)
+        return structure
+    #close _task_structure
+
+
+    def _task_timing(self):
+        return super()._task_timing() + (self.frames_per_trial,)
+    #close _task_timing
+
+
+    def _start_tasks(self):
+        self._frame_in_trial = 0    # Every trial starts at the first frame of a block
+        super()._start_tasks()
+    #close _start_tasks
+
+
+    def _lease_frame(self, data):
+        # Frames are assembled straight into their plane of the current trial block, rather
+        # than into a buffer from the frame pool
+        if self._frame_in_trial == 0:
+            self._block = self._next_block()
+        return frameBuffer(self._block[self._frame_in_trial])
+    #close _lease_frame
+
+
+    def _next_block(self):
+        # The next block of the pool, which is re-allocated if the frame size has changed
+        shape = (self.frames_per_trial,) + self._engine.frame_shape
+        if len(self._trial_blocks) != self.num_trial_buffers or self._trial_blocks[0].shape != shape:
+            self._trial_blocks = [np.zeros(shape) for ii in range(self.num_trial_buffers)]
+        return self._trial_blocks[self.trials_acquired % self.num_trial_buffers]
+    #close _next_block
+
+
+    def _read_and_display_last_frame(self, tTask, event_type, num_samples, callback_data):
+        with self.tracer.span('frame'):
+            self._read_and_display_frame()
+        return 0
+    #close _read_and_display_last_frame
+
+
+    def _read_and_display_frame(self):
+        _im = self._read_last_frame()
+
+        # Motion correction returns a new frame: keep the corrected one
+        plane = self._block[self._frame_in_trial]
+        if _im is not plane:
+            plane[...] = _im
+        if self._frame_in_trial == 0:
+            self.trial_sample_index.append(self.last_frame_sample)
+
+        self.display.submit(_im, self._frame_lease.retain())
+
+        self._frame_in_trial += 1
+        if self._frame_in_trial == self.frames_per_trial:
+            self._frame_in_trial = 0
+            with self.tracer.span('trial callbacks'):
+                self._complete_trial()
+    #close _read_and_display_frame
+
+
+    def _complete_trial(self):
+        block = self._block
+        with self._frame_condition:
+            self.last_trial = block
+            self.trials_acquired += 1
+            self._frame_condition.notify_all()
+        for callback in self.trial_callbacks:
+            callback(self.trials_acquired - 1, block)
+    #close _complete_trial
+
+
+    def wait_for_trials(self, num_trials=1, timeout=10):
+        '''
+        Block until num_trials new trials have been acquired then return the block of the
+        last of them. Returns None if the timeout (in seconds) expires.
+        '''
+        with self._frame_condition:
+            target = self.trials_acquired + num_trials
+            if not self._frame_condition.wait_for(lambda: self.trials_acquired >= target, timeout):
+                print('Timed out waiting for trials')
+                return None
+            return self.last_trial
+    #close wait_for_trials
+
+#close class triggeredScanner
+
+
+
+if __name__ == '__main__':
+    print('\nRunning demo for triggeredScanner\n\n')
+    SCANNER = triggeredScanner()
+    SCANNER.start_acquisition()
+    input('Waiting for triggers on %s. Press return to stop' % SCANNER.trigger_terminal)
+    SCANNER.stop_acquisition()
+    SCANNER.close_tasks()
@@ -27,6 +27,8 @@
    from waveformTester import waveformTester
    S=waveformTester()       # To connect to Dev1.
    S=waveformTester('Dev3') # To connect to a named device ID
+   S=waveformTester(simulated=True) # To run without hardware (see simulatedDAQ.py)
+   S=waveformTester(profile='standard_256') # Parameters from the [waveformTester] section of a profile
    You can stop acquisition by closing the window.
 
 
@@ -56,16 +58,18 @@
  Try a sawtooth waveform by modifying the waveform_type property. Start with a frequency below 500 Hz
  then try higher frequency (e.g. 2 kHz). How well do the scanners follow the command signal?
 
+ Waveforms are checked by galvo_limiter (see galvoLimiter.py) before they are sent to the mirrors.
+ Those that exceed the velocity or acceleration limits are smoothed, which you will see as rounded
+ corners on the sawtooth. Set galvo_limiter.action to 'reject' to refuse them instead.
+
 
  See Also:
  basicScanner.py
 '''
 
-import nidaqmx
-from nidaqmx.constants import (AcquisitionType,RegenerationMode)
 import numpy as np
-from pyqtgraph.Qt import QtGui, QtCore
-import pyqtgraph as pg
+import aoScaling
+from galvoLimiter import galvoLimiter
 
 class waveformTester():
 
@@ -84,9 +88,21 @@ class waveformTester():
     ao_task = []  # The AO task handle will be kept here
     waveform = [] # The scanner waveform will be stored here
 
+    # If True the waveform is written as the AO DAC's int16 codes, converted once using the
+    # device's calibration, rather than scaled by the driver. See aoScaling.py
+    unscaled_output = True
+
+    # Waveforms are checked against the mirror velocity and acceleration limits before being
+    # played out. Waveforms that are too fast are smoothed ('reshape') or refused ('reject').
+    galvo_limiter = []
+
     # Properties for the analog inputs
     ai_task = [] #The AI task handle will be kept here
 
+    # If True the tasks are created on a simulated device (see simulatedDAQ.py)
+    simulated = False
+    _daq = [] # The DAQmx module in use: nidaqmx or simulatedDAQ
+
 
     # These attributes hold information relevant to the plot window
     _app = []
@@ -99,15 +115,33 @@ class waveformTester():
 
     _read_number = 0 # counter for the number of times the DAQmx callback is run
 
+    # DAQmx task names must be unique, so each instance numbers its tasks
+    _num_instances = 0
+    _instance = 0
+
 
 
 
-    def __init__(self,dev_name=''):
+    def __init__(self,dev_name='', autoconnect=True, simulated=None, profile=None):
+
+        self.galvo_limiter = galvoLimiter()
+        waveformTester._num_instances += 1
+        self._instance = waveformTester._num_instances
+
+        # Parameters from a profile (see scanPlan.py) are applied before the arguments below
+        if profile is not None:
+            self.load_profile(profile)
 
         # Optionally replace device name if needed
         if 'Dev' in dev_name:
             self.dev_name = dev_name
 
+        if simulated is not None:
+            self.simulated = simulated
+
+        if not autoconnect:
+            return
+
         # Build the figure window
         self.build_figure_window()
 
@@ -127,6 +161,7 @@ class waveformTester():
         #if ~isempty(self.hFig) && isvalid(self.hFig)
         #    self.hFig.delete #Closes the plot window
         self.stop() # Call the method that stops the DAQmx tasks
+        self.close_tasks()
     #close destructor
 
 
@@ -138,10 +173,12 @@ class waveformTester():
         l_wav = len(self.waveform)
 
         print('Connecting to DAQ')
+        self._import_daq()
 
-        # Create separate DAQmx tasks for the AI and AO
-        self.ai_task = nidaqmx.Task('signalReceiver')
-        self.ao_task = nidaqmx.Task('waveformMaker')
+        # Create separate DAQmx tasks for the AI and AO, replacing any we made before
+        self.close_tasks()
+        self.ai_task = self._daq.Task('signalReceiver%d' % self._instance)
+        self.ao_task = self._daq.Task('waveformMaker%d' % self._instance)
 
         #  Set up analog input and output voltage channels, digitizing over +/- maxV Volts
         # Channel 0 is the recorded copy of the AO signal. Channel 1 is the scanner feedback.
@@ -160,7 +197,7 @@ class waveformTester():
         self.ai_task.timing.cfg_samp_clk_timing(self.sample_rate, \
                             source= '/%s/ao/SampleClock' % self.dev_name, \
                             samps_per_chan=l_wav*buf_size_scale_factor, \
-                            sample_mode=AcquisitionType.CONTINUOUS)
+                            sample_mode=self._daq.constants.AcquisitionType.CONTINUOUS)
 
         # NOTE: must explicitly set the input buffer so that it's a multiple
         # of the number of samples per frame. Setting the samples per channel
@@ -177,26 +214,37 @@ class waveformTester():
         # * Set up the AO task
         # Set the size of the output buffer
         self.ao_task.timing.cfg_samp_clk_timing(self.sample_rate, \
-                sample_mode=AcquisitionType.CONTINUOUS, \
+                sample_mode=self._daq.constants.AcquisitionType.CONTINUOUS, \
                 samps_per_chan=len(self.waveform))
 
 
         # Allow sample regeneration (buffer is circular)
-        self.ao_task.out_stream.regen_mode = RegenerationMode.ALLOW_REGENERATION
+        self.ao_task.out_stream.regen_mode = self._daq.constants.RegenerationMode.ALLOW_REGENERATION
 
 
         # Write the waveform to the buffer with a 5 second timeout in case it fails
-        self.ao_task.write(self.waveform, timeout=5)
+        if self.unscaled_output:
+            codes = aoScaling.volts_to_codes(self.waveform.reshape(1, -1), aoScaling.device_scaling(self.ao_task))
+            writer = self._daq.stream_writers.AnalogUnscaledWriter(self.ao_task.out_stream)
+            writer.write_int16(codes, timeout=5)
+        else:
+            self.ao_task.write(self.waveform, timeout=5)
 
 
         # Configure the AO task to start as soon as the AI task starts
         self.ao_task.triggers.start_trigger.cfg_dig_edge_start_trig( '/' + self.dev_name + '/ai/StartTrigger' )
+
+
+        # Commit the tasks now so that starting and stopping them is quick
+        for task in (self.ai_task, self.ao_task):
+            task.control(self._daq.constants.TaskMode.TASK_COMMIT)
     # close connect_to_daq
 
 
     def build_figure_window(self):
         print("Building figure window")
-        self._app = QtGui.QApplication([])
+        import pyqtgraph as pg
+        self._app = pg.mkQApp()
         self._win = pg.GraphicsLayoutWidget(show=True)
 
         # Make two subplots
@@ -247,12 +295,25 @@ class waveformTester():
 
     def stop(self):
         # Stop the AI and then AO tasks
+        if isinstance(self.ai_task, list):
+            return
         print('Stopping the scanning AI and AO tasks')
         self.ai_task.stop()
         self.ao_task.stop()
     #close stop
 
 
+    def close_tasks(self):
+        # Release the DAQmx tasks
+        if isinstance(self.ai_task, list):
+            return
+        self.ai_task.close()
+        self.ao_task.close()
+        self.ai_task = []
+        self.ao_task = []
+    #close close_tasks
+
+
     def generate_scan_waveform(self):
         # This method builds a simple ("unshaped") galvo waveform and stores it in the self.waveform
 
@@ -272,6 +333,9 @@ class waveformTester():
                                                             np.pi*self.num_reps_per_acq, \
                                                             self.pixels_per_line*self.num_reps_per_acq))
 
+        # Make sure the mirrors can cope with this waveform
+        self.waveform = self.galvo_limiter.limit_waveform(self.waveform, self.sample_rate)
+
         print('Generated a waveform of length %d and a line period of %0.3f ms (%0.1f Hz)' % \
                (self.pixels_per_line, self.line_period()*1E3, 1/(2*self.line_period()) ) )
     #close generate_scan_waveform
@@ -303,6 +367,37 @@ class waveformTester():
     #close read_and_display_data
 
 
+    def load_profile(self, name):
+        # Set parameters from the [waveformTester] and [galvo] sections of a profile (see
+        # scanPlan.py). Like editing the properties, this takes effect when you next connect.
+        import scanPlan
+        profile = scanPlan.read_profile(name)
+        for key, value in profile.get('waveformTester', {}).items():
+            setattr(self, key, value)
+        for key, value in profile.get('galvo', {}).items():
+            setattr(self.galvo_limiter, key, value)
+    #close load_profile
+
+
+    def _import_daq(self):
+        # The DAQmx module is imported only when we connect, so that the waveform code can be
+        # used without NI-DAQmx installed and without paying its import time. If simulated
+        # has changed since, the other module is imported.
+        if getattr(self._daq, '__name__', None) == ('simulatedDAQ' if self.simulated else 'nidaqmx'):
+            return
+        if self.simulated:
+            import simulatedDAQ
+            # AI0 is a copy of the AO0 command signal, AI1 the mirror position
+            simulatedDAQ.wire(self.dev_name, 'ai0', 'ao0')
+            simulatedDAQ.wire(self.dev_name, 'ai1', 'x_feedback')
+            self._daq = simulatedDAQ
+        else:
+            import nidaqmx
+            import nidaqmx.stream_writers
+            self._daq = nidaqmx
+    #close _import_daq
+
+
     def line_period(self):
         if len(self.waveform)==0:
             LP=[]
@@ -0,0 +1,30 @@
+'''
+ Shared set-up for the correctness tests
+
+ Like the benchmarks these run headless against the simulated DAQ (see src/simulatedDAQ.py).
+'''
+
+import os
+import sys
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pytest
+
+
+@pytest.fixture
+def fast_simulation():
+    # Produce simulated samples as fast as possible rather than in real time
+    import simulatedDAQ
+    simulatedDAQ.realtime = False
+    yield simulatedDAQ
+    simulatedDAQ.realtime = True
+
+
+@pytest.fixture(scope='session', autouse=True)
+def plan_cache(tmp_path_factory):
+    # Keep compiled scan plans out of the user's cache directory
+    import scanPlan
+    scanPlan.cache_dir = str(tmp_path_factory.mktemp('plans'))
+    return scanPlan
@@ -0,0 +1,35 @@
+'''
+ Conversion of AO waveforms to int16 codes and back
+'''
+
+import numpy as np
+import pytest
+
+import aoScaling
+
+
+@pytest.mark.parametrize('scaling', [((0, 3276.8),),
+                                     ((12.5, 3276.4),),
+                                     ((3.0, 3276.8, 0.4, -0.02),)])
+def test_round_trip_within_one_code(scaling):
+    volts = np.linspace(-9.5, 9.5, 2001)
+    codes = aoScaling.volts_to_codes(volts, scaling)
+    assert codes.dtype == np.int16
+    back = aoScaling.codes_to_volts(codes, scaling)
+    # Rounding to a code is the only loss: at most half a code, in volts
+    np.testing.assert_array_less(np.abs(back - volts), 0.5/scaling[0][1] + 1e-3/scaling[0][1])
+    np.testing.assert_array_equal(aoScaling.volts_to_codes(back, scaling), codes)
+
+
+def test_channels_and_out():
+    scaling = ((0, 3276.8), (-2.0, 3276.0))
+    volts = np.vstack((np.linspace(-1, 1, 100), np.linspace(2, -2, 100)))
+    out = np.empty(volts.shape, dtype=np.int16)
+    codes = aoScaling.volts_to_codes(volts, scaling, out=out)
+    assert codes is out or np.shares_memory(codes, out)
+    np.testing.assert_allclose(aoScaling.codes_to_volts(codes, scaling), volts, atol=0.5/3276)
+
+
+def test_channel_mismatch_raises():
+    with pytest.raises(ValueError):
+        aoScaling.volts_to_codes(np.zeros((2, 10)), ((0, 3276.8),))
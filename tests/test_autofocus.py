@@ -0,0 +1,46 @@
+'''
+ Sharpness metrics and the parabolic peak fit used by autoFocuser
+'''
+
+import numpy as np
+import pytest
+
+from autoFocuser import fit_peak, sharpness
+
+
+def _blurred_stack(widths, size=64, seed=0):
+    # The same random texture blurred by a Gaussian of each width, in pixels
+    rng = np.random.default_rng(seed)
+    image = rng.random((size, size))
+    k = np.hypot(*np.meshgrid(np.fft.fftfreq(size), np.fft.fftfreq(size)))
+    return np.stack([np.fft.ifft2(np.fft.fft2(image)*np.exp(-2*(np.pi*k*w)**2)).real for w in widths])
+
+
+@pytest.mark.parametrize('metric', ['laplacian', 'gradient'])
+def test_sharpness_falls_with_blur(metric):
+    scores = sharpness(_blurred_stack([0.5, 1, 2, 4]))[metric]
+    assert scores.shape == (4,)
+    assert np.all(np.diff(scores) < 0)
+
+
+def test_sharpness_rejects_small_stacks():
+    with pytest.raises(ValueError):
+        sharpness(np.zeros((3, 2, 10)))
+    with pytest.raises(ValueError):
+        sharpness(np.zeros((10, 10)))
+
+
+def test_fit_peak_finds_parabola_vertex():
+    z = np.linspace(-10, 10, 11)
+    scores = 100 - (z - 1.3)**2
+    peak, in_range = fit_peak(z, scores)
+    assert in_range
+    assert peak == pytest.approx(1.3)
+
+
+def test_fit_peak_at_edge_is_out_of_range():
+    z = np.linspace(0, 10, 6)
+    peak, in_range = fit_peak(z, z)
+    assert peak == 10 and not in_range
+    peak, in_range = fit_peak(z, -z)
+    assert peak == 0 and not in_range
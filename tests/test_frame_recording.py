@@ -0,0 +1,57 @@
+'''
+ Frames written by frameRecorder are read back unchanged by frameReader
+'''
+
+import numpy as np
+import pytest
+
+from frameRecording import frameRecorder, frameReader
+
+
+@pytest.mark.parametrize('frames_per_chunk', [1, 4, 8])
+def test_round_trip(tmp_path, frames_per_chunk):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(-2000, 2000, (11, 2, 32, 48)).astype(np.int16)
+    fname = str(tmp_path / 'test')
+
+    R = frameRecorder(fname, frames_per_chunk=frames_per_chunk, workers=2)
+    for ii, frame in enumerate(frames):
+        R.write(frame, first_sample=1000*ii)
+    R.close()
+
+    F = frameReader(fname)
+    try:
+        assert len(F) == frames.shape[0]
+        for ii in range(len(F)):
+            np.testing.assert_array_equal(F[ii], frames[ii])
+        np.testing.assert_array_equal(F[2:9], frames[2:9])
+        np.testing.assert_array_equal(F.sample_index, 1000*np.arange(frames.shape[0]))
+    finally:
+        F.close()
+
+
+def test_scaled_round_trip(tmp_path):
+    # Floats are stored as scale times their value, rounded and clipped to the integer type
+    rng = np.random.default_rng(1)
+    frames = rng.uniform(-3, 3, (5, 16, 16))
+    fname = str(tmp_path / 'test')
+
+    R = frameRecorder(fname, scale=1000, frames_per_chunk=2)
+    for frame in frames:
+        R.write(frame)
+    R.close()
+
+    F = frameReader(fname)
+    try:
+        for ii in range(len(F)):
+            np.testing.assert_allclose(F.read(ii, scaled=True), frames[ii], atol=0.5/1000 + 1e-12)
+    finally:
+        F.close()
+
+
+def test_shape_mismatch_raises(tmp_path):
+    R = frameRecorder(str(tmp_path / 'test'))
+    R.write(np.zeros((8, 8), dtype=np.int16))
+    with pytest.raises(ValueError):
+        R.write(np.zeros((8, 9), dtype=np.int16))
+    R.close()
@@ -0,0 +1,56 @@
+'''
+ Frames replayed from a raw recording equal the frames acquired while recording
+'''
+
+import numpy as np
+import pytest
+
+from frameRecording import frameReader
+
+
+@pytest.fixture
+def scanner(fast_simulation):
+    app = pytest.importorskip('pyqtgraph').mkQApp()
+    from basicScanner import basicScanner
+    B = basicScanner(autoconnect=False, simulated=True)
+    B.im_size = 64
+    B.set_up_tasks()
+    B.setup_plot()
+    yield B
+    B.stop_acquisition()
+    B.close_tasks()
+    B._win.close()
+    app.processEvents()
+
+
+def test_replay_equals_acquisition(scanner, tmp_path):
+    from rawRecording import rawReplay
+    B = scanner
+    B.start_raw_recording(str(tmp_path / 'raw'))
+    B.start_recording(str(tmp_path / 'acquired'), scale=100)
+    B.start_acquisition()
+    B.wait_for_frames(6)
+    B.stop_acquisition()
+    B.stop_recording()
+    B.stop_raw_recording()
+
+    R = rawReplay(str(tmp_path / 'raw'))
+    assert R.num_blocks >= 6
+    R.configure(B)
+    B.start_recording(str(tmp_path / 'replayed'), scale=100)
+    R.replay(realtime=False)
+    B.stop_recording()
+
+    acquired = frameReader(str(tmp_path / 'acquired'))
+    replayed = frameReader(str(tmp_path / 'replayed'))
+    try:
+        assert len(replayed) == R.num_blocks
+        assert len(acquired) > 0
+        # Frames dropped during acquisition are in the raw recording but not the frames
+        replayed_index = list(replayed.sample_index)
+        for ii in range(len(acquired)):
+            jj = replayed_index.index(acquired.sample_index[ii])
+            np.testing.assert_array_equal(replayed[jj], acquired[ii])
+    finally:
+        acquired.close()
+        replayed.close()
@@ -0,0 +1,64 @@
+'''
+ reconstructionEngine against a plain bincount mean of the samples in each pixel
+'''
+
+import numpy as np
+import pytest
+
+from reconstructionEngine import reconstructionEngine
+from scanPatterns import rasterPattern
+
+
+def _bincount_mean(pixel, frame_shape, data):
+    # The reference: every sample with pixel >= 0 averaged into its pixel, empty pixels 0
+    n = frame_shape[0]*frame_shape[1]
+    keep = pixel >= 0
+    counts = np.bincount(pixel[keep], minlength=n)
+    out = np.zeros(data.shape[:-1] + (n,))
+    for index in np.ndindex(data.shape[:-1]):
+        sums = np.bincount(pixel[keep], weights=data[index][keep], minlength=n)
+        out[index] = np.divide(sums, counts, out=np.zeros(n), where=counts > 0)
+    return out.reshape(data.shape[:-1] + frame_shape)
+
+
+@pytest.mark.parametrize('flyback, bidirectional', [(0, False), (16, False), (0, True), (16, True)])
+@pytest.mark.parametrize('oversample', [1, 3])
+def test_raster_matches_bincount(flyback, bidirectional, oversample):
+    plan = rasterPattern(24, 32, flyback_samples=flyback, bidirectional=bidirectional).compile()
+    engine = reconstructionEngine.from_plan(plan, oversample=oversample, use_numba=False)
+    data = np.random.default_rng(0).standard_normal((2, plan.num_samples*oversample))
+
+    pixel = np.repeat(np.asarray(plan.pixel_index, dtype=np.int64), oversample)
+    expected = _bincount_mean(pixel, plan.frame_shape, data)
+    np.testing.assert_allclose(engine.assemble(data), expected, atol=1e-12)
+
+
+def test_phase_and_binning_match_bincount():
+    plan = rasterPattern(24, 32, flyback_samples=8).compile()
+    engine = reconstructionEngine.from_plan(plan, phase=5, binning=2, use_numba=False)
+    data = np.random.default_rng(1).standard_normal((1, plan.num_samples))
+
+    pixel = np.roll(np.asarray(plan.pixel_index, dtype=np.int64), 5)
+    r, c = np.divmod(pixel, 32)
+    pixel = np.where(pixel >= 0, (r//2)*16 + c//2, -1)
+    np.testing.assert_allclose(engine.assemble(data), _bincount_mean(pixel, (12, 16), data), atol=1e-12)
+
+
+def test_sum_reduction_matches_bincount():
+    plan = rasterPattern(16, 16, flyback_samples=4).compile()
+    engine = reconstructionEngine.from_plan(plan, reduction='sum', use_numba=False)
+    data = np.random.default_rng(2).standard_normal((1, plan.num_samples))
+
+    pixel = np.asarray(plan.pixel_index, dtype=np.int64)
+    keep = pixel >= 0
+    expected = np.bincount(pixel[keep], weights=data[0][keep], minlength=256).reshape(16, 16)
+    np.testing.assert_allclose(engine.assemble(data)[0], expected, atol=1e-12)
+
+
+def test_numba_matches_numpy():
+    pytest.importorskip('numba')
+    plan = rasterPattern(24, 32, flyback_samples=8, bidirectional=True).compile()
+    data = np.random.default_rng(3).standard_normal((2, plan.num_samples*2))
+    numpy_frame = reconstructionEngine.from_plan(plan, oversample=2, use_numba=False).assemble(data)
+    numba_frame = reconstructionEngine.from_plan(plan, oversample=2, use_numba=True).assemble(data)
+    np.testing.assert_allclose(numba_frame, numpy_frame, atol=1e-12)